@@ -9,7 +9,6 @@ import warnings
 from collections import defaultdict
 from typing import List
 
-import pandas as pd
 import requests
 from pyshex import ShExEvaluator
 from rdflib import Graph
@@ -19,6 +18,9 @@ from wikidataintegrator.wdi_backoff import wdi_backoff
 from wikidataintegrator.wdi_config import config
 from wikidataintegrator.wdi_fastrun import FastRunContainer
 from wikidataintegrator.wdi_helpers import MappingRelationHelper
+from wikidataintegrator.wdi_sparql_cache import get_cache
+from wikidataintegrator.wdi_sparql_results import results_to_df
+from wikidataintegrator.wdi_transport import get_transport
 from wikidataintegrator import wdi_rdf
 
 """
@@ -63,7 +65,8 @@ class WDFunctionsEngine(object):
 
     @staticmethod
     @wdi_backoff()
-    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60):
+    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60,
+                             use_cache=True):
 
         """
         Static method which can be used to execute any SPARQL query
@@ -76,6 +79,8 @@ class WDFunctionsEngine(object):
         :type user_agent: str
         :param max_retries: The number time this function should retry in case of header reports.
         :param retry_after: the number of seconds should wait upon receiving either an error code or the WDQS is not reachable.
+        :param use_cache: Look up and store the results in the SPARQL result cache, if caching is enabled (see
+            wdi_sparql_cache)
         :return: The results of the query are returned in JSON format
         """
 
@@ -85,6 +90,12 @@ class WDFunctionsEngine(object):
         if prefix:
             query = prefix + '\n' + query
 
+        cache = get_cache() if use_cache else None
+        if cache is not None:
+            results = cache.get(query, sparql_endpoint_url)
+            if results is not None:
+                return WDItemEngine._sparql_query_result_to_df(results) if as_dataframe else results
+
         params = {
             'query': '#Tool: wdi_core fastrun\n' + query,
             'format': 'json'
@@ -98,7 +109,7 @@ class WDFunctionsEngine(object):
 
         for n in range(max_retries):
             try:
-                response = requests.post(sparql_endpoint_url, params=params, headers=headers)
+                response = get_transport().post(sparql_endpoint_url, data=params, headers=headers)
             except requests.exceptions.ConnectionError as e:
                 print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
                 time.sleep(retry_after)
@@ -115,6 +126,8 @@ class WDFunctionsEngine(object):
                 continue
             response.raise_for_status()
             results = response.json()
+            if cache is not None:
+                cache.put(query, sparql_endpoint_url, results)
 
             if as_dataframe:
                 return WDItemEngine._sparql_query_result_to_df(results)
@@ -122,21 +135,11 @@ class WDFunctionsEngine(object):
                 return results
 
     @staticmethod
-    def _sparql_query_result_to_df(results):
-
-        def parse_value(item):
-            if item.get("type") == "http://www.w3.org/2001/XMLSchema#decimal":
-                return float(item['value'])
-            if item.get("type") == "http://www.w3.org/2001/XMLSchema#integer":
-                return int(item['value'])
-            if item.get("type") == "http://www.w3.org/2001/XMLSchema#dateTime":
-                return datetime.datetime.strptime(item['value'], '%Y-%m-%dT%H:%M:%SZ')
-            return item['value']
-
-        results = results['results']['bindings']
-        results = [{k: parse_value(v) for k, v in item.items()} for item in results]
-        df = pd.DataFrame(results)
-        return df
+    def _sparql_query_result_to_df(results, strip_prefix=False, categorical=False, arrow=False):
+        """
+        :return: the results of a SPARQL query as a pandas dataframe, see `wdi_sparql_results.results_to_df`
+        """
+        return results_to_df(results, strip_prefix=strip_prefix, categorical=categorical, arrow=arrow)
 
     @staticmethod
     def delete_item(item, reason, login, mediawiki_api_url=None, user_agent=None):
@@ -165,7 +168,7 @@ class WDFunctionsEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     @staticmethod
@@ -182,7 +185,7 @@ class WDFunctionsEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     ## SHEX related functions
@@ -206,7 +209,7 @@ class WDFunctionsEngine(object):
         else:
             rdfdata.parse(data=data)
         entity_schema_repo = config["ENTITY_SCHEMA_REPO"] if entity_schema_repo is None else entity_schema_repo
-        schema = requests.get(entity_schema_repo+eid).text
+        schema = get_transport().get(entity_schema_repo+eid).text
 
         for result in ShExEvaluator(rdf=rdfdata, schema=schema, focus=config["CONCEPT_BASE_URI"] + qid).evaluate():
             shex_result = dict()
@@ -653,7 +656,7 @@ class WDItemEngine(object):
         while cont_count > 0:
             params.update({'continue': 0 if cont_count == 1 else cont_count})
 
-            reply = requests.get(mediawiki_api_url, params=params, headers=headers)
+            reply = get_transport().get(mediawiki_api_url, params=params, headers=headers)
             reply.raise_for_status()
             search_results = reply.json()
 
@@ -1314,7 +1317,7 @@ class WDItemEngine(object):
         rdfdata = wdi_rdf.WDqidRDFEngine(qid=self.wd_item_id, json_data=self.get_wd_json_representation(), max_steps=max_steps, current_step = 0).rdf_item
 
         entity_schema_repo = config["ENTITY_SCHEMA_REPO"] if entity_schema_repo is None else entity_schema_repo
-        schema = requests.get(entity_schema_repo+eid).text
+        schema = get_transport().get(entity_schema_repo+eid).text
 
         for result in ShExEvaluator(rdf=rdfdata, schema=schema, focus=config["CONCEPT_BASE_URI"] + self.wd_item_id).evaluate():
             shex_result = dict()
@@ -1338,7 +1341,8 @@ class WDItemEngine(object):
         """
         :param method: 'GET' or 'POST'
         :param mediawiki_api_url:
-        :param session: If a session is passed, it will be used. Otherwise a new requests session is created
+        :param session: If a session is passed, it will be used. Otherwise the shared transport is used, see
+        wdi_transport
         :param max_retries: If api request fails due to rate limiting, maxlag, or readonly mode, retry up to
         `max_retries` times
         :type max_retries: int
@@ -1351,7 +1355,7 @@ class WDItemEngine(object):
         mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
 
         response = None
-        session = session if session else requests.session()
+        session = session if session else get_transport()
         for n in range(max_retries):
             try:
                 response = session.request(method, mediawiki_api_url, **kwargs)
@@ -1515,7 +1519,7 @@ class WDItemEngine(object):
         if login:
             reply = login.get_session().get(url, params=params, headers=headers)
         else:
-            reply = requests.get(url, params=params)
+            reply = get_transport().get(url, params=params)
 
         item_instances = []
         for qid, v in reply.json()['entities'].items():
@@ -1528,7 +1532,7 @@ class WDItemEngine(object):
     @staticmethod
     @wdi_backoff()
     def execute_sparql_query(query, prefix=None, endpoint=None,
-                             user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60):
+                             user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60, use_cache=True):
         """
         Static method which can be used to execute any SPARQL query
 
@@ -1540,6 +1544,8 @@ class WDItemEngine(object):
         :type user_agent: str
         :param max_retries: The number time this function should retry in case of header reports.
         :param retry_after: the number of seconds should wait upon receiving either an error code or the WDQS is not reachable.
+        :param use_cache: Look up and store the results in the SPARQL result cache, if caching is enabled (see
+            wdi_sparql_cache)
         :return: The results of the query are returned in JSON format
         """
 
@@ -1549,6 +1555,12 @@ class WDItemEngine(object):
         if prefix:
             query = prefix + '\n' + query
 
+        cache = get_cache() if use_cache else None
+        if cache is not None:
+            results = cache.get(query, sparql_endpoint_url)
+            if results is not None:
+                return WDItemEngine._sparql_query_result_to_df(results) if as_dataframe else results
+
         params = {
             'query': '#Tool: wdi_core fastrun\n' + query,
             'format': 'json'
@@ -1562,7 +1574,7 @@ class WDItemEngine(object):
 
         for n in range(max_retries):
             try:
-                response = requests.post(sparql_endpoint_url, params=params, headers=headers)
+                response = get_transport().post(sparql_endpoint_url, data=params, headers=headers)
             except requests.exceptions.ConnectionError as e:
                 print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
                 time.sleep(retry_after)
@@ -1579,6 +1591,8 @@ class WDItemEngine(object):
                 continue
             response.raise_for_status()
             results = response.json()
+            if cache is not None:
+                cache.put(query, sparql_endpoint_url, results)
 
             if as_dataframe:
                 return WDItemEngine._sparql_query_result_to_df(results)
@@ -1586,21 +1600,11 @@ class WDItemEngine(object):
                 return results
 
     @staticmethod
-    def _sparql_query_result_to_df(results):
-
-        def parse_value(item):
-            if item.get("type") == "http://www.w3.org/2001/XMLSchema#decimal":
-                return float(item['value'])
-            if item.get("type") == "http://www.w3.org/2001/XMLSchema#integer":
-                return int(item['value'])
-            if item.get("type") == "http://www.w3.org/2001/XMLSchema#dateTime":
-                return datetime.datetime.strptime(item['value'], '%Y-%m-%dT%H:%M:%SZ')
-            return item['value']
-
-        results = results['results']['bindings']
-        results = [{k: parse_value(v) for k, v in item.items()} for item in results]
-        df = pd.DataFrame(results)
-        return df
+    def _sparql_query_result_to_df(results, strip_prefix=False, categorical=False, arrow=False):
+        """
+        :return: the results of a SPARQL query as a pandas dataframe, see `wdi_sparql_results.results_to_df`
+        """
+        return results_to_df(results, strip_prefix=strip_prefix, categorical=categorical, arrow=arrow)
 
     @staticmethod
     def get_linked_by(qid, mediawiki_api_url=None):
@@ -1613,13 +1617,13 @@ class WDItemEngine(object):
         mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
 
         linkedby = []
-        whatlinkshere = json.loads(requests.get(
+        whatlinkshere = json.loads(get_transport().get(
             mediawiki_api_url + "?action=query&list=backlinks&format=json&bllimit=500&bltitle=" + qid).text)
         for link in whatlinkshere["query"]["backlinks"]:
             if link["title"].startswith("Q"):
                 linkedby.append(link["title"])
         while 'continue' in whatlinkshere.keys():
-            whatlinkshere = json.loads(requests.get(
+            whatlinkshere = json.loads(get_transport().get(
                 mediawiki_api_url + "?action=query&list=backlinks&blcontinue=" +
                 whatlinkshere['continue']['blcontinue'] + "&format=json&bllimit=50&bltitle=" + "Q42").text)
             for link in whatlinkshere["query"]["backlinks"]:
@@ -1682,7 +1686,7 @@ class WDItemEngine(object):
 
         try:
             # TODO: should we retry this?
-            merge_reply = requests.post(url=url, data=params, headers=headers, cookies=login_obj.get_edit_cookie())
+            merge_reply = get_transport().post(url=url, data=params, headers=headers, cookies=login_obj.get_edit_cookie())
             merge_reply.raise_for_status()
 
             if 'error' in merge_reply.json():
@@ -1745,7 +1749,7 @@ class WDItemEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     @staticmethod
@@ -1762,7 +1766,7 @@ class WDItemEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     ## References
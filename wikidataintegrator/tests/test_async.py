@@ -0,0 +1,108 @@
+import asyncio
+import json
+import threading
+import time
+
+from wikidataintegrator import wdi_core, wdi_transport
+from wikidataintegrator.wdi_async import WDAsyncClient
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.data)
+
+
+class FakeTransport(object):
+    """
+    Answers each query with the query, after a delay. The first request asks to retry after 0 seconds
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    def _enter(self):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return self.calls
+
+    def _exit(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        n = self._enter()
+        time.sleep(0.02)
+        self._exit()
+        if n == 1:
+            return FakeResponse('', status_code=429, headers={'retry-after': '0'})
+        results = {'head': {'vars': ['q']},
+                   'results': {'bindings': [{'q': {'type': 'literal', 'value': data['query']}}]}}
+        return FakeResponse(json.dumps(results))
+
+    def request(self, method, url, params=None, **kwargs):
+        n = self._enter()
+        time.sleep(0.02)
+        self._exit()
+        if n == 1:
+            return FakeResponse(json.dumps({'error': {'code': 'maxlag', 'lag': 0}}))
+        ids = params['ids'].split('|')
+        assert len(ids) <= 50
+        return FakeResponse(json.dumps({'entities': {x: {'id': x, 'claims': {}} for x in ids}}))
+
+
+class FakeItem(object):
+    def __init__(self, wd_item_id, item_data):
+        self.wd_item_id = wd_item_id
+        self.item_data = item_data
+
+
+def test_sparql_queries():
+    transport = FakeTransport()
+    client = WDAsyncClient(concurrency=4, transport=transport)
+    queries = ['SELECT * WHERE {{ ?s ?p {} }}'.format(i) for i in range(40)]
+    results = asyncio.run(client.execute_sparql_queries(queries, endpoint='https://query.example.org/sparql'))
+
+    # one retry after the 429
+    assert transport.calls == 41
+    # the queries ran 4 at a time
+    assert transport.max_in_flight == 4
+    assert [r['results']['bindings'][0]['q']['value'] for r in results] == \
+        ['#Tool: wdi_core fastrun\n' + q for q in queries]
+
+    # the same results as the synchronous api, also as a dataframe
+    wdi_transport.set_transport(transport)
+    try:
+        assert wdi_core.WDItemEngine.execute_sparql_query(queries[0], endpoint='https://query.example.org/sparql') \
+            == results[0]
+    finally:
+        wdi_transport.set_transport(None)
+    df = asyncio.run(client.execute_sparql_query(queries[0], as_dataframe=True))
+    assert df.q[0] == '#Tool: wdi_core fastrun\n' + queries[0]
+    client.close()
+
+
+def test_generate_item_instances():
+    transport = FakeTransport()
+    client = WDAsyncClient(concurrency=3, transport=transport)
+    qids = ['Q{}'.format(i) for i in range(1, 501)]
+    items = asyncio.run(client.generate_item_instances(qids, engine=FakeItem))
+
+    # ten batches of 50, and one retry after maxlag
+    assert transport.calls == 11
+    assert transport.max_in_flight == 3
+    assert sorted(qid for qid, _ in items) == sorted(qids)
+    assert all(item.item_data == {'id': qid, 'claims': {}} for qid, item in items)
+    client.close()
@@ -0,0 +1,127 @@
+import json
+import re
+import threading
+import time
+
+import pytest
+
+from wikidataintegrator import wdi_transport
+from wikidataintegrator.wdi_helpers import BatchResolver, get_values
+
+ENTITY = 'http://www.wikidata.org/entity/'
+EXACT = 'Q39893449'
+
+# pmid -> list of (qid, mapping relation type)
+MAPPINGS = {str(i): [('Q{}'.format(1000 + i), None)] for i in range(0, 2000, 3)}
+MAPPINGS['3'].append(('Q7', None))
+MAPPINGS['6'] = [('Q8', EXACT), ('Q9', None)]
+# statements that are not of the best rank
+MAPPINGS['10'] = [('Q5', None)]
+NOT_BEST_RANK = {('10', 'Q5')}
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, results):
+        self.results = results
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.results
+
+
+class FakeTransport(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.queries = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, data=None, **kwargs):
+        query = data['query']
+        with self.lock:
+            self.queries.append(query)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        values = re.search(r'VALUES \?(\w+) \{ (.*) \}', query)
+        rows = []
+        if values.group(1) == 'id':
+            for pmid in re.findall(r'"(\d+)"', values.group(2)):
+                rows += [(pmid, qid, mrt) for qid, mrt in MAPPINGS.get(pmid, [])]
+        else:
+            qids = set(re.findall(r'entity/(Q\d+)>', values.group(2)))
+            rows = [(pmid, qid, mrt) for pmid, items in MAPPINGS.items() for qid, mrt in items if qid in qids]
+        if 'wikibase:BestRank' in query:
+            rows = [row for row in rows if row[:2] not in NOT_BEST_RANK]
+        bindings = []
+        # the endpoint returns the rows in any order
+        for pmid, qid, mrt in reversed(rows):
+            binding = {'id': {'type': 'literal', 'value': pmid}, 'item': {'type': 'uri', 'value': ENTITY + qid}}
+            if mrt:
+                binding['mrt'] = {'type': 'uri', 'value': ENTITY + mrt}
+            bindings.append(binding)
+        time.sleep(self.delay * (1 + len(bindings) / 100))
+        with self.lock:
+            self.running -= 1
+        return FakeResponse({'head': {'vars': ['id', 'item', 'mrt']}, 'results': {'bindings': bindings}})
+
+
+@pytest.fixture
+def transport():
+    transport = FakeTransport()
+    wdi_transport.set_transport(transport)
+    yield transport
+    wdi_transport.set_transport(None)
+
+
+def test_values_to_qids(transport):
+    values = [str(i) for i in reversed(range(2000))] + ['12']
+    resolver = BatchResolver('P698', max_workers=3)
+    resolver.initial_chunk_size = resolver.chunk_size = 100
+    d = resolver.values_to_qids(values)
+    # in the order of the values, without those that are on no item
+    assert list(d) == [v for v in values[:2000] if v in MAPPINGS]
+    assert d['12'] == 'Q1012' and d['6'] in {'Q8', 'Q9'}
+    assert 'P698' in transport.queries[0]
+
+    assert BatchResolver('P698', prefer_exact_match=True).values_to_qids(['6']) == {'6': 'Q8'}
+    # nothing found, or nothing to look up
+    assert BatchResolver('P698', prefer_exact_match=True).values_to_qids(['1', '2']) == {}
+    assert BatchResolver('P698', prefer_exact_match=True).values_to_qids([]) == {}
+    assert BatchResolver('P698').values_to_qids(['3', '6'], return_as_set=True) == {
+        '3': {'Q1003', 'Q7'}, '6': {'Q8', 'Q9'}}
+    with pytest.raises(ValueError):
+        BatchResolver('P698', raise_on_duplicate=True).values_to_qids(['3', '4'])
+
+    # like wdt:, get_values only uses the statements of the best rank
+    assert BatchResolver('P698').values_to_qids(['9', '10']) == {'9': 'Q1009', '10': 'Q5'}
+    assert get_values('P698', ['9', '10', 9]) == {'9': 'Q1009'}
+    assert 'wikibase:BestRank' in transport.queries[-1]
+
+
+def test_qids_to_values(transport):
+    d = BatchResolver('P698').qids_to_values(['Q1999', 'Q1000', 'Q1', 'Q7'])
+    assert d == {'Q1999': '999', 'Q1000': '0', 'Q7': '3'}
+    assert list(d) == ['Q1999', 'Q1000', 'Q7']
+
+
+def test_chunk_sizes(transport):
+    transport.delay = 0.02
+    resolver = BatchResolver('P698', max_workers=4)
+    resolver.initial_chunk_size = resolver.chunk_size = 10
+    resolver.target_latency = 0.1
+    resolver.max_query_length = 2000
+    d = resolver.values_to_qids(str(i) for i in range(2000))
+    assert len(d) == len(MAPPINGS)
+
+    assert 1 < transport.max_running <= 4
+    sizes = [len(re.findall(r'"\d+"', q)) for q in transport.queries]
+    assert max(sizes) > 10
+    # without the '#Tool' comment line added to every query
+    assert max(len(q.split('\n', 1)[1]) for q in transport.queries) <= 2000
+    assert sum(sizes) == 2000
@@ -0,0 +1,305 @@
+import copy
+import random
+import time
+
+import pytest
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_core import WDBaseDataType
+
+DATABASES = {'Q905695': ['P352'], 'Q1345229': ['P594']}
+
+
+class LegacyEngine(wdi_core.WDItemEngine):
+    def _WDItemEngine__construct_claim_json(self):
+        # __construct_claim_json before statements were indexed
+        if not self.data and self._statements is None:
+            # nothing to merge: the claims json stays as loaded, without building the statements
+            return
+
+
+        def handle_qualifiers(old_item, new_item):
+            if not new_item.check_qualifier_equality:
+                old_item.set_qualifiers(new_item.get_qualifiers())
+
+        def is_good_ref(ref_block):
+
+            databases = self.context.databases
+
+            prop_nrs = [x.get_prop_nr() for x in ref_block]
+            values = [x.get_value() for x in ref_block]
+            good_ref = True
+            prop_value_map = dict(zip(prop_nrs, values))
+
+            # if self.good_refs has content, use these to determine good references
+            if self.good_refs and len(self.good_refs) > 0:
+                found_good = True
+                for rblock in self.good_refs:
+
+                    if not all([k in prop_value_map for k, v in rblock.items()]):
+                        found_good = False
+
+                    if not all([v in prop_value_map[k] for k, v in rblock.items() if v]):
+                        found_good = False
+
+                    if found_good:
+                        return True
+
+                return False
+
+            # stated in, title, retrieved
+            ref_properties = ['P248', 'P1476', 'P813']
+
+            for v in values:
+                if prop_nrs[values.index(v)] == 'P248':
+                    return True
+                elif v == 'P698':
+                    return True
+
+            for p in ref_properties:
+                if p not in prop_nrs:
+                    return False
+
+            for ref in ref_block:
+                pn = ref.get_prop_nr()
+                value = ref.get_value()
+
+                if pn == 'P248' and value not in databases and 'P854' not in prop_nrs:
+                    return False
+                elif pn == 'P248' and value in databases:
+                    db_props = databases[value]
+                    if not any([False if x not in prop_nrs else True for x in db_props]) and 'P854' not in prop_nrs:
+                        return False
+
+            return good_ref
+
+        def handle_references(old_item, new_item):
+            """
+            Local function to handle references
+
+            :param old_item: An item containing the data as currently in WD
+            :type old_item: A child of WDBaseDataType
+            :param new_item: An item containing the new data which should be written to WD
+            :type new_item: A child of WDBaseDataType
+            """
+            # stated in, title, language of work, retrieved, imported from
+            ref_properties = ['P248', 'P1476', 'P407', 'P813', 'P143']
+            new_references = new_item.get_references()
+            old_references = old_item.get_references()
+
+            if any([z.overwrite_references for y in new_references for z in y]) \
+                    or sum(map(lambda z: len(z), old_references)) == 0 \
+                    or self.global_ref_mode == 'STRICT_OVERWRITE':
+                old_item.set_references(new_references)
+
+            elif self.global_ref_mode == 'STRICT_KEEP' or new_item.statement_ref_mode == 'STRICT_KEEP':
+                pass
+
+            elif self.global_ref_mode == 'STRICT_KEEP_APPEND' or new_item.statement_ref_mode == 'STRICT_KEEP_APPEND':
+                old_references.extend(new_references)
+                old_item.set_references(old_references)
+
+            elif self.global_ref_mode == 'CUSTOM' or new_item.statement_ref_mode == 'CUSTOM':
+                self.ref_handler(old_item, new_item)
+
+            elif self.global_ref_mode == 'KEEP_GOOD' or new_item.statement_ref_mode == 'KEEP_GOOD':
+                keep_block = [False for x in old_references]
+                for count, ref_block in enumerate(old_references):
+                    stated_in_value = [x.get_value() for x in ref_block if x.get_prop_nr() == 'P248']
+                    if is_good_ref(ref_block):
+                        keep_block[count] = True
+
+                    new_ref_si_values = [x.get_value() if x.get_prop_nr() == 'P248' else None
+                                         for z in new_references for x in z]
+
+                    for si in stated_in_value:
+                        if si in new_ref_si_values:
+                            keep_block[count] = False
+
+                refs = [x for c, x in enumerate(old_references) if keep_block[c]]
+                refs.extend(new_references)
+                old_item.set_references(refs)
+
+        # sort the incoming data according to the WD property number
+        self.data.sort(key=lambda z: z.get_prop_nr().lower())
+
+        # collect all statements which should be deleted
+        statements_for_deletion = []
+        for item in self.data:
+            if item.get_value() == '' and isinstance(item, WDBaseDataType):
+                statements_for_deletion.append(item.get_prop_nr())
+
+        if self.create_new_item:
+            self.statements = copy.copy(self.data)
+        else:
+            for stat in self.data:
+                prop_nr = stat.get_prop_nr()
+
+                prop_data = [x for x in self.statements if x.get_prop_nr() == prop_nr]
+                prop_pos = [x.get_prop_nr() == prop_nr for x in self.statements]
+                prop_pos.reverse()
+                insert_pos = len(prop_pos) - (prop_pos.index(True) if any(prop_pos) else 0)
+
+                # If value should be appended, check if values exists, if not, append
+                if prop_nr in self.append_value:
+                    equal_items = [stat == x for x in prop_data]
+                    if True not in equal_items:
+                        self.statements.insert(insert_pos + 1, stat)
+                    else:
+                        # if item exists, modify rank
+                        current_item = prop_data[equal_items.index(True)]
+                        current_item.set_rank(stat.get_rank())
+                        handle_references(old_item=current_item, new_item=stat)
+                        handle_qualifiers(old_item=current_item, new_item=stat)
+                    continue
+
+                # set all existing values of a property for removal
+                for x in prop_data:
+                    # for deletion of single statements, do not set all others to delete
+                    if hasattr(stat, 'remove'):
+                        break
+                    elif x.get_id() and not hasattr(x, 'retain'):
+                        # keep statements with good references if keep_good_ref_statements is True
+                        if self.keep_good_ref_statements:
+                            if any([is_good_ref(r) for r in x.get_references()]):
+                                setattr(x, 'retain', '')
+                        else:
+                            setattr(x, 'remove', '')
+
+                match = []
+                for i in prop_data:
+                    if stat == i and hasattr(stat, 'remove'):
+                        match.append(True)
+                        setattr(i, 'remove', '')
+                    elif stat == i:
+                        match.append(True)
+                        setattr(i, 'retain', '')
+                        if hasattr(i, 'remove'):
+                            delattr(i, 'remove')
+                        handle_references(old_item=i, new_item=stat)
+                        handle_qualifiers(old_item=i, new_item=stat)
+
+                        i.set_rank(rank=stat.get_rank())
+                    # if there is no value, do not add an element, this is also used to delete whole properties.
+                    elif i.get_value():
+                        match.append(False)
+
+                if True not in match and not hasattr(stat, 'remove'):
+                    self.statements.insert(insert_pos + 1, stat)
+
+        # For whole property deletions, add remove flag to all statements which should be deleted
+        for item in copy.deepcopy(self.statements):
+            if item.get_prop_nr() in statements_for_deletion and item.get_id() != '':
+                setattr(item, 'remove', '')
+            elif item.get_prop_nr() in statements_for_deletion:
+                self.statements.remove(item)
+
+        # regenerate claim json
+        self.wd_json_representation['claims'] = {}
+        for stat in self.statements:
+            prop_nr = stat.get_prop_nr()
+            if prop_nr not in self.wd_json_representation['claims']:
+                self.wd_json_representation['claims'][prop_nr] = []
+            self.wd_json_representation['claims'][prop_nr].append(stat.get_json_representation())
+
+
+def snak(prop_nr, value):
+    if value.startswith('Q'):
+        return {'snaktype': 'value', 'property': prop_nr, 'datatype': 'wikibase-item',
+                'datavalue': {'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value},
+                              'type': 'wikibase-entityid'}}
+    return {'snaktype': 'value', 'property': prop_nr, 'datatype': 'external-id',
+            'datavalue': {'value': value, 'type': 'string'}}
+
+
+def statement(rng, prop_nr, value):
+    if prop_nr.endswith('1'):
+        datatype, value = wdi_core.WDItemID, 'Q{}'.format(value)
+    else:
+        datatype, value = wdi_core.WDExternalID, 'V{}'.format(value)
+    qualifiers = [wdi_core.WDString('q{}'.format(rng.randrange(3)), 'P1545', is_qualifier=True)
+                  for _ in range(rng.choice([0, 0, 1, 2]))]
+    references = []
+    for _ in range(rng.choice([0, 1, 1, 2])):
+        db = rng.choice(sorted(DATABASES) + ['Q5'])
+        block = [wdi_core.WDItemID(db, 'P248', is_reference=True)]
+        if rng.random() < 0.5:
+            block.append(wdi_core.WDExternalID('V{}'.format(rng.randrange(5)), rng.choice(['P352', 'P594']),
+                                               is_reference=True))
+        references.append(block)
+    return datatype(value, prop_nr, qualifiers=qualifiers, references=references,
+                    rank=rng.choice(['normal', 'normal', 'preferred', 'deprecated']))
+
+
+def entity(rng, n_statements, n_props):
+    """
+    The json of an item with random statements, as wbgetentities returns it
+    """
+    claims = dict()
+    for n in range(n_statements):
+        prop_nr = 'P{}'.format(100 + rng.randrange(n_props))
+        claim = statement(rng, prop_nr, rng.randrange(n_statements // n_props + 3)).get_json_representation()
+        claim['id'] = 'Q42${}'.format(n)
+        claim['mainsnak']['datatype'] = 'wikibase-item' if prop_nr.endswith('1') else 'external-id'
+        for x in claim['qualifiers'].values():
+            for q in x:
+                q['datatype'] = 'string'
+        claim['references'] = [{'snaks': {p: [dict(v, datatype=snak(p, 'Q1' if p == 'P248' else 'V')['datatype'])
+                                              for v in vs] for p, vs in ref['snaks'].items()},
+                                'snaks-order': ref['snaks-order'], 'hash': 'h{}'.format(n)}
+                               for ref in claim['references']]
+        claims.setdefault(prop_nr, []).append(claim)
+    return {'id': 'Q42', 'labels': {}, 'descriptions': {}, 'aliases': {}, 'claims': claims}
+
+
+def new_data(rng, n_statements, n_props, n_existing):
+    data = []
+    for _ in range(n_statements):
+        prop_nr = 'P{}'.format(100 + rng.randrange(n_props + 2))
+        stat = statement(rng, prop_nr, rng.randrange(n_existing // n_props + 4))
+        if rng.random() < 0.05:
+            setattr(stat, 'remove', '')
+        data.append(stat)
+    if rng.random() < 0.5:
+        # delete a whole property
+        data.append(wdi_core.WDExternalID('', 'P{}'.format(100 + rng.randrange(n_props))))
+    return data
+
+
+def merged(engine, item, data, **kwargs):
+    item = engine(wd_item_id='Q42', item_data=copy.deepcopy(item), data=copy.deepcopy(data), core_props=set(),
+                  **kwargs)
+    return item.get_wd_json_representation()['claims'], \
+        [(type(x), x.get_json_representation(), hasattr(x, 'remove'), hasattr(x, 'retain')) for x in item.statements]
+
+
+@pytest.fixture(autouse=True)
+def databases(monkeypatch):
+    monkeypatch.setattr(wdi_core.WDItemEngine, 'databases', DATABASES)
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_merge_is_unchanged(seed):
+    rng = random.Random(seed)
+    n_props = rng.choice([1, 3, 10])
+    n_existing = rng.choice([0, 5, 30, 100])
+    item = entity(rng, n_existing, n_props) if n_existing else {'id': 'Q42', 'claims': {}}
+    data = new_data(rng, rng.choice([1, 10, 50]), n_props, n_existing)
+    kwargs = {
+        'append_value': rng.sample(['P{}'.format(100 + i) for i in range(n_props)], rng.randrange(2)),
+        'global_ref_mode': rng.choice(['KEEP_GOOD', 'STRICT_KEEP', 'STRICT_KEEP_APPEND', 'STRICT_OVERWRITE']),
+        'keep_good_ref_statements': rng.random() < 0.3,
+    }
+    assert merged(wdi_core.WDItemEngine, item, data, **kwargs) == merged(LegacyEngine, item, data, **kwargs)
+
+
+if __name__ == '__main__':
+    # time the merge of 2000 statements into an item of 5000
+    wdi_core.WDItemEngine.databases = DATABASES
+    rng = random.Random(0)
+    item = entity(rng, 5000, 200)
+    data = new_data(rng, 2000, 200, 5000)
+    for engine in (LegacyEngine, wdi_core.WDItemEngine):
+        start = time.time()
+        result = merged(engine, item, data)
+        print(engine.__name__, time.time() - start)
@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+from wikidataintegrator import wdi_core, wdi_engine_context
+from wikidataintegrator.wdi_engine_context import EngineContext, get_context
+
+ENDPOINT = 'http://localhost:1/sparql'
+
+
+class FakeEngine(wdi_core.WDItemEngine):
+    queries = 0
+    DISTINCT_VALUE_PROPS = dict()
+
+    @classmethod
+    def execute_sparql_query(cls, query, *args, **kwargs):
+        cls.queries += 1
+        return pd.DataFrame({'p': ['http://www.wikidata.org/entity/P352']})
+
+
+class FailingMappingRelationHelper(object):
+    calls = 0
+
+    def __init__(self, sparql_endpoint_url):
+        FailingMappingRelationHelper.calls += 1
+        raise ValueError("no mapping relation type property")
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    FakeEngine.queries = 0
+    FakeEngine.DISTINCT_VALUE_PROPS = dict()
+    FailingMappingRelationHelper.calls = 0
+    monkeypatch.setattr(wdi_engine_context, 'MappingRelationHelper', FailingMappingRelationHelper)
+    wdi_engine_context.clear_contexts()
+    yield
+    wdi_engine_context.clear_contexts()
+
+
+def test_setup_is_shared():
+    items = [FakeEngine(wd_item_id='Q{}'.format(i), item_data={'id': 'Q{}'.format(i), 'claims': {}},
+                        sparql_endpoint_url=ENDPOINT) for i in range(1, 101)]
+    assert FakeEngine.queries == 1
+    assert FailingMappingRelationHelper.calls == 1
+    assert all(item.context is items[0].context for item in items)
+    assert all(item.core_props == {'P352'} and item.mrh is None for item in items)
+    assert get_context(FakeEngine, ENDPOINT) is items[0].context
+    assert get_context(FakeEngine, 'http://localhost:2/sparql') is not items[0].context
+
+
+def test_explicit_context():
+    context = EngineContext(engine=FakeEngine, sparql_endpoint_url=ENDPOINT, mediawiki_api_url='http://localhost:1/api',
+                            core_props={'P698'})
+    item = FakeEngine(wd_item_id='Q1', item_data={'id': 'Q1', 'claims': {}}, context=context)
+    assert item.context is context
+    assert item.sparql_endpoint_url == ENDPOINT
+    assert item.mediawiki_api_url == 'http://localhost:1/api'
+    assert item.core_props == {'P698'}
+    # core_props were given, so the distinct value properties are not queried
+    assert FakeEngine.queries == 0
+
+    item = FakeEngine(wd_item_id='Q1', item_data={'id': 'Q1', 'claims': {}}, context=context,
+                      mediawiki_api_url='http://localhost:2/api')
+    assert item.mediawiki_api_url == 'http://localhost:2/api'
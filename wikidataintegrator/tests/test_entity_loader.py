@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+
+import pytest
+
+from wikidataintegrator import wdi_core, wdi_transport
+from wikidataintegrator.wdi_entity_loader import WDEntityLoader
+
+# Q2 redirects to Q2000, Q4 was deleted, Q0 is not a valid ID
+REDIRECTS = {'Q2': 'Q2000'}
+DELETED = {'Q4'}
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeTransport(object):
+    def __init__(self, rights=()):
+        self.rights = list(rights)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, url, params=None, **kwargs):
+        with self.lock:
+            self.calls.append(params)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            n = len(self.calls)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        assert params['maxlag'] == wdi_core.config['MAXLAG']
+        if params['action'] == 'query':
+            return FakeResponse({'query': {'userinfo': {'id': 1, 'name': 'Bot', 'rights': self.rights}}})
+        if n == 2:
+            return FakeResponse({'error': {'code': 'maxlag', 'lag': 0}})
+        ids = params['ids'].split('|')
+        if 'Q0' in ids:
+            return FakeResponse({'error': {'code': 'no-such-entity', 'id': 'Q0'}})
+        entities = dict()
+        for x in ids:
+            if x in DELETED:
+                entities[x] = {'id': x, 'missing': ''}
+            elif x in REDIRECTS:
+                entities[REDIRECTS[x]] = {'id': REDIRECTS[x], 'claims': {}, 'redirects': {'from': x, 'to': REDIRECTS[x]}}
+            else:
+                entities[x] = {'id': x, 'claims': {}}
+        return FakeResponse({'entities': entities})
+
+
+class FakeLogin(object):
+    def __init__(self, session):
+        self.session = session
+
+    def get_session(self):
+        return self.session
+
+
+class FakeItem(wdi_core.WDItemEngine):
+    def __init__(self, wd_item_id, item_data):
+        self.wd_item_id = wd_item_id
+        self.item_data = item_data
+
+
+@pytest.fixture
+def transport():
+    transport = FakeTransport()
+    wdi_transport.set_transport(transport)
+    yield transport
+    wdi_transport.set_transport(None)
+
+
+def test_load(transport):
+    qids = ['Q{}'.format(i) for i in range(1, 1001)] + ['Q5']
+    consumed = []
+
+    def items():
+        for qid in qids:
+            consumed.append(qid)
+            yield qid
+
+    loader = WDEntityLoader(FakeItem, max_workers=3)
+    loaded = loader.load(items())
+    qid, item = next(loaded)
+    # the first items come before all the IDs were read
+    assert len(consumed) < len(qids)
+    assert isinstance(item, FakeItem) and item.wd_item_id == qid and item.item_data['id'] == qid
+
+    loaded = dict([(qid, item)] + list(loaded))
+    assert set(loaded) == set(qids) - {'Q2', 'Q4'} | {'Q2000'}
+    assert loader.missing == ['Q4']
+    assert loader.redirects == {'Q2': 'Q2000'}
+    # 20 calls of 50 IDs, and one retry after maxlag
+    assert len(transport.calls) == 21
+    assert all(len(call['ids'].split('|')) == 50 for call in transport.calls)
+    assert 1 < transport.max_in_flight <= 3
+
+
+def test_invalid_ids(transport):
+    loaded = dict(FakeItem.iter_item_instances(['Q1', 'Q0', 'Q5'], loader=WDEntityLoader(FakeItem, batch_size=5)))
+    assert set(loaded) == {'Q1', 'Q5'}
+    assert len(transport.calls) == 5
+
+
+def test_high_limits():
+    bot = FakeTransport(rights=['edit', 'apihighlimits'])
+    loader = WDEntityLoader(FakeItem, login=FakeLogin(bot))
+    assert loader.get_batch_size() == 500
+    assert len(list(loader.load('Q{}'.format(i) for i in range(1, 1001)))) == 999
+    assert sorted(len(call['ids'].split('|')) for call in bot.calls[1:]) == [500, 500, 500]
+
+    user = FakeTransport(rights=['edit'])
+    assert WDEntityLoader(FakeItem, login=FakeLogin(user)).get_batch_size() == 50
@@ -0,0 +1,123 @@
+import copy
+
+import pytest
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_entity_view import WDEntityView
+
+
+def claim(prop_nr, value, datatype='external-id', references=(), rank='normal'):
+    if datatype == 'wikibase-item':
+        datavalue = {'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value},
+                     'type': 'wikibase-entityid'}
+    else:
+        datavalue = {'value': value, 'type': 'string'}
+    return {
+        'mainsnak': {'snaktype': 'value', 'property': prop_nr, 'datavalue': datavalue, 'datatype': datatype},
+        'type': 'statement',
+        'id': 'Q1$' + prop_nr + value,
+        'rank': rank,
+        'references': [{
+            'hash': 'h' + ref,
+            'snaks': {'P248': [{'snaktype': 'value', 'property': 'P248', 'datatype': 'wikibase-item',
+                                'datavalue': {'value': {'entity-type': 'item', 'numeric-id': int(ref[1:]),
+                                                        'id': ref}, 'type': 'wikibase-entityid'}}]},
+            'snaks-order': ['P248']
+        } for ref in references]
+    }
+
+
+ITEM = {
+    'id': 'Q1',
+    'lastrevid': 10,
+    'labels': {'en': {'language': 'en', 'value': 'protein'}},
+    'descriptions': {},
+    'aliases': {'en': [{'language': 'en', 'value': 'prot'}]},
+    'sitelinks': {'enwiki': {'site': 'enwiki', 'title': 'Protein'}},
+    'claims': {
+        'P31': [claim('P31', 'Q8054', 'wikibase-item'), claim('P31', 'Q5', 'wikibase-item', rank='deprecated')],
+        'P352': [claim('P352', 'P12345', references=['Q905695'])],
+        'P594': [claim('P594', 'ENSG1'), claim('P594', 'ENSG2')],
+    }
+}
+
+
+@pytest.fixture(autouse=True)
+def databases(monkeypatch):
+    # the reference databases are not loaded from wikidata
+    monkeypatch.setattr(wdi_core.WDItemEngine, 'databases', {'Q905695': ['P352']})
+
+
+def engine(**kwargs):
+    return wdi_core.WDItemEngine(wd_item_id='Q1', item_data=copy.deepcopy(ITEM), core_props={'P352'}, **kwargs)
+
+
+def test_statements_are_built_lazily(monkeypatch):
+    built = []
+    build_statements = wdi_core.WDItemEngine._build_statements
+
+    def counting_build_statements(self, prop_nr):
+        built.append(prop_nr)
+        return build_statements(self, prop_nr)
+
+    monkeypatch.setattr(wdi_core.WDItemEngine, '_build_statements', counting_build_statements)
+    item = engine()
+    assert built == []
+    assert sorted(item.get_property_list()) == ['P31', 'P352', 'P594']
+
+    assert [x.get_value() for x in item.get_property_statements('P594')] == ['ENSG1', 'ENSG2']
+    assert built == ['P594']
+    # the statements of P594 are not built again
+    p594 = item.get_property_statements('P594')
+    assert built == ['P594']
+    assert [x.get_prop_nr() for x in item.statements] == ['P31', 'P31', 'P352', 'P594', 'P594']
+    assert item.statements[3] is p594[0]
+    assert built == ['P594', 'P31', 'P352']
+
+
+def test_update_matches_eager_parsing():
+    data = [wdi_core.WDExternalID('P12345', 'P352', references=[[wdi_core.WDItemID('Q1', 'P248', is_reference=True)]]),
+            wdi_core.WDExternalID('ENSG3', 'P594')]
+    item = engine(data=copy.deepcopy(data))
+    original = [x.get_json_representation() for x in item.original_statements]
+
+    # what the engine did before: all statements built when loading, and copied for each update
+    eager = engine()
+    eager.statements = [x for x in eager.statements]
+    eager.original_statements = copy.deepcopy(eager.statements)
+    eager.update(copy.deepcopy(data))
+    assert item.get_wd_json_representation()['claims'] == eager.get_wd_json_representation()['claims']
+
+    # updating again starts over from the item as it was loaded
+    item.update([wdi_core.WDExternalID('ENSG4', 'P594')])
+    eager.update([wdi_core.WDExternalID('ENSG4', 'P594')])
+    assert item.get_wd_json_representation()['claims'] == eager.get_wd_json_representation()['claims']
+    assert [x.get_json_representation() for x in item.original_statements] == original
+    assert [x.get_value() for x in item.get_property_statements('P594')] == ['ENSG1', 'ENSG2', 'ENSG3', 'ENSG4']
+
+
+def test_item_without_data_keeps_its_json():
+    item = engine()
+    assert item.get_wd_json_representation()['claims'] == ITEM['claims']
+    assert item.statements[0].get_value() == 8054
+    # the original statements are separate objects
+    assert item.original_statements[0] is not item.statements[0]
+    assert item.original_statements[0] == item.statements[0]
+
+
+def test_entity_view():
+    view = WDEntityView(item_data=ITEM)
+    assert view.wd_item_id == 'Q1' and view.lastrevid == 10
+    assert view.get_label() == 'protein'
+    assert view.get_label('de') == ''
+    assert view.get_description() == ''
+    assert view.get_aliases() == ['prot']
+    assert view.get_sitelink('enwiki') == 'Protein'
+    assert sorted(view.get_property_list()) == ['P31', 'P352', 'P594']
+    assert view.get_values('P31') == ['Q8054']
+    assert view.get_values('P31', include_deprecated=True) == ['Q8054', 'Q5']
+    assert view.get_values('P594') == ['ENSG1', 'ENSG2']
+    assert view.get_claims('P352') is ITEM['claims']['P352']
+    statements = view.get_statements('P352')
+    assert statements[0].get_value() == 'P12345'
+    assert statements[0].get_references()[0][0].get_value() == 905695
@@ -1,3 +1,10 @@
+import copy
+import datetime
+import re
+from collections import defaultdict
+
+import pytest
+
 from wikidataintegrator import wdi_core, wdi_fastrun
 wdi_fastrun.FastRunContainer.debug = True
 
@@ -183,4 +190,533 @@ def test_append_props():
                                        base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
                                        use_refs=True)
     assert frc.write_required(data=statements, append_props=['P527'], cqid=qid) is True
-    assert frc.write_required(data=statements, cqid=qid)
\ No newline at end of file
+    assert frc.write_required(data=statements, cqid=qid)
+
+def test_snapshot(tmp_path):
+    frc = frc_fake_query_data_ensembl(base_filter={'P594': '', 'P703': 'Q15978631'},
+                                      base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                      use_refs=True)
+    frc.data_timestamp = datetime.datetime.utcnow()
+    frc.save_snapshot(str(tmp_path))
+
+    # a container with the same parameters warm starts from the snapshot
+    frc2 = wdi_fastrun.FastRunContainer(base_filter={'P594': '', 'P703': 'Q15978631'},
+                                        base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                        use_refs=True)
+    assert frc2.load_snapshot(str(tmp_path))
+    assert frc2.prop_data == frc.prop_data
+    assert frc2.data_timestamp == frc.data_timestamp
+    statements = [wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594',
+                                        references=[[wdi_core.WDItemID("Q29458763", "P248", is_reference=True),
+                                                     wdi_core.WDExternalID("ENSG00000123374", "P594",
+                                                                           is_reference=True)]])]
+    assert not frc2.write_required(data=statements)
+
+    # too old
+    assert not frc2.load_snapshot(str(tmp_path), max_age=datetime.timedelta(seconds=-1))
+
+    # different parameters don't match the snapshot
+    frc3 = wdi_fastrun.FastRunContainer(base_filter={'P594': '', 'P703': 'Q15978631'},
+                                        base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                        use_refs=False)
+    assert not frc3.load_snapshot(str(tmp_path))
+    assert frc3.prop_data == {}
+
+    # nor does a container storing its statements in the other form
+    frc4 = wdi_fastrun.FastRunContainer(base_filter={'P594': '', 'P703': 'Q15978631'},
+                                        base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                        use_refs=True, compact=True)
+    assert not frc4.load_snapshot(str(tmp_path))
+    assert isinstance(frc4.prop_data, wdi_fastrun.CompactPropData)
+
+
+# recorded from https://www.wikidata.org/w/api.php?action=query&list=recentchanges&rcprop=title|timestamp&rcdir=newer
+# (trimmed, the second page is what a wikibase with an 'Item' namespace returns, pages of other namespaces were
+# added to check they are left out)
+recent_changes_pages = [
+    {'batchcomplete': '',
+     'continue': {'rccontinue': '20171018120512|1290512345', 'continue': '-||'},
+     'query': {'recentchanges': [
+         {'type': 'edit', 'ns': 0, 'title': 'Q14911732', 'timestamp': '2017-10-18T12:01:33Z'},
+         {'type': 'new', 'ns': 0, 'title': 'Q28548813', 'timestamp': '2017-10-18T12:03:02Z'},
+         {'type': 'edit', 'ns': 4, 'title': 'Wikidata:Project chat', 'timestamp': '2017-10-18T12:03:10Z'},
+         {'type': 'edit', 'ns': 1, 'title': 'Talk:Q42', 'timestamp': '2017-10-18T12:03:15Z'},
+         {'type': 'edit', 'ns': 3, 'title': 'User talk:Example', 'timestamp': '2017-10-18T12:03:20Z'},
+         {'type': 'edit', 'ns': 10, 'title': 'Template:Property documentation',
+          'timestamp': '2017-10-18T12:03:30Z'}]}},
+    {'batchcomplete': '',
+     'query': {'recentchanges': [
+         {'type': 'edit', 'ns': 120, 'title': 'Item:Q14911732', 'timestamp': '2017-10-18T12:05:12Z'},
+         {'type': 'log', 'ns': 0, 'title': 'Q21109414', 'timestamp': '2017-10-18T12:06:40Z'},
+         {'type': 'log', 'ns': 0, 'title': 'Main Page', 'timestamp': '2017-10-18T12:07:00Z'}]}},
+]
+
+
+class fake_engine_recent_changes(wdi_core.WDItemEngine):
+    queries = []
+
+    @staticmethod
+    def mediawiki_api_call(method, mediawiki_api_url=None, session=None, max_retries=1000, retry_after=60, **kwargs):
+        assert kwargs['params']['list'] == 'recentchanges'
+        assert kwargs['params']['rcnamespace'] == '0|120|146'
+        return recent_changes_pages[1 if 'rccontinue' in kwargs['params'] else 0]
+
+    @staticmethod
+    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                             max_retries=1000, retry_after=60, use_cache=True, result_format='json',
+                             query_class='lookup'):
+        # the edited items are queried again, not looked up in the result cache
+        assert not use_cache
+        fake_engine_recent_changes.queries.append(query)
+        assert 'VALUES ?item' in query
+        uri = 'http://www.wikidata.org/entity/'
+        bindings = [
+            {'item': {'type': 'uri', 'value': uri + 'Q14911732'},
+             'p': {'type': 'uri', 'value': 'http://www.wikidata.org/prop/P594'},
+             'sid': {'type': 'uri', 'value': uri + 'statement/Q14911732-new'},
+             'v': {'type': 'literal', 'value': 'ENSG00000999999'}},
+            {'item': {'type': 'uri', 'value': uri + 'Q28548813'},
+             'p': {'type': 'uri', 'value': 'http://www.wikidata.org/prop/P594'},
+             'sid': {'type': 'uri', 'value': uri + 'statement/Q28548813-new'},
+             'v': {'type': 'literal', 'value': 'ENSG00000000001'}},
+        ]
+        return {'results': {'bindings': bindings}}
+
+
+class frc_fake_refresh(wdi_fastrun.FastRunContainer):
+    def __init__(self, *args, **kwargs):
+        super(frc_fake_refresh, self).__init__(*args, **kwargs)
+        self.prop_dt_map = {'P594': 'external-id'}
+        self.loaded_props = {'P594'}
+        self.data_timestamp = datetime.datetime(2017, 10, 18, 12, 0, 0)
+        for qid, value in [('Q14911732', 'ENSG00000123374'), ('Q21109414', 'ENSG00000000002'),
+                           ('Q18034149', 'ENSG00000000003')]:
+            self.prop_data[qid] = {'P594': {qid + '-old': {'qual': set(), 'ref': dict(), 'v': value, 'unit': '1'}}}
+            self.rev_lookup.add(value, qid)
+
+    def get_prop_datatypes(self, props):
+        return {prop_nr: self.prop_dt_map[prop_nr] for prop_nr in props}
+
+
+def test_refresh_from_recent_changes():
+    frc = frc_fake_refresh(base_filter={'P594': ''}, base_data_type=wdi_core.WDBaseDataType,
+                           engine=fake_engine_recent_changes)
+    refreshed = frc.refresh()
+
+    assert refreshed == {'Q14911732', 'Q28548813', 'Q21109414'}
+    assert len(fake_engine_recent_changes.queries) == 1
+    assert frc.data_timestamp > datetime.datetime(2017, 10, 18, 12, 0, 0)
+    # edited item
+    assert [d['v'] for d in frc.prop_data['Q14911732']['P594'].values()] == ['ENSG00000999999']
+    assert 'ENSG00000123374' not in frc.rev_lookup
+    assert frc.rev_lookup['ENSG00000999999'] == {'Q14911732'}
+    # new item
+    assert frc.rev_lookup['ENSG00000000001'] == {'Q28548813'}
+    # deleted (or no longer matching the base filter)
+    assert 'Q21109414' not in frc.prop_data
+    assert 'ENSG00000000002' not in frc.rev_lookup
+    # untouched
+    assert frc.rev_lookup['ENSG00000000003'] == {'Q18034149'}
+
+
+def test_compact_prop_data():
+    # rows as they come out of format_query_results for the refs query, one per qualifier x reference snak
+    rows = []
+    for pq, qval in [('P659', 'Q21067546'), ('P659', 'Q20966585')]:
+        for pr, rval in [('P248', 'Q29458763'), ('P594', 'ENSG00000123374')]:
+            rows.append({'item': 'Q14911732', 'sid': 'Q14911732-23F268EB-2848-4A82-A248-CF4DF6B256BC',
+                         'v': 'Q847102', 'pq': pq, 'qval': qval,
+                         'ref': '9d96507726508344ef1b8f59092fb350171b3d99', 'pr': pr, 'rval': rval})
+    expected = copy.deepcopy(wdi_fastrun.example_Q14911732)
+    expected['P1057']['Q14911732-23F268EB-2848-4A82-A248-CF4DF6B256BC']['unit'] = '1'
+
+    for compact in [False, True]:
+        frc = wdi_fastrun.FastRunContainer(base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                           compact=compact)
+        frc.update_frc_from_query(copy.deepcopy(rows), 'P1057')
+        assert 'Q14911732' in frc.prop_data
+        assert 'Q1' not in frc.prop_data
+        assert frc.prop_data['Q14911732'] == expected
+        assert list(frc.prop_data) == ['Q14911732']
+
+    assert 'memory=' in repr(frc.prop_data)
+    frc.remove_items(['Q14911732'])
+    assert 'Q14911732' not in frc.prop_data
+
+    # values that look like QIDs but don't fit in 32 bits
+    data = wdi_fastrun.CompactPropData()
+    for value in ['Q2147483647', 'Q2147483648', 'Q99999999999']:
+        data['Q1'] = {'P1': {'Q1-s': {'qual': set(), 'ref': dict(), 'v': value, 'unit': '1'}}}
+        assert data['Q1']['P1']['Q1-s']['v'] == value
+
+    # same answers as the default storage
+    frc = frc_fake_query_data_ensembl(base_filter={'P594': '', 'P703': 'Q15978631'},
+                                      base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                      use_refs=True, compact=True)
+    statements = [wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594')]
+    assert frc.write_required(data=statements)
+    statements = [wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594',
+                                        references=[[wdi_core.WDItemID("Q29458763", "P248", is_reference=True),
+                                                     wdi_core.WDExternalID("ENSG00000123374", "P594",
+                                                                           is_reference=True)]])]
+    assert not frc.write_required(data=statements)
+
+
+def standin_statements(n_statements):
+    uri = 'http://www.wikidata.org/entity/'
+    statements = [{'item': {'type': 'uri', 'value': uri + 'Q{}'.format(k)},
+                   'p': {'type': 'uri', 'value': 'http://www.wikidata.org/prop/P594'},
+                   'sid': {'type': 'uri', 'value': uri + 'statement/Q{}-{:08X}'.format(k, k * 7919 % 2 ** 32)},
+                   'v': {'type': 'literal', 'value': 'ENSG{:011d}'.format(k)}} for k in range(1, n_statements + 1)]
+    return sorted(statements, key=lambda x: x['sid']['value'])
+
+
+class fake_engine_sparql_standin(wdi_core.WDItemEngine):
+    """
+    Stands in for a sparql endpoint holding `n_statements` P594 statements, some with two qualifiers and a reference.
+    Only understands the paging of the fastrun queries.
+    """
+    n_statements = 25000
+    statements = standin_statements(n_statements)
+    queries = []
+
+    @staticmethod
+    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                             max_retries=1000, retry_after=60, use_cache=True, result_format='json',
+                             query_class='lookup'):
+        fake_engine_sparql_standin.queries.append(query)
+        last_sid = re.search(r'FILTER\(STR\(\?sid\) > "(.*?)"', query).group(1)
+        bindings = []
+        if 'prov:wasDerivedFrom' in query:
+            max_sid = re.search(r'STR\(\?sid\) <= "(.*?)"', query).group(1)
+            for x in fake_engine_sparql_standin.statements:
+                if last_sid < x['sid']['value'] <= max_sid and x['item']['value'].endswith('0'):
+                    for pr, rval in [('P248', 'Q29458763'), ('P594', x['v']['value'])]:
+                        bindings.append(dict(copy.deepcopy(x), ref={'type': 'uri', 'value': 'http://ref/r1'},
+                                             pr={'type': 'uri', 'value': 'http://www.wikidata.org/prop/reference/' + pr},
+                                             rval={'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + rval}
+                                             if rval.startswith('Q') else {'type': 'literal', 'value': rval}))
+                        del bindings[-1]['v']
+            return {'results': {'bindings': bindings}}
+        limit = int(re.search(r'LIMIT (\d+)', query).group(1))
+        page = [x for x in fake_engine_sparql_standin.statements if x['sid']['value'] > last_sid][:limit]
+        for x in page:
+            if x['item']['value'].endswith('0'):
+                for q in ['Q1', 'Q2']:
+                    bindings.append(dict(copy.deepcopy(x),
+                                         pq={'type': 'uri', 'value': 'http://www.wikidata.org/prop/qualifier/P642'},
+                                         qval={'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + q}))
+            else:
+                bindings.append(copy.deepcopy(x))
+        return {'results': {'bindings': bindings}}
+
+
+class frc_fake_datatypes(wdi_fastrun.FastRunContainer):
+    def get_prop_datatypes(self, props):
+        return {prop_nr: {'P594': 'external-id', 'P642': 'wikibase-item', 'P248': 'wikibase-item'}[prop_nr]
+                for prop_nr in props}
+
+
+def test_keyset_paging():
+    for use_refs in [False, True]:
+        fake_engine_sparql_standin.queries = []
+        frc = frc_fake_datatypes(base_filter={'P594': ''}, base_data_type=wdi_core.WDBaseDataType,
+                                 engine=fake_engine_sparql_standin, use_refs=use_refs)
+        frc.page_size = 3000
+        frc._query_data('P594')
+
+        assert len(frc.prop_data) == fake_engine_sparql_standin.n_statements
+        assert len(frc.rev_lookup) == fake_engine_sparql_standin.n_statements
+        assert frc.prop_data['Q10']['P594']['Q10-00013556']['qual'] == {('P642', 'Q1'), ('P642', 'Q2')}
+        # 9 pages, the last one is not full. With references, one more query per page
+        assert len(fake_engine_sparql_standin.queries) == 9 * (1 + use_refs)
+        if use_refs:
+            assert frc.prop_data['Q10']['P594']['Q10-00013556']['ref'] == {
+                'r1': {('P248', 'Q29458763'), ('P594', 'ENSG00000000010')}}
+            assert [d['ref'] for d in frc.prop_data['Q11']['P594'].values()] == [{}]
+        assert not any('OFFSET' in q for q in fake_engine_sparql_standin.queries)
+
+
+class fake_engine_sparql_multi_prop(wdi_core.WDItemEngine):
+    queries = []
+
+    @staticmethod
+    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                             max_retries=1000, retry_after=60, use_cache=True, result_format='json',
+                             query_class='lookup'):
+        fake_engine_sparql_multi_prop.queries.append(query)
+        uri = 'http://www.wikidata.org/entity/'
+        data = {'P594': [('Q14911732', 'ENSG00000123374')],
+                'P351': [('Q14911732', '1017')],
+                'P703': [('Q14911732', 'Q15978631'), ('Q21109414', 'Q15978631')]}
+        bindings = []
+        for prop_nr in re.findall(r'\(p:(P\d+) ps:P\d+ psv:P\d+\)', query):
+            for qid, value in data[prop_nr]:
+                bindings.append({'item': {'type': 'uri', 'value': uri + qid},
+                                 'p': {'type': 'uri', 'value': 'http://www.wikidata.org/prop/' + prop_nr},
+                                 'sid': {'type': 'uri', 'value': uri + 'statement/{}-{}'.format(qid, prop_nr)},
+                                 'v': {'type': 'uri', 'value': uri + value} if value.startswith('Q') else
+                                 {'type': 'literal', 'value': value}})
+        return {'results': {'bindings': bindings}}
+
+
+class frc_fake_multi_prop(wdi_fastrun.FastRunContainer):
+    def get_prop_datatypes(self, props):
+        return {prop_nr: {'P594': 'external-id', 'P351': 'external-id', 'P703': 'wikibase-item', 'P31': 'wikibase-item',
+                          'P279': 'wikibase-item'}[prop_nr]
+                for prop_nr in props}
+
+
+def test_prefetch():
+    fake_engine_sparql_multi_prop.queries = []
+    frc = frc_fake_multi_prop(base_filter={'P594': ''}, base_data_type=wdi_core.WDBaseDataType,
+                              engine=fake_engine_sparql_multi_prop)
+    assert frc.prefetch(['P703', 'P594', 'P351', 'P594']) == ['P351', 'P594', 'P703']
+    assert len(fake_engine_sparql_multi_prop.queries) == 1
+    assert 'VALUES (?p ?ps ?psv)' in fake_engine_sparql_multi_prop.queries[0]
+    assert frc.loaded_props == {'P351', 'P594', 'P703'}
+    assert set(frc.prop_data['Q14911732']) == {'P351', 'P594', 'P703'}
+    assert set(frc.prop_data['Q21109414']) == {'P703'}
+    assert frc.rev_lookup['Q15978631'] == {'Q14911732', 'Q21109414'}
+
+    # nothing left to load
+    assert frc.prefetch(['P594', 'P351']) == []
+    statements = [wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594'),
+                  wdi_core.WDExternalID(value='1017', prop_nr='P351'),
+                  wdi_core.WDItemID(value='Q15978631', prop_nr='P703')]
+    assert not frc.write_required(data=statements)
+    assert len(fake_engine_sparql_multi_prop.queries) == 1
+
+
+class fake_engine_wbgetentities(wdi_core.WDItemEngine):
+    calls = []
+
+    @staticmethod
+    def mediawiki_api_call(method, mediawiki_api_url=None, session=None, max_retries=1000, retry_after=60, **kwargs):
+        ids = kwargs['params']['ids'].split('|')
+        assert kwargs['params']['props'] == 'datatype'
+        assert len(ids) <= 50
+        fake_engine_wbgetentities.calls.append(ids)
+        # P9999 was deleted
+        return {'entities': {x: {'id': x, 'missing': ''} if x == 'P9999' else
+                             {'type': 'property', 'id': x, 'datatype': 'string'} for x in ids}}
+
+
+def test_batched_datatypes():
+    fake_engine_wbgetentities.calls = []
+    api_url = 'https://example.org/w/api.php'
+    wdi_fastrun.FastRunContainer.prop_datatype_cache.pop(api_url, None)
+    frc = wdi_fastrun.FastRunContainer(base_data_type=wdi_core.WDBaseDataType, engine=fake_engine_wbgetentities,
+                                       mediawiki_api_url=api_url)
+    props = ['P{}'.format(n) for n in range(1, 121)]
+    assert frc.get_prop_datatypes(props) == {p: 'string' for p in props}
+    assert len(fake_engine_wbgetentities.calls) == 3
+
+    # the datatypes are shared with other containers for the same wikibase
+    frc = wdi_fastrun.FastRunContainer(base_data_type=wdi_core.WDBaseDataType, engine=fake_engine_wbgetentities,
+                                       mediawiki_api_url=api_url)
+    assert frc.get_prop_datatype('P7') == 'string'
+    assert len(fake_engine_wbgetentities.calls) == 3
+    with pytest.raises(ValueError, match='P9999'):
+        frc.get_prop_datatypes(['P7', 'P9999'])
+
+    # all qualifier and reference properties of an item are looked up together
+    frc.prop_dt_map = {'P594': 'external-id'}
+    frc.prop_data['Q1'] = {'P594': {'Q1-1': {'v': 'ENSG00000123374', 'unit': '1',
+                                             'qual': {('P200', 'a'), ('P201', 'b')},
+                                             'ref': {'r1': {('P202', 'c'), ('P3', 'd')}}}}}
+    assert len(frc.reconstruct_statements('Q1')) == 1
+    assert fake_engine_wbgetentities.calls[4:] == [['P200', 'P201', 'P202']]
+
+
+class frc_fake_fingerprints(wdi_fastrun.FastRunContainer):
+    def __init__(self, *args, **kwargs):
+        super(frc_fake_fingerprints, self).__init__(*args, **kwargs)
+        self.prop_dt_map = {'P248': 'wikibase-item', 'P594': 'external-id', 'P703': 'wikibase-item',
+                            'P642': 'wikibase-item'}
+        self.prop_data['Q14911732'] = {
+            'P594': {'sid1': {'qual': set(), 'ref': {'r1': {('P248', 'Q29458763'), ('P594', 'ENSG00000123374')}},
+                              'v': 'ENSG00000123374'},
+                     'sid2': {'qual': {('P642', 'Q1')}, 'ref': dict(), 'v': 'ENSG00000123375'}},
+            'P703': {'sid3': {'qual': set(), 'ref': {'r1': {('P248', 'Q29458763')}}, 'v': 'Q15978631'}}}
+        self.rev_lookup = defaultdict(set, {'ENSG00000123374': {'Q14911732'}, 'ENSG00000123375': {'Q14911732'},
+                                            'Q15978631': {'Q14911732'}})
+
+
+def test_fingerprint_write_required():
+    ref = [wdi_core.WDItemID('Q29458763', 'P248', is_reference=True),
+           wdi_core.WDExternalID('ENSG00000123374', 'P594', is_reference=True)]
+    statements = [
+        wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594', references=[ref]),
+        wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594'),
+        wdi_core.WDExternalID(value='ENSG00000123375', prop_nr='P594',
+                              qualifiers=[wdi_core.WDItemID('Q1', 'P642', is_qualifier=True)]),
+        wdi_core.WDExternalID(value='ENSG00000123375', prop_nr='P594',
+                              qualifiers=[wdi_core.WDItemID('Q2', 'P642', is_qualifier=True)]),
+        wdi_core.WDExternalID(value='ENSG00000123375', prop_nr='P594', check_qualifier_equality=False),
+        wdi_core.WDItemID(value='Q15978631', prop_nr='P703', references=[ref[:1]]),
+        wdi_core.WDItemID(value='Q15978631', prop_nr='P703'),
+        wdi_core.WDBaseDataType.delete_statement('P703'),
+    ]
+    # every ordered selection of up to three statements gives the same answer as comparing the statement objects
+    cases = [[]]
+    for _ in range(3):
+        cases += [case + [x] for case in cases if len(case) == len(cases[-1]) for x in statements if x not in case]
+    n_no_write = 0
+    for use_refs in [False, True]:
+        frc = frc_fake_fingerprints(base_data_type=wdi_core.WDBaseDataType, engine=wdi_core.WDItemEngine,
+                                    use_refs=use_refs)
+        for case in cases[1:]:
+            for append_props in [None, ['P703']]:
+                expected = frc.write_required(case, append_props=append_props, cqid='Q14911732')
+                frc.load_item(case, cqid='Q14911732')
+                assert frc._write_required_statements(case, append_props or [], {
+                    x.get_prop_nr() for x in case if x.value and x.data_type}) == expected
+                n_no_write += not expected
+    assert n_no_write
+    assert list(frc._fingerprints) == ['Q14911732']
+    frc.remove_items(['Q14911732'])
+    assert frc._fingerprints == {}
+
+
+class fake_engine_sparql_subset(wdi_core.WDItemEngine):
+    """
+    Stands in for a sparql endpoint with 1000 items with a P594 and a P703 statement.
+    Only answers queries for items listed in a VALUES block.
+    """
+    queries = []
+
+    @staticmethod
+    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                             max_retries=1000, retry_after=60, use_cache=True, result_format='json',
+                             query_class='lookup'):
+        fake_engine_sparql_subset.queries.append(query)
+        uri = 'http://www.wikidata.org/entity/'
+        qids = re.search(r'VALUES \?item \{(.*?)\}', query).group(1).replace('wd:', '').split()
+        assert all(1 <= int(qid[1:]) <= 1000 for qid in qids)
+        bindings = []
+        if '?label' in query:
+            return {'results': {'bindings': [{'item': {'type': 'uri', 'value': uri + qid},
+                                              'label': {'type': 'literal', 'value': 'gene ' + qid}}
+                                             for qid in qids]}}
+        for prop_nr in re.findall(r'\(p:(P\d+) ps:P\d+ psv:P\d+\)', query):
+            if prop_nr not in {'P594', 'P703'}:
+                continue
+            for qid in qids:
+                v = {'type': 'literal', 'value': 'ENSG{:011d}'.format(int(qid[1:]))} if prop_nr == 'P594' else \
+                    {'type': 'uri', 'value': uri + 'Q15978631'}
+                bindings.append({'item': {'type': 'uri', 'value': uri + qid},
+                                 'p': {'type': 'uri', 'value': 'http://www.wikidata.org/prop/' + prop_nr},
+                                 'sid': {'type': 'uri', 'value': uri + 'statement/{}-{}'.format(qid, prop_nr)},
+                                 'v': v})
+        return {'results': {'bindings': bindings}}
+
+
+def test_subset_loading():
+    fake_engine_sparql_subset.queries = []
+    frc = frc_fake_multi_prop(base_filter={'P594': ''}, base_data_type=wdi_core.WDBaseDataType,
+                              engine=fake_engine_sparql_subset, qids=['Q{}'.format(n) for n in range(1, 301)])
+    statements = [wdi_core.WDExternalID(value='ENSG00000000007', prop_nr='P594'),
+                  wdi_core.WDItemID(value='Q15978631', prop_nr='P703')]
+    assert not frc.write_required(data=statements)
+    assert frc.current_qid == 'Q7'
+    # both properties in one query per chunk of 200 items
+    assert len(fake_engine_sparql_subset.queries) == 2
+    assert frc.loaded_props == set()
+    assert len(frc.prop_data) == 300
+    assert frc.is_loaded('P594', 'Q300') and not frc.is_loaded('P594', 'Q301')
+
+    # items outside the targets are loaded when they are compared, including the properties to delete
+    statements = [wdi_core.WDExternalID(value='ENSG00000000500', prop_nr='P594'),
+                  wdi_core.WDBaseDataType.delete_statement('P351')]
+    assert not frc.write_required(data=statements, cqid='Q500')
+    # P351 for all 301 items, P594 and P703 for Q500
+    assert len(fake_engine_sparql_subset.queries) == 5
+    assert frc.is_loaded('P351', 'Q7') and frc.is_loaded('P703', 'Q500')
+    assert frc.write_required(data=[wdi_core.WDExternalID(value='ENSG00000000500', prop_nr='P594')], cqid='Q501')
+    assert frc.is_loaded('P351', 'Q501')
+
+    # properties prefetched for the targets, e.g. by init_fastrun with a generator, are not loaded again
+    n_queries = len(fake_engine_sparql_subset.queries)
+    assert frc.prefetch(x for x in ['P31', 'P279']) == ['P279', 'P31']
+    assert frc._target_props >= {'P31', 'P279'}
+    assert len(fake_engine_sparql_subset.queries) == n_queries + 2
+    frc.load_item([wdi_core.WDItemID(value='Q7187', prop_nr='P31'), wdi_core.WDItemID(value='Q8054', prop_nr='P279')],
+                  cqid='Q7')
+    assert len(fake_engine_sparql_subset.queries) == n_queries + 2
+
+    # comparing a target whose properties are loaded doesn't check all targets again
+    checked = []
+    is_loaded = frc.is_loaded
+    frc.is_loaded = lambda prop_nr, qid: checked.append(qid) or is_loaded(prop_nr, qid)
+    n_queries = len(fake_engine_sparql_subset.queries)
+    for n in range(1, 301):
+        frc.load_item(statements, cqid='Q{}'.format(n))
+    assert checked == [] and len(fake_engine_sparql_subset.queries) == n_queries
+    del frc.is_loaded
+
+    # labels are only loaded for the targets too
+    assert frc.get_language_data('Q7', 'en', 'label') == {'gene Q7'}
+    assert frc.get_language_data('Q900', 'en', 'label') == {'gene Q900'}
+    assert len(frc.loaded_langs['en']['label']) == 303
+
+    # reloading an item doesn't make the container forget it was loaded
+    n_queries = len(fake_engine_sparql_subset.queries)
+    frc.reload_items(['Q500'])
+    assert frc.is_loaded('P594', 'Q500') and 'Q500' in frc.prop_data
+    assert len(fake_engine_sparql_subset.queries) == n_queries + 2
+
+
+class fake_engine_streaming(fake_engine_sparql_subset):
+    @staticmethod
+    def execute_sparql_query_iter(query, endpoint=None, **kwargs):
+        return fake_engine_sparql_subset.execute_sparql_query(query, endpoint=endpoint)['results']['bindings']
+
+
+def test_engine_overrides():
+    # the results are streamed, unless the engine only overrides execute_sparql_query
+    for engine, streams in [(wdi_core.WDItemEngine, True), (fake_engine_sparql_subset, False),
+                            (fake_engine_streaming, True)]:
+        frc = wdi_fastrun.FastRunContainer(base_data_type=wdi_core.WDBaseDataType, engine=engine)
+        assert frc._streams_results() == streams
+
+
+def test_reverse_index():
+    rev_lookup = wdi_fastrun.ReverseIndex()
+    for n in range(1000, 0, -1):
+        rev_lookup.add('Q5', 'Q{}'.format(n))
+        rev_lookup.add('ENSG{:011d}'.format(n), 'Q{}'.format(n))
+    rev_lookup.add('Q5', 'L7-F1')
+    rev_lookup.add('Q5', 'Q7')
+    rev_lookup.add('female', 'Q7')
+    rev_lookup.add('female', 'L7-F1')
+    assert len(rev_lookup) == 1002
+    assert rev_lookup.count('Q5') == 1001
+    assert rev_lookup.contains('Q5', 'L7-F1') and not rev_lookup.contains('Q5', 'Q1001')
+    assert rev_lookup.intersect(['Q5', 'ENSG00000000007', 'female']) == {'Q7'}
+    assert rev_lookup.intersect(['Q5', 'female']) == {'Q7', 'L7-F1'}
+    assert rev_lookup.intersect(['Q5', 'male']) == set()
+    rev_lookup.discard('Q5', 'Q7')
+    rev_lookup.discard('female', 'L7-F1')
+    assert rev_lookup['female'] == {'Q7'}
+    assert rev_lookup.intersect(['Q5', 'female']) == set()
+    rev_lookup.discard('female', 'Q7')
+    assert 'female' not in rev_lookup
+
+
+def test_unindexed_props():
+    fake_engine_sparql_multi_prop.queries = []
+    frc = frc_fake_multi_prop(base_filter={'P594': ''}, base_data_type=wdi_core.WDBaseDataType,
+                              engine=fake_engine_sparql_multi_prop, unindexed_props=['P703'])
+    frc.prefetch(['P594', 'P703'])
+    assert 'Q15978631' not in frc.rev_lookup
+    statements = [wdi_core.WDExternalID(value='ENSG00000123374', prop_nr='P594'),
+                  wdi_core.WDItemID(value='Q15978631', prop_nr='P703')]
+    assert not frc.write_required(data=statements)
+    assert frc.current_qid == 'Q14911732'
+    # still compared
+    statements[1] = wdi_core.WDItemID(value='Q5', prop_nr='P703')
+    assert frc.write_required(data=statements)
+    # nothing to identify the item with
+    frc.current_qid = ''
+    assert frc.load_item(statements[1:])
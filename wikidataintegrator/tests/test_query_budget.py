@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+
+from wikidataintegrator import wdi_core, wdi_query_budget, wdi_transport
+from wikidataintegrator.wdi_query_budget import QueryBudget
+
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.starts = []
+
+    def query(self, duration):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.starts.append(time.time())
+        time.sleep(duration)
+        with self.lock:
+            self.running -= 1
+
+
+def test_budget():
+    # one second of query time per second, that 20 queries of 0.1s running 4 at a time would use up in half a second
+    budget = QueryBudget(query_time=1, window=1, max_concurrent=4)
+    counter = Counter()
+    start = time.time()
+    threads = [threading.Thread(target=lambda: [budget.call(counter.query, 0.1) for _ in range(5)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    assert counter.max_running <= 4
+    assert budget.queries == 20
+    assert 1.9 <= budget.time_used < 2.5
+    # the first second comes from the full bucket, the rest at the refill rate
+    assert elapsed >= 0.9
+    # spread out: the second half of the queries didn't start at once
+    late = sorted(counter.starts)[10:]
+    assert late[-1] - late[0] >= 0.3
+
+    # a throttled endpoint pauses all queries
+    budget.throttle(0.3)
+    start = time.time()
+    budget.call(counter.query, 0)
+    assert time.time() - start >= 0.29
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'head': {'vars': []}, 'results': {'bindings': []}}
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            return FakeResponse(429, headers={'retry-after': '0'})
+        return FakeResponse(200)
+
+
+def test_sparql_query_budget():
+    endpoint = 'https://query.example.org/sparql'
+    budget = QueryBudget(query_time=60, window=60, max_concurrent=5)
+    wdi_query_budget.set_budget(endpoint, budget)
+    wdi_transport.set_transport(FakeTransport())
+    try:
+        before = time.time()
+        wdi_core.WDItemEngine.execute_sparql_query('SELECT * WHERE { ?s ?p ?o }', endpoint=endpoint)
+        # the 429 was recorded and both requests were counted
+        assert budget.blocked_until >= before
+        assert budget.queries == 2
+        assert wdi_query_budget.get_budget(endpoint) is budget
+    finally:
+        wdi_transport.set_transport(None)
+        wdi_query_budget.set_budget(endpoint, None)
+    # without a budget set for it, an endpoint has none by default
+    assert wdi_query_budget.get_budget(endpoint) is None
@@ -0,0 +1,117 @@
+import re
+
+import pytest
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_core import ManualInterventionReqException
+from wikidataintegrator.wdi_engine_context import EngineContext
+
+ENTITY = 'http://www.wikidata.org/entity/'
+EXACT = ENTITY + 'Q39893449'
+CLOSE = ENTITY + 'Q39893184'
+
+# (property, value term) to the items having the value, with the mapping relation type of the statement
+ITEMS = {
+    ('P352', "'P12345'"): [('Q1', None)],
+    ('P594', "'ENSG1'"): [('Q1', EXACT), ('Q2', CLOSE)],
+    ('P703', 'wd:Q15978631'): [('Q1', None), ('Q7', None), ('Q8', None)],
+    ('P352', "'P99999'"): [('Q3', None), ('Q4', None)],
+    ('P594', "'ENSG2'"): [('Q2', None)],
+    ('P351', "'1017'"): [('Q1', None)],
+}
+
+
+class WDDirectExternalID(wdi_core.WDExternalID):
+    # a datatype whose query has another form
+    sparql_query = '''
+        SELECT * WHERE {{
+          ?item_id <{wb_url}/prop/direct/{pid}> '{value}' .
+        }}
+    '''
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    queries = []
+
+    def execute_sparql_query(query, endpoint=None, **kwargs):
+        # the items are looked up on the query service, never in the result cache
+        assert kwargs['use_cache'] is False
+        queries.append(query)
+        rows = re.findall(r"\((\d+) p:(\w+) ps:\w+ (.+?)\)", query)
+        if not rows:
+            # a single value query
+            m = re.search(r"prop/direct/(\w+)> ('.*') \.", query)
+            rows = [('0', m.group(1), m.group(2))]
+        bindings = []
+        for row, pid, term in rows:
+            for qid, mrt in ITEMS.get((pid, term), []):
+                binding = {'row': {'type': 'literal', 'value': row}, 'item_id': {'type': 'uri', 'value': ENTITY + qid}}
+                if mrt:
+                    binding['mrt'] = {'type': 'uri', 'value': mrt}
+                bindings.append(binding)
+        return {'head': {'vars': ['row', 'item_id', 'mrt']}, 'results': {'bindings': bindings}}
+
+    def mediawiki_api_call(method, mediawiki_api_url=None, session=None, max_retries=1000, retry_after=60, **kwargs):
+        qid = kwargs['params']['ids']
+        return {'entities': {qid: {'id': qid, 'claims': {}}}}
+
+    monkeypatch.setattr(wdi_core.WDItemEngine, 'execute_sparql_query', staticmethod(execute_sparql_query))
+    monkeypatch.setattr(wdi_core.WDItemEngine, 'mediawiki_api_call', staticmethod(mediawiki_api_call))
+    return queries
+
+
+def engine(data, **kwargs):
+    return wdi_core.WDItemEngine(data=data, core_props={'P352', 'P594', 'P703', 'P351'}, search_only=True, **kwargs)
+
+
+def test_one_query(queries):
+    data = [wdi_core.WDExternalID('P12345', 'P352'), wdi_core.WDExternalID('ENSG1', 'P594'),
+            wdi_core.WDItemID('Q15978631', 'P703'), wdi_core.WDString('not a core prop', 'P1476')]
+    # P1476 is not a core prop, so its value isn't looked up. The close match of ENSG1 on Q2 is left out
+    item = engine(data[:2] + data[3:])
+    assert item.wd_item_id == 'Q1'
+    assert len(queries) == 1
+    assert "VALUES (?row ?p ?ps ?value) { (0 p:P352 ps:P352 'P12345') (1 p:P594 ps:P594 'ENSG1') }" in queries[0]
+
+    with pytest.raises(ManualInterventionReqException) as e:
+        engine(data)
+    assert 'Property: P703' in str(e.value)
+
+
+def test_conflicts(queries):
+    # one value on several items
+    with pytest.raises(ManualInterventionReqException) as e:
+        engine([wdi_core.WDExternalID('P12345', 'P352'), wdi_core.WDExternalID('P99999', 'P352')])
+    assert "Property: P352" in str(e.value) and 'Q3' in str(e.value)
+
+    # values on different items
+    with pytest.raises(ManualInterventionReqException) as e:
+        engine([wdi_core.WDExternalID('P12345', 'P352'), wdi_core.WDExternalID('ENSG2', 'P594')])
+    assert "{'P352': [{'Q1'}], 'P594': [{'Q2'}]}" in str(e.value)
+    assert len(queries) == 2
+
+    # no item has the value
+    item = engine([wdi_core.WDExternalID('P00000', 'P352')])
+    assert item.create_new_item and item.wd_item_id == ''
+
+
+def test_core_prop_index(queries):
+    context = EngineContext(core_prop_index={'P352': {'P12345': 'Q1', 'P99999': {'Q3'}}})
+    item = engine([wdi_core.WDExternalID('P12345', 'P352'), wdi_core.WDExternalID('ENSG1', 'P594')], context=context)
+    assert item.wd_item_id == 'Q1'
+    assert "(0 p:P594 ps:P594 'ENSG1')" in queries[0] and 'P352' not in queries[0]
+
+    # all values are in the index
+    item = engine([wdi_core.WDExternalID('P99999', 'P352')], context=context)
+    assert item.wd_item_id == 'Q3'
+    item = engine([wdi_core.WDExternalID('P00000', 'P352')], context=context)
+    assert item.create_new_item
+    assert len(queries) == 1
+
+
+def test_other_query_form(queries):
+    item = engine([WDDirectExternalID('1017', 'P351'), wdi_core.WDExternalID('P12345', 'P352')])
+    assert item.wd_item_id == 'Q1'
+    assert len(queries) == 2
+    assert "prop/direct/P351> '1017'" in queries[0]
@@ -0,0 +1,216 @@
+import json
+import os
+import time
+
+import pytest
+
+from wikidataintegrator import wdi_core, wdi_helpers, wdi_sparql_cache, wdi_transport
+
+ENDPOINT = 'https://query.example.org/sparql'
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, results):
+        self.results = results
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.results
+
+    def iter_content(self, chunk_size=1):
+        data = json.dumps(self.results).encode('utf-8')
+        return (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    """
+    Answers a sparql query with one binding holding the query, and dateModified queries with `date_modified`
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.date_modified = '2020-01-01T00:00:00Z'
+
+    def post(self, url, data=None, **kwargs):
+        query = data['query']
+        self.queries.append(query)
+        if 'schema:dateModified' in query:
+            return FakeResponse({'head': {'vars': ['d']},
+                                 'results': {'bindings': [{'d': {'type': 'literal', 'value': self.date_modified}}]}})
+        return FakeResponse({'head': {'vars': ['q']},
+                             'results': {'bindings': [{'q': {'type': 'literal', 'value': query}}]}})
+
+
+@pytest.fixture
+def transport():
+    transport = FakeTransport()
+    wdi_transport.set_transport(transport)
+    yield transport
+    wdi_transport.set_transport(None)
+    wdi_sparql_cache.set_cache(None)
+
+
+def query(q, **kwargs):
+    return wdi_core.WDItemEngine.execute_sparql_query(q, endpoint=ENDPOINT, **kwargs)
+
+
+def test_cache_hit(transport, tmpdir):
+    # no cache configured
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    assert len(transport.queries) == 2
+
+    cache = wdi_sparql_cache.SparqlResultCache(str(tmpdir), ttl=60)
+    wdi_sparql_cache.set_cache(cache)
+    r1 = query('SELECT ?s WHERE { ?s ?p ?o }')
+    # formatted differently, same query
+    r2 = query('\n  SELECT ?s WHERE { ?s ?p ?o }  \n\n')
+    assert r1 == r2
+    assert len(transport.queries) == 3
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # different query, different endpoint, or cache not used
+    query('SELECT ?s WHERE { ?s ?p "a  b" }')
+    query('SELECT ?s WHERE { ?s ?p "a b" }')
+    wdi_core.WDItemEngine.execute_sparql_query('SELECT ?s WHERE { ?s ?p ?o }', endpoint=ENDPOINT + '2')
+    query('SELECT ?s WHERE { ?s ?p ?o }', use_cache=False)
+    assert len(transport.queries) == 7
+
+    df = query('SELECT ?s WHERE { ?s ?p ?o }', as_dataframe=True)
+    assert list(df.columns) == ['q']
+    assert len(transport.queries) == 7
+
+    cache.clear()
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    assert len(transport.queries) == 8
+
+
+def test_cache_ttl(transport, tmpdir):
+    cache = wdi_sparql_cache.SparqlResultCache(str(tmpdir), ttl=60)
+    wdi_sparql_cache.set_cache(cache)
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    assert len(transport.queries) == 1
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    assert len(transport.queries) == 2
+
+    # None is no expiry, not the default from the config
+    assert wdi_sparql_cache.SparqlResultCache(str(tmpdir)).ttl == wdi_sparql_cache.config['SPARQL_CACHE_TTL']
+    assert wdi_sparql_cache.SparqlResultCache(str(tmpdir), ttl=None).ttl is None
+    assert wdi_sparql_cache.SparqlResultCache(str(tmpdir), max_size=None, validate=None).max_size is None
+
+
+def test_cache_validate(transport, tmpdir):
+    cache = wdi_sparql_cache.SparqlResultCache(str(tmpdir), validate=0)
+    wdi_sparql_cache.set_cache(cache)
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    # one dateModified lookup, remembered for a while
+    assert len(transport.queries) == 2
+
+    # the endpoint was updated
+    transport.date_modified = '2020-01-01T00:00:10Z'
+    cache._date_modified.clear()
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    assert len(transport.queries) == 4
+
+    # updates within the tolerance don't invalidate
+    cache.validate = 60
+    transport.date_modified = '2020-01-01T00:00:30Z'
+    cache._date_modified.clear()
+    query('SELECT ?s WHERE { ?s ?p ?o }')
+    assert len(transport.queries) == 5
+
+
+def test_cache_eviction(transport, tmpdir):
+    cache = wdi_sparql_cache.SparqlResultCache(str(tmpdir), max_size=10 ** 6)
+    wdi_sparql_cache.set_cache(cache)
+    for i in range(5):
+        query('SELECT ?s WHERE {{ ?s ?p {} }}'.format(i))
+        os.utime(cache._path(cache.key('SELECT ?s WHERE {{ ?s ?p {} }}'.format(i), ENDPOINT)), (i, i))
+    # entries are stored compressed
+    assert all(name.endswith('.json.gz') for name in os.listdir(str(tmpdir)))
+    entry_size = cache.size() // 5
+
+    # use the oldest, then shrink the cache to three entries
+    query('SELECT ?s WHERE { ?s ?p 0 }')
+    cache.max_size = entry_size * 3 + entry_size // 2
+    cache.evict()
+    assert len(os.listdir(str(tmpdir))) == 3
+
+    n = len(transport.queries)
+    for i in (0, 3, 4):
+        query('SELECT ?s WHERE {{ ?s ?p {} }}'.format(i))
+    assert len(transport.queries) == n
+    query('SELECT ?s WHERE { ?s ?p 1 }')
+    assert len(transport.queries) == n + 1
+
+
+def test_cache_size_counter(transport, tmpdir, monkeypatch):
+    cache = wdi_sparql_cache.SparqlResultCache(str(tmpdir), max_size=10 ** 6)
+    wdi_sparql_cache.set_cache(cache)
+    listed = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, '_entries', lambda: listed.append(1) or entries())
+
+    # the directory is listed for the first entry only
+    for i in range(20):
+        query('SELECT ?s WHERE {{ ?s ?p {} }}'.format(i))
+    assert len(listed) == 1
+    assert cache._size == sum(os.path.getsize(os.path.join(str(tmpdir), x)) for x in os.listdir(str(tmpdir)))
+
+    # storing an entry again doesn't count it twice
+    query('SELECT ?s WHERE { ?s ?p 0 }', use_cache=False)
+    size = cache._size
+    cache.put('SELECT ?s WHERE { ?s ?p 0 }', ENDPOINT, {'head': {'vars': []}, 'results': {'bindings': []}})
+    assert cache._size < size
+
+    # going over the limit
+    cache.max_size = cache._size
+    query('SELECT ?s WHERE { ?s ?p 20 }')
+    assert len(listed) == 2 and cache._size <= cache.max_size
+    assert len(os.listdir(str(tmpdir))) < 21
+
+    # other processes may add entries too
+    cache.max_size = 10 ** 6
+    cache.evict_interval = 5
+    for i in range(21, 26):
+        query('SELECT ?s WHERE {{ ?s ?p {} }}'.format(i))
+    assert len(listed) == 3
+
+
+def test_streamed_results(transport, tmpdir):
+    cache = wdi_sparql_cache.SparqlResultCache(str(tmpdir))
+    wdi_sparql_cache.set_cache(cache)
+    uri = 'http://www.wikidata.org/entity/'
+    bindings = [{'id': {'type': 'literal', 'value': str(i)}, 'item': {'type': 'uri', 'value': uri + 'Q{}'.format(i)}}
+                for i in range(1, 4)]
+
+    def post(url, data=None, **kwargs):
+        transport.queries.append(data['query'])
+        return FakeResponse({'head': {'vars': ['id', 'item', 'mrt']}, 'results': {'bindings': bindings}})
+
+    transport.post = post
+    # the second pull is served from the cache
+    for _ in range(2):
+        assert wdi_helpers.id_mapper('P698', endpoint=ENDPOINT) == {'1': 'Q1', '2': 'Q2', '3': 'Q3'}
+    assert len(transport.queries) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # results that were not all read are not stored
+    query = 'SELECT ?id ?item WHERE { ?item wdt:P351 ?id }'
+    next(iter(wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=ENDPOINT)))
+    assert cache.get(query, ENDPOINT) is None
+    list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=ENDPOINT))
+    assert cache.get(query, ENDPOINT)['head']['vars'] == ['id', 'item']
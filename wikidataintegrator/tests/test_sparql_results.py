@@ -0,0 +1,294 @@
+import csv
+import datetime
+import io
+import json
+import time
+
+import pandas as pd
+import pytest
+
+from wikidataintegrator import wdi_core, wdi_transport
+from wikidataintegrator.wdi_sparql_results import XSD, iter_csv_bindings, iter_json_bindings, iter_tsv_bindings, \
+    parse_term, results_to_df
+
+RESULTS = {
+    'head': {'vars': ['item', 'bindings', 'n']},
+    'results': {'bindings': [
+        {'item': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q{}'.format(i)},
+         'bindings': {'type': 'literal', 'value': 'Zürich ]}, "bindings": [ ☃ ' + str(i), 'xml:lang': 'de'},
+         'n': {'type': 'literal', 'value': str(i), 'datatype': 'http://www.w3.org/2001/XMLSchema#integer'}}
+        for i in range(25)
+    ]}
+}
+
+
+def chunks_of(data, size):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def to_term(binding):
+    # write a term the way the query service does in tsv results
+    if binding['type'] == 'uri':
+        return '<{}>'.format(binding['value'])
+    if binding['type'] == 'bnode':
+        return '_:' + binding['value']
+    if binding.get('datatype') == XSD + 'integer':
+        return binding['value']
+    value = binding['value']
+    for c, e in (('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n'), ('\r', '\\r'), ('\t', '\\t')):
+        value = value.replace(c, e)
+    if 'xml:lang' in binding:
+        return '"{}"@{}'.format(value, binding['xml:lang'])
+    if 'datatype' in binding:
+        return '"{}"^^<{}>'.format(value, binding['datatype'])
+    return '"{}"'.format(value)
+
+
+def to_tsv(results):
+    variables = results['head']['vars']
+    lines = ['\t'.join('?' + v for v in variables)]
+    for binding in results['results']['bindings']:
+        lines.append('\t'.join(to_term(binding[v]) if v in binding else '' for v in variables))
+    return '\n'.join(lines) + '\n'
+
+
+def to_csv(results):
+    variables = results['head']['vars']
+    f = io.StringIO()
+    writer = csv.writer(f, lineterminator='\r\n')
+    writer.writerow(variables)
+    for binding in results['results']['bindings']:
+        writer.writerow([binding[v]['value'] if v in binding else '' for v in variables])
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_iter_json_bindings(indent):
+    data = json.dumps(RESULTS, indent=indent, ensure_ascii=False).encode('utf-8')
+    # split within multi-byte characters, strings, keys and between bindings
+    for size in (1, 2, 3, 7, 64, len(data)):
+        assert list(iter_json_bindings(chunks_of(data, size))) == RESULTS['results']['bindings']
+
+    empty = json.dumps({'head': {'vars': []}, 'results': {'bindings': []}}).encode()
+    assert list(iter_json_bindings([empty])) == []
+
+    with pytest.raises(ValueError):
+        list(iter_json_bindings(chunks_of(data[:len(data) // 2], 10)))
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.data)
+
+    def iter_content(self, chunk_size=1):
+        return chunks_of(self.data, 10)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def post(self, url, data=None, headers=None, stream=False, **kwargs):
+        self.requests.append((data, headers))
+        if headers['Accept'] == 'text/tab-separated-values':
+            self.responses.append(FakeResponse(to_tsv(RESULTS).encode('utf-8')))
+        elif headers['Accept'] == 'text/csv':
+            self.responses.append(FakeResponse(to_csv(RESULTS).encode('utf-8')))
+        else:
+            self.responses.append(FakeResponse(json.dumps(RESULTS).encode('utf-8')))
+        return self.responses[-1]
+
+
+def test_execute_sparql_query_iter():
+    transport = FakeTransport()
+    wdi_transport.set_transport(transport)
+    try:
+        query = 'SELECT ?item ?bindings ?n WHERE { ?item ?bindings ?n }'
+        bindings = wdi_core.WDItemEngine.execute_sparql_query_iter(query)
+        assert next(bindings) == RESULTS['results']['bindings'][0]
+        assert list(bindings) == RESULTS['results']['bindings'][1:]
+        assert transport.responses[0].closed
+
+        dfs = list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, as_dataframe=True, chunk_size=10))
+        assert [len(df) for df in dfs] == [10, 10, 5]
+        df = wdi_core.WDItemEngine.execute_sparql_query(query, as_dataframe=True)
+        assert dfs[2].reset_index(drop=True).equals(df[20:].reset_index(drop=True))
+    finally:
+        wdi_transport.set_transport(None)
+
+
+def test_parse_term():
+    assert parse_term('<http://www.wikidata.org/entity/Q42>') == {
+        'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q42'}
+    assert parse_term('"Douglas Adams"@en') == {'type': 'literal', 'value': 'Douglas Adams', 'xml:lang': 'en'}
+    assert parse_term('"a\\tb \\"c\\" \\\\ \\u00e9\\U0001F600"') == {
+        'type': 'literal', 'value': 'a\tb "c" \\ \u00e9\U0001F600'}
+    assert parse_term('"+1.50"^^<http://www.w3.org/2001/XMLSchema#decimal>') == {
+        'type': 'literal', 'value': '+1.50', 'datatype': XSD + 'decimal'}
+    assert parse_term('-3') == {'type': 'literal', 'value': '-3', 'datatype': XSD + 'integer'}
+    assert parse_term('1.5') == {'type': 'literal', 'value': '1.5', 'datatype': XSD + 'decimal'}
+    assert parse_term('1.5E3') == {'type': 'literal', 'value': '1.5E3', 'datatype': XSD + 'double'}
+    assert parse_term('true') == {'type': 'literal', 'value': 'true', 'datatype': XSD + 'boolean'}
+    assert parse_term('_:b0') == {'type': 'bnode', 'value': 'b0'}
+
+
+def test_tsv_csv():
+    data = to_tsv(RESULTS).encode('utf-8')
+    head = dict()
+    for size in (1, 3, 64, len(data)):
+        assert list(iter_tsv_bindings(chunks_of(data, size), head=head)) == RESULTS['results']['bindings']
+        assert head['vars'] == RESULTS['head']['vars']
+
+    data = 'a,b\r\n"x, ""y""\nz",\r\n,2\r\n'.encode('utf-8')
+    assert list(iter_csv_bindings(chunks_of(data, 3))) == [{'a': {'value': 'x, "y"\nz'}}, {'b': {'value': '2'}}]
+
+    transport = FakeTransport()
+    wdi_transport.set_transport(transport)
+    try:
+        query = 'SELECT ?item ?bindings ?n WHERE { ?item ?bindings ?n }'
+        assert wdi_core.WDItemEngine.execute_sparql_query(query, result_format='tsv') == RESULTS
+        assert 'format' not in transport.requests[-1][0]
+        assert list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, result_format='tsv')) == \
+            RESULTS['results']['bindings']
+        with pytest.raises(ValueError):
+            wdi_core.WDItemEngine.execute_sparql_query(query, result_format='xml')
+
+        # csv results only have the values, as strings
+        df = wdi_core.WDItemEngine.execute_sparql_query(query, result_format='csv', as_dataframe=True)
+        assert list(df.columns) == ['item', 'bindings', 'n']
+        assert df['n'].tolist() == [str(i) for i in range(25)]
+        assert df['bindings'][3] == RESULTS['results']['bindings'][3]['bindings']['value']
+        chunks = list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, result_format='csv', as_dataframe=True,
+                                                                      chunk_size=10))
+        assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    finally:
+        wdi_transport.set_transport(None)
+
+
+def recorded_results(n):
+    """
+    Results shaped like those of the fastrun statement query, with qualifiers on every other statement
+    """
+    uri = 'http://www.wikidata.org/entity/'
+    bindings = []
+    for i in range(n):
+        binding = {
+            'item': {'type': 'uri', 'value': uri + 'Q{}'.format(1000000 + i // 3)},
+            'p': {'type': 'uri', 'value': 'http://www.wikidata.org/prop/P{}'.format(i % 7 + 31)},
+            'sid': {'type': 'uri', 'value': uri + 'statement/Q{}-{:08x}-4c2d-8b2e-{:012x}'.format(
+                1000000 + i // 3, i * 7919, i * 104729)},
+            'v': [{'type': 'uri', 'value': uri + 'Q{}'.format(i % 5000)},
+                  {'type': 'literal', 'value': 'ENSG{:011d}'.format(i)},
+                  {'type': 'literal', 'value': '{}.5'.format(i), 'datatype': XSD + 'decimal'},
+                  {'type': 'literal', 'value': 'Über "{}"'.format(i), 'xml:lang': 'de'}][i % 4]
+        }
+        if i % 2:
+            binding['pq'] = {'type': 'uri', 'value': 'http://www.wikidata.org/prop/qualifier/P580'}
+            binding['qval'] = {'type': 'literal', 'value': '2018-0{}-01T00:00:00Z'.format(i % 9 + 1),
+                               'datatype': XSD + 'dateTime'}
+        bindings.append(binding)
+    return {'head': {'vars': ['item', 'p', 'qval', 'pq', 'sid', 'v', 'unit']}, 'results': {'bindings': bindings}}
+
+
+FORMATS = (('json', lambda chunks: json.loads(b''.join(chunks))['results']['bindings']),
+           ('json stream', iter_json_bindings),
+           ('tsv', iter_tsv_bindings))
+
+
+def test_formats():
+    results = recorded_results(100000)
+    json_data = json.dumps(results).encode('utf-8')
+    tsv_data = to_tsv(results).encode('utf-8')
+    assert len(tsv_data) < len(json_data) * 0.7
+
+    for name, parse in FORMATS:
+        data = tsv_data if name == 'tsv' else json_data
+        assert list(parse(chunks_of(data, 2 ** 16))) == results['results']['bindings']
+
+
+def parse_value(item):
+    # the conversion of each value done by _sparql_query_result_to_df before
+    if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#decimal":
+        return float(item['value'])
+    if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#integer":
+        return int(item['value'])
+    if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#dateTime":
+        return datetime.datetime.strptime(item['value'], '%Y-%m-%dT%H:%M:%SZ')
+    return item['value']
+
+
+def test_results_to_df():
+    results = recorded_results(100000)
+    bindings = results['results']['bindings']
+    for i, binding in enumerate(bindings):
+        binding['n'] = {'type': 'literal', 'value': str(i), 'datatype': XSD + 'integer'}
+
+    expected = pd.DataFrame([{k: parse_value(v) for k, v in binding.items()} for binding in bindings])
+    df = results_to_df(results)
+    assert list(df.columns) == list(expected.columns)
+    assert df['n'].dtype == 'int64'
+    assert str(df['qval'].dtype).startswith('datetime64')
+    for column in df.columns:
+        assert df[column].tolist() == expected[column].tolist() or \
+            df[column].fillna(0).tolist() == expected[column].fillna(0).tolist()
+
+    df = results_to_df(results, strip_prefix=True, categorical=True)
+    assert df['item'].dtype == 'category'
+    assert df['item'][0] == 'Q1000000'
+    assert df['v'][0] == 'Q0' and df['v'][1] == 'ENSG00000000001' and df['v'][2] == 2.5
+    assert df['p'][0] == 'http://www.wikidata.org/prop/P31'
+
+    df = results_to_df(results, arrow=True)
+    assert df['v'][2] == '2.5' and df['qval'].isna()[0]
+
+    # dates pandas can't hold are not lost
+    dates = ['1500-01-01T00:00:00Z', '-0500-01-01T00:00:00Z']
+    df = results_to_df({'head': {'vars': ['d']}, 'results': {'bindings': [
+        {'d': {'type': 'literal', 'value': d, 'datatype': XSD + 'dateTime'}} for d in dates]}})
+    assert df['d'].tolist() == dates
+    assert results_to_df({'head': {'vars': []}, 'results': {'bindings': []}}).empty
+
+
+def test_results_to_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    df = results_to_df(recorded_results(100), strip_prefix=True, categorical=True, arrow=True)
+    df.to_parquet(str(tmp_path / 'results.parquet'))
+    assert pd.read_parquet(str(tmp_path / 'results.parquet')).equals(df)
+
+
+if __name__ == '__main__':
+    # time the parsing of 100000 rows in each format
+    results = recorded_results(100000)
+    json_data = json.dumps(results).encode('utf-8')
+    tsv_data = to_tsv(results).encode('utf-8')
+    timings = dict()
+    for name, parse in FORMATS:
+        start = time.time()
+        list(parse(chunks_of(tsv_data if name == 'tsv' else json_data, 2 ** 16)))
+        timings[name] = time.time() - start
+    print("100000 rows: json {} bytes, tsv {} bytes; ".format(len(json_data), len(tsv_data)) +
+          ", ".join("{} {:.3f}s".format(k, v) for k, v in timings.items()))
+
+    # time the conversion of 100000 rows value by value, against column by column
+    results = recorded_results(100000)
+    start = time.time()
+    pd.DataFrame([{k: parse_value(v) for k, v in binding.items()} for binding in results['results']['bindings']])
+    per_value = time.time() - start
+    start = time.time()
+    results_to_df(results)
+    per_column = time.time() - start
+    print("100000 rows: per value {:.3f}s, per column {:.3f}s".format(per_value, per_column))
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_sparql_router import SparqlMirror, SparqlRouter, set_router
+
+
+class Endpoint(object):
+    """
+    A local stand-in for a SPARQL endpoint, that answers every query with the same item
+    """
+
+    def __init__(self, entity, declared_prefixes=False):
+        self.entity = entity
+        self.declared_prefixes = declared_prefixes
+        self.queries = []
+        self.status = 200
+        # time out on queries that are not split up
+        self.timeout = False
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+                status, body = endpoint.answer(data['query'][0])
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/sparql-results+json')
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/sparql'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def answer(self, query):
+        self.queries.append(query)
+        if self.status != 200:
+            return self.status, 'unavailable'
+        if self.timeout and '#wdi-shard' not in query:
+            return 500, 'java.util.concurrent.TimeoutException'
+        if query.strip() == 'ASK {}':
+            return 200, json.dumps({'head': {}, 'boolean': True})
+        if self.declared_prefixes and 'wdt:' in query and 'PREFIX wdt:' not in query:
+            return 400, 'Unknown prefix wdt'
+        results = {'head': {'vars': ['item', 'label']}, 'results': {'bindings': [
+            {'item': {'type': 'uri', 'value': self.entity + 'Q42'},
+             'label': {'type': 'literal', 'value': 'Douglas Adams', 'xml:lang': 'en'}}]}}
+        return 200, json.dumps(results)
+
+
+@pytest.fixture
+def endpoints():
+    primary = Endpoint('http://www.wikidata.org/entity/')
+    mirror = Endpoint('http://mirror.example.org/entity/', declared_prefixes=True)
+    router = SparqlRouter(primary=primary.url, health_check_interval=0.5)
+    router.add_mirror(mirror.url, query_classes=('bulk',), declare_prefixes=True, retry_after=0,
+                      iri_map={'http://www.wikidata.org/entity/': 'http://mirror.example.org/entity/'})
+    set_router(router)
+    yield primary, mirror, router
+    set_router(None)
+    primary.server.shutdown()
+    mirror.server.shutdown()
+
+
+def test_rewrite_query():
+    mirror = SparqlMirror('http://localhost/sparql', declare_prefixes=True,
+                          iri_map={'http://www.wikidata.org/entity/': 'http://mirror.example.org/entity/'})
+    query = mirror.rewrite_query('PREFIX wd: <http://www.wikidata.org/entity/>\n'
+                                 'SELECT ?item WHERE { ?item wdt:P31 wd:Q5 ; p:P31 ?s . '
+                                 'FILTER(STRSTARTS(STR(?item), "http://www.wikidata.org/entity/Q1")) }')
+    assert query.startswith('PREFIX wdt: <http://www.wikidata.org/prop/direct/>\n'
+                            'PREFIX p: <http://www.wikidata.org/prop/>\n'
+                            'PREFIX wd: <http://mirror.example.org/entity/>\n')
+    assert '"http://mirror.example.org/entity/Q1"' in query
+    assert 'www.wikidata.org/entity/' not in query
+    assert mirror.map_binding({'item': {'type': 'uri', 'value': 'http://mirror.example.org/entity/Q1'}}) == {
+        'item': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q1'}}
+
+
+def test_routing(endpoints):
+    primary, mirror, router = endpoints
+    query = 'SELECT ?item ?label WHERE { ?item wdt:P31 wd:Q5 ; rdfs:label ?label }'
+    expected = {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q42'}
+
+    # bulk queries go to the mirror, with the IRIs mapped both ways
+    bindings = list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=primary.url))
+    assert bindings[0]['item'] == expected
+    assert len(mirror.queries) == 1 and not primary.queries
+    assert 'PREFIX wd: <http://mirror.example.org/entity/>' in mirror.queries[0]
+    results = wdi_core.WDItemEngine.execute_sparql_query(query, endpoint=primary.url, query_class='bulk')
+    assert results['results']['bindings'][0]['item'] == expected
+    assert len(mirror.queries) == 2
+
+    # lookups go to the primary endpoint
+    results = wdi_core.WDItemEngine.execute_sparql_query(query, endpoint=primary.url)
+    assert results['results']['bindings'][0]['item'] == expected
+    assert len(primary.queries) == 1 and len(mirror.queries) == 2
+
+    # while the mirror is down, its queries go to the primary endpoint
+    mirror.status = 503
+    for n in range(3):
+        bindings = list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=primary.url))
+        assert bindings[0]['item'] == expected
+    assert len(primary.queries) == 4
+    assert len(mirror.queries) == 3
+    assert not router.mirrors[0].healthy
+
+    # and go back to the mirror once the health check passes
+    mirror.status = 200
+    time.sleep(0.6)
+    bindings = list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=primary.url))
+    assert bindings[0]['item'] == expected
+    assert mirror.queries[-2] == 'ASK {}'
+    assert len(primary.queries) == 4
+    assert router.mirrors[0].healthy
+
+    # queries for other endpoints are not routed
+    assert router.route('http://localhost:1/sparql', 'bulk') == []
+
+
+def test_mirror_timeout(endpoints):
+    primary, mirror, router = endpoints
+    query = 'SELECT ?item ?label WHERE { ?item wdt:P31 wd:Q5 ; rdfs:label ?label }'
+    expected = {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q42'}
+
+    # the query is split up and the parts run on the mirror, in the form it needs
+    mirror.timeout = True
+    for bindings in (list(wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=primary.url)),
+                     wdi_core.WDItemEngine.execute_sparql_query(query, endpoint=primary.url, query_class='bulk',
+                                                                use_cache=False)['results']['bindings']):
+        assert len(bindings) == 10 and all(b['item'] == expected for b in bindings)
+    assert not primary.queries
+    shards = mirror.queries[1:11]
+    assert all('PREFIX wdt:' in q and '"http://mirror.example.org/entity/Q' in q for q in shards)
+    assert not any('www.wikidata.org/entity/' in q for q in shards)
+
+
+def test_failover_without_waiting(endpoints):
+    primary, mirror, router = endpoints
+    router.mirrors[0].retry_after = 60
+    mirror.server.shutdown()
+    mirror.server.server_close()
+    start = time.time()
+    bindings = list(wdi_core.WDItemEngine.execute_sparql_query_iter('SELECT ?item WHERE { ?item ?p ?o }',
+                                                                     endpoint=primary.url))
+    assert time.time() - start < 10
+    assert bindings and len(primary.queries) == 1
+    assert not router.mirrors[0].healthy
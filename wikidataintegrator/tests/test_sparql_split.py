@@ -0,0 +1,152 @@
+import json
+import re
+
+import pytest
+
+from wikidataintegrator import wdi_core, wdi_transport
+from wikidataintegrator.wdi_sparql_split import merge_results, split_query
+
+PAGED_QUERY = """
+select ?item ?p ?qval ?pq ?sid ?v ?unit where {
+  {
+    SELECT ?item ?p ?psv ?v ?sid where {
+      VALUES (?p ?ps ?psv) { (p:P594 ps:P594 psv:P594) (p:P351 ps:P351 psv:P351) }
+      ?item ?p ?sid .
+      ?sid ?ps ?v .
+      FILTER(STR(?sid) > "")
+    } GROUP BY ?item ?p ?psv ?v ?sid
+    ORDER BY ?sid
+    LIMIT 10000
+  }
+  OPTIONAL {
+    ?sid ?pq ?qval .
+    [] wikibase:qualifier ?pq
+  }
+}"""
+
+VALUES_QUERY = """select * where {
+  values ?x {"a b" "c \\" d" "e}" "f"@en}
+  ?item wdt:P698 ?x
+}"""
+
+ID_MAPPER_QUERY = """SELECT ?id ?item ?mrt WHERE {?item p:P352 ?s .
+?s ps:P352 ?id .
+OPTIONAL {?s pq:P4390 ?mrt}
+}"""
+
+
+def test_split_limit():
+    parts = split_query(PAGED_QUERY)
+    assert len(parts) == 2
+    assert 'LIMIT 5000\n' in parts[0] and 'OFFSET' not in parts[0]
+    assert 'LIMIT 5000 OFFSET 5000\n' in parts[1]
+    assert 'LIMIT 2500 OFFSET 7500' in split_query(parts[1])[1]
+    assert split_query(PAGED_QUERY.replace('LIMIT 10000', 'LIMIT 1')) is None
+
+
+def test_split_values():
+    parts = split_query(VALUES_QUERY)
+    assert len(parts) == 2
+    assert '"a b" "c \\" d"' in parts[0] and '"e}"' not in parts[0]
+    assert '"e}" "f"@en' in parts[1] and '"a b"' not in parts[1]
+    # rows of several variables
+    q = 'SELECT ?item WHERE { VALUES (?p ?v) { (p:P1 "x") (p:P2 "y") (p:P3 "z") } ?item ?p ?v }'
+    parts = split_query(q)
+    assert '(p:P1 "x")' in parts[0] and '(p:P2 "y") (p:P3 "z")' in parts[1]
+    # counts over the whole result can't be split on the values
+    assert split_query('SELECT (COUNT(?x) AS ?c) WHERE { VALUES ?x { 1 2 3 } ?item ?p ?x }') is None
+    # but can be, if grouped by them
+    assert len(split_query('SELECT ?x (COUNT(?s) AS ?c) WHERE { VALUES ?x { 1 2 } ?s ?p ?x } GROUP BY ?x')) == 2
+
+
+def test_split_items():
+    parts = split_query(ID_MAPPER_QUERY)
+    assert len(parts) == 10
+    assert 'FILTER(STRSTARTS(STR(?item), "http://www.wikidata.org/entity/Q1")) #wdi-shard Q1\n}' in parts[0]
+    assert 'FILTER(!STRSTARTS(STR(?item), "http://www.wikidata.org/entity/Q"))' in parts[9]
+    assert split_query(parts[9]) is None
+
+    refined = split_query(parts[1])
+    assert len(refined) == 11
+    assert 'FILTER(STR(?item) = "http://www.wikidata.org/entity/Q2")\n' in refined[0]
+    assert '"http://www.wikidata.org/entity/Q29")) #wdi-shard Q29' in refined[10]
+    assert all('wdi-shard Q2\n' not in q for q in refined)
+    assert split_query(refined[0]) is None
+
+
+def test_merge_results():
+    r1 = {'head': {'vars': ['a']}, 'results': {'bindings': [{'a': {'type': 'literal', 'value': '1'}}]}}
+    r2 = {'head': {'vars': ['a', 'b']}, 'results': {'bindings': [{'a': {'type': 'literal', 'value': '1'}}]}}
+    assert merge_results('SELECT * WHERE {}', [r1, r2]) == {
+        'head': {'vars': ['a', 'b']}, 'results': {'bindings': r1['results']['bindings'] * 2}}
+    assert merge_results('SELECT DISTINCT ?a WHERE {}', [r1, r2])['results']['bindings'] == \
+        r1['results']['bindings']
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, results=None):
+        self.status_code = status_code
+        self.headers = {}
+        self.results = results
+        self.text = json.dumps(results) if results else \
+            'SPARQL-QUERY: queryStr=...\njava.util.concurrent.TimeoutException\n\tat java.util.concurrent.FutureTask'
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise AssertionError("not split")
+
+    def json(self):
+        return self.results
+
+
+class FakeTransport(object):
+    """
+    Times out on queries with more than 2 values, a limit larger than 100 or neither
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def post(self, url, data=None, **kwargs):
+        query = data['query']
+        self.queries.append(query)
+        values = re.search(r'values \?x \{(.*?)\}\n', query)
+        if values:
+            xs = re.findall(r'"(\w+)"', values.group(1))
+            if len(xs) > 2:
+                return FakeResponse(500)
+            rows = [{'x': {'type': 'literal', 'value': x}} for x in xs]
+        else:
+            m = re.search(r'LIMIT (\d+)(?: OFFSET (\d+))?', query)
+            if not m:
+                return FakeResponse(500)
+            limit, offset = int(m.group(1)), int(m.group(2) or 0)
+            if limit > 100:
+                return FakeResponse(500)
+            rows = [{'n': {'type': 'literal', 'value': str(n)}} for n in range(offset, min(offset + limit, 350))]
+        return FakeResponse(200, {'head': {'vars': ['x', 'n']}, 'results': {'bindings': rows}})
+
+
+@pytest.fixture
+def transport():
+    transport = FakeTransport()
+    wdi_transport.set_transport(transport)
+    yield transport
+    wdi_transport.set_transport(None)
+
+
+def test_split_timed_out_query(transport):
+    xs = ['v{}'.format(i) for i in range(9)]
+    query = 'select * where {\n  values ?x {' + ' '.join('"{}"'.format(x) for x in xs) + '}\n  ?item wdt:P1 ?x\n}'
+    results = wdi_core.WDItemEngine.execute_sparql_query(query)
+    assert [b['x']['value'] for b in results['results']['bindings']] == xs
+
+    transport.queries.clear()
+    bindings = wdi_core.WDItemEngine.execute_sparql_query_iter(PAGED_QUERY.replace('LIMIT 10000', 'LIMIT 400'))
+    assert [int(b['n']['value']) for b in bindings] == list(range(350))
+    # 400 -> 200, 200 -> 100 + 100, 100 + 100
+    assert len(transport.queries) == 7
+
+    # a query that can't be split any further
+    with pytest.raises(wdi_core.SparqlQueryTimeout):
+        wdi_core.WDItemEngine.execute_sparql_query('SELECT ?s WHERE { ?s ?p ?o }')
@@ -0,0 +1,102 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from wikidataintegrator import wdi_core, wdi_transport
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request with an empty sparql result, on a keep-alive connection
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(StandInHandler, self).setup()
+        # like a real server, don't wait for more data before sending the body of the reply
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.path, body, self.headers.get('Cookie')))
+        reply = json.dumps({'head': {'vars': []}, 'results': {'bindings': []}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Set-Cookie', 'session=secret; Path=/')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super(StandInServer, self).__init__(('127.0.0.1', 0), StandInHandler)
+        self.connections = 0
+        self.requests = []
+
+    def get_request(self):
+        self.connections += 1
+        return super(StandInServer, self).get_request()
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_queries(url, n):
+    start = time.time()
+    for _ in range(n):
+        wdi_core.WDItemEngine.execute_sparql_query('SELECT * WHERE { ?s ?p ?o }', endpoint=url)
+    return time.time() - start
+
+
+def test_connection_reuse(server):
+    url = 'http://127.0.0.1:{}/sparql'.format(server.server_address[1])
+    wdi_transport.set_transport(wdi_transport.WDTransport())
+    try:
+        run_queries(url, 50)
+        assert server.connections == 1
+        # the query is sent in the request body, not the url
+        assert server.requests[0][0] == '/sparql'
+        assert b'query=' in server.requests[0][1]
+
+        # cookies set in a reply are not sent along with later requests
+        wdi_transport.get_transport().get(url)
+        assert server.requests[-1][2] is None
+        wdi_transport.get_transport().get(url, cookies={'login': 'me'})
+        assert server.requests[-1][2] == 'login=me'
+    finally:
+        wdi_transport.set_transport(None)
+
+
+if __name__ == '__main__':
+    # time 50 queries on one pooled connection, against a new connection per query
+    server = StandInServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/sparql'.format(server.server_address[1])
+    wdi_transport.set_transport(wdi_transport.WDTransport())
+    pooled = run_queries(url, 50)
+    start = time.time()
+    for _ in range(50):
+        requests.post(url, data={'query': 'SELECT * WHERE { ?s ?p ?o }', 'format': 'json'})
+    unpooled = time.time() - start
+    print("50 queries: {:.3f}s pooled, {:.3f}s with a connection each".format(pooled, unpooled))
+    server.shutdown()
@@ -0,0 +1,227 @@
+"""
+asyncio client for the query service and the wikibase api.
+
+The requests of WDFunctionsEngine and WDItemEngine are sent one after the other, so looking up many identifiers or
+entities takes about as long as the sum of the round trips. `WDAsyncClient` has coroutine versions of
+`execute_sparql_query`, `mediawiki_api_call` and `generate_item_instances`, which can be gathered, while the client
+keeps at most `concurrency` requests in flight. They retry on the same conditions as the synchronous methods (503,
+429 with Retry-After, rate limiting, maxlag and readonly mode), and return the same structures.
+
+The requests are sent by threads through the shared transport (see wdi_transport), so they reuse its connections.
+Raise config['HTTP_POOL_MAXSIZE'] if `concurrency` is larger than it. SPARQL queries also stay within the query
+budget of their endpoint (see wdi_query_budget), which has its own limit on parallel queries.
+
+    import asyncio
+    from wikidataintegrator.wdi_async import WDAsyncClient
+
+    async def main():
+        client = WDAsyncClient(concurrency=5)
+        return await asyncio.gather(*(client.execute_sparql_query(q) for q in queries))
+
+    results = asyncio.run(main())
+
+Options (see wdi_config):
+ASYNC_CONCURRENCY: default maximum number of requests in flight per client
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_query_budget import get_budget
+from wikidataintegrator.wdi_sparql_cache import get_cache
+from wikidataintegrator.wdi_transport import get_transport
+
+
+class WDAsyncClient(object):
+    # maximum number of entities per wbgetentities call
+    entities_batch_size = 50
+
+    def __init__(self, concurrency=None, transport=None):
+        """
+        :param concurrency: maximum number of requests in flight. Default from config['ASYNC_CONCURRENCY']
+        :type concurrency: int
+        :param transport: the WDTransport to send the requests with, default is the shared one
+        """
+        self.concurrency = config['ASYNC_CONCURRENCY'] if concurrency is None else concurrency
+        self.transport = transport
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._semaphore = None
+        self._loop = None
+
+    def _get_semaphore(self):
+        # a semaphore belongs to the event loop it is first used in
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def _get_transport(self):
+        return self.transport if self.transport is not None else get_transport()
+
+    async def execute_sparql_query(self, query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                                   max_retries=1000, retry_after=60, use_cache=True, result_format='json'):
+        """
+        Coroutine version of `WDFunctionsEngine.execute_sparql_query`
+
+        :return: The results of the query in JSON format, or a pandas dataframe if `as_dataframe`
+        """
+        sparql_endpoint_url = config['SPARQL_ENDPOINT_URL'] if endpoint is None else endpoint
+        user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
+
+        if prefix:
+            query = prefix + '\n' + query
+
+        cache = get_cache() if use_cache and result_format != 'csv' else None
+        results = None
+        if cache is not None:
+            results = await self._run(cache.get, query, sparql_endpoint_url)
+
+        if results is None:
+            params, headers = wdi_core.WDFunctionsEngine._sparql_request_args(query, user_agent, result_format)
+            post = partial(self._get_transport().post, sparql_endpoint_url, data=params, headers=headers)
+            budget = get_budget(sparql_endpoint_url)
+            async with self._get_semaphore():
+                for n in range(max_retries):
+                    try:
+                        # waiting for the budget happens in the thread, so that it never holds up a running query
+                        response = await self._run(budget.call, post) if budget is not None else await self._run(post)
+                    except requests.exceptions.ConnectionError as e:
+                        print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if response.status_code == 503:
+                        print("service unavailable. sleeping for {} seconds".format(retry_after))
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if response.status_code == 429:
+                        if "retry-after" in response.headers.keys():
+                            retry_after = int(response.headers["retry-after"])
+                        if budget is not None:
+                            budget.throttle(retry_after)
+                        print("service unavailable. sleeping for {} seconds".format(retry_after))
+                        await asyncio.sleep(retry_after)
+                        continue
+                    response.raise_for_status()
+                    break
+                else:
+                    return None
+            results = await self._run(wdi_core.WDFunctionsEngine._parse_sparql_response, response, result_format)
+            if cache is not None:
+                await self._run(cache.put, query, sparql_endpoint_url, results)
+
+        if as_dataframe:
+            return await self._run(wdi_core.WDItemEngine._sparql_query_result_to_df, results)
+        return results
+
+    async def execute_sparql_queries(self, queries, **kwargs):
+        """
+        Run many queries, at most `concurrency` at a time
+
+        :param queries: iterable of SPARQL query strings
+        :param kwargs: passed to `execute_sparql_query`
+        :return: list of the results, in the order of `queries`
+        """
+        return await asyncio.gather(*(self.execute_sparql_query(query, **kwargs) for query in queries))
+
+    async def mediawiki_api_call(self, method, mediawiki_api_url=None, session=None, max_retries=1000,
+                                 retry_after=60, **kwargs):
+        """
+        Coroutine version of `WDItemEngine.mediawiki_api_call`
+
+        :param session: If a session is passed, it will be used. Otherwise the transport of the client
+        :return: the json response
+        """
+        mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
+
+        response = None
+        session = session if session else self._get_transport()
+        async with self._get_semaphore():
+            for n in range(max_retries):
+                try:
+                    response = await self._run(session.request, method, mediawiki_api_url, **kwargs)
+                except requests.exceptions.ConnectionError as e:
+                    print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
+                    await asyncio.sleep(retry_after)
+                    continue
+                if response.status_code == 503:
+                    print("service unavailable. sleeping for {} seconds".format(retry_after))
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                response.raise_for_status()
+                json_data = response.json()
+                sleep_sec = wdi_core.WDItemEngine._mediawiki_retry_delay(response, json_data, retry_after)
+                if sleep_sec is not None:
+                    await asyncio.sleep(sleep_sec)
+                    continue
+                break
+            else:
+                raise wdi_core.WDApiError(response.json() if response else dict())
+
+        return json_data
+
+    async def get_entities(self, ids, mediawiki_api_url=None, user_agent=None, login=None):
+        """
+        Fetch the json of many entities, with concurrent wbgetentities calls of up to `entities_batch_size` IDs
+
+        :param ids: list of entity IDs
+        :param login: An object of type WDLogin, whose session is used for the requests
+        :return: dict of entity ID to entity json, like the 'entities' of a wbgetentities response
+        """
+        user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
+        headers = {
+            'User-Agent': user_agent
+        }
+        session = login.get_session() if login else None
+
+        batches = [ids[i:i + self.entities_batch_size] for i in range(0, len(ids), self.entities_batch_size)]
+        replies = await asyncio.gather(*(
+            self.mediawiki_api_call('GET', mediawiki_api_url, session=session, headers=headers,
+                                    params={'action': 'wbgetentities', 'ids': '|'.join(batch), 'format': 'json'})
+            for batch in batches))
+
+        entities = dict()
+        for reply in replies:
+            entities.update(reply['entities'])
+        return entities
+
+    async def generate_item_instances(self, items, mediawiki_api_url=None, login=None, user_agent=None,
+                                      engine=wdi_core.WDItemEngine):
+        """
+        Coroutine version of `WDItemEngine.generate_item_instances`, without a limit on the number of items
+
+        :param items: A list of QIDs or property IDs
+        :param engine: the class of the instances
+        :return: A list of tuples of the QID or property ID and the instance of `engine` with the item data
+        """
+        mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
+        entities = await self.get_entities(items, mediawiki_api_url=mediawiki_api_url, user_agent=user_agent,
+                                           login=login)
+
+        item_instances = []
+        for qid, v in entities.items():
+            ii = engine(wd_item_id=qid, item_data=v)
+            ii.mediawiki_api_url = mediawiki_api_url
+            item_instances.append((qid, ii))
+        return item_instances
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items()),
+        )
@@ -10,6 +10,43 @@ BACKOFF_MAX_VALUE: maximum number of seconds to wait before retrying. wait time
         Default: 3600 (one hour)
 USER_AGENT_DEFAULT: default user agent string used for http requests. Both to wikibase api, query service and others.
     See: https://meta.wikimedia.org/wiki/User-Agent_policy
+FASTRUN_QUERY_HINTS: list of query hints added to the fastrun statement query, e.g. ['hint:Query hint:optimizer "None" .']
+        Default: [] (none)
+HTTP_TIMEOUT: (connect, read) timeout in seconds for http requests, see wdi_transport.
+        Default: (30, None) (no read timeout)
+HTTP_POOL_CONNECTIONS: number of hosts to keep a pool of open connections for.
+        Default: 10
+HTTP_POOL_MAXSIZE: maximum number of open connections per host.
+        Default: 10
+SPARQL_CACHE_DIR: directory to cache SPARQL query results in, see wdi_sparql_cache.
+        Default: None (no caching)
+SPARQL_CACHE_TTL: number of seconds a cached query result is used for.
+        Default: 86400 (one day). None for no expiry
+SPARQL_CACHE_MAX_SIZE: maximum size of the SPARQL cache in bytes. Least recently used results are removed first.
+        Default: 1073741824 (1 GiB)
+SPARQL_CACHE_VALIDATE: if set, cached results are not used when the data of the endpoint (its schema:dateModified)
+        changed more than this number of seconds after they were stored. 0 invalidates on any update.
+        Default: None (no validation)
+SPARQL_BULK_FORMAT: result format requested for queries with large results (fastrun, id_mapper, get_values), 'json' or
+        'tsv'. TSV results are a fraction of the size of JSON results, see wdi_sparql_results.
+        Default: 'json'
+ASYNC_CONCURRENCY: maximum number of requests a wdi_async.WDAsyncClient has in flight at the same time.
+        Default: 5 (the number of parallel queries the Wikidata query service allows per client)
+SPARQL_QUERY_TIME_BUDGET: seconds of query time per minute the queries to one SPARQL endpoint may use together, see
+        wdi_query_budget. Queries wait for their turn instead of going over the limit of the endpoint. Set it to 60
+        for the limit of the Wikidata query service, or give a single endpoint a budget with
+        wdi_query_budget.set_budget.
+        Default: None (no budget)
+SPARQL_MAX_CONCURRENT: maximum number of queries to one SPARQL endpoint with a query time budget running at the
+        same time.
+        Default: 5 (the limit of the Wikidata query service)
+SPARQL_SPLIT_MAX_DEPTH: how many times a SPARQL query that times out is split into smaller ones, see wdi_sparql_split.
+        Default: 6. 0 disables splitting
+RECENT_CHANGES_NAMESPACES: the namespaces of entity pages, whose changes a fastrun container refreshes.
+        Default: [0, 120, 146] (items, properties and lexemes on Wikidata). A default wikibase install has items in 120
+        and properties in 122
+ENTITY_LOADER_WORKERS: number of wbgetentities calls a wdi_entity_loader.WDEntityLoader has in flight at the same time.
+        Default: 4
 """
 import pkg_resources
 
@@ -32,7 +69,22 @@ config = {
     'SPARQL_ENDPOINT_URL': 'https://query.wikidata.org/sparql',
     "ENTITY_SCHEMA_REPO": "https://www.wikidata.org/wiki/Special:EntitySchemaText/",
     'WIKIBASE_URL': 'http://www.wikidata.org',
-    'CONCEPT_BASE_URI': 'http://www.wikidata.org/entity/'
+    'CONCEPT_BASE_URI': 'http://www.wikidata.org/entity/',
+    'FASTRUN_QUERY_HINTS': [],
+    'HTTP_TIMEOUT': (30, None),
+    'HTTP_POOL_CONNECTIONS': 10,
+    'HTTP_POOL_MAXSIZE': 10,
+    'SPARQL_CACHE_DIR': None,
+    'SPARQL_CACHE_TTL': 86400,
+    'SPARQL_CACHE_MAX_SIZE': 2 ** 30,
+    'SPARQL_CACHE_VALIDATE': None,
+    'SPARQL_BULK_FORMAT': 'json',
+    'ASYNC_CONCURRENCY': 5,
+    'SPARQL_QUERY_TIME_BUDGET': None,
+    'SPARQL_MAX_CONCURRENT': 5,
+    'SPARQL_SPLIT_MAX_DEPTH': 6,
+    'ENTITY_LOADER_WORKERS': 4,
+    'RECENT_CHANGES_NAMESPACES': [0, 120, 146]
 }
 
 prefix = {
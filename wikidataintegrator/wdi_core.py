@@ -7,9 +7,10 @@ import re
 import time
 import warnings
 from collections import defaultdict
+from functools import partial
+from itertools import islice
 from typing import List
 
-import pandas as pd
 import requests
 from pyshex import ShExEvaluator
 from rdflib import Graph
@@ -17,8 +18,15 @@ from shexer.shaper import Shaper
 
 from wikidataintegrator.wdi_backoff import wdi_backoff
 from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_engine_context import get_context
+from wikidataintegrator.wdi_entity_loader import WDEntityLoader
 from wikidataintegrator.wdi_fastrun import FastRunContainer
-from wikidataintegrator.wdi_helpers import MappingRelationHelper
+from wikidataintegrator.wdi_query_budget import get_budget
+from wikidataintegrator.wdi_sparql_cache import get_cache
+from wikidataintegrator.wdi_sparql_results import RESULT_FORMATS, iter_bindings, results_to_df
+from wikidataintegrator.wdi_sparql_router import get_router
+from wikidataintegrator.wdi_sparql_split import merge_results, split_query
+from wikidataintegrator.wdi_transport import get_transport
 from wikidataintegrator import wdi_rdf
 
 """
@@ -66,13 +74,13 @@ class WDFunctionsEngine(object):
         mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
 
         linkedby = []
-        whatlinkshere = json.loads(requests.get(
+        whatlinkshere = json.loads(get_transport().get(
             mediawiki_api_url + "?action=query&list=backlinks&format=json&bllimit=500&bltitle=" + qid).text)
         for link in whatlinkshere["query"]["backlinks"]:
             if link["title"].startswith("Q"):
                 linkedby.append(link["title"])
         while 'continue' in whatlinkshere.keys():
-            whatlinkshere = json.loads(requests.get(
+            whatlinkshere = json.loads(get_transport().get(
                 mediawiki_api_url + "?action=query&list=backlinks&blcontinue=" +
                 whatlinkshere['continue']['blcontinue'] + "&format=json&bllimit=500&bltitle=" + qid).text)
             for link in whatlinkshere["query"]["backlinks"]:
@@ -82,7 +90,8 @@ class WDFunctionsEngine(object):
 
     @staticmethod
     @wdi_backoff()
-    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60):
+    def execute_sparql_query(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60,
+                             use_cache=True, result_format='json', query_class='lookup'):
 
         """
         Static method which can be used to execute any SPARQL query
@@ -95,6 +104,12 @@ class WDFunctionsEngine(object):
         :type user_agent: str
         :param max_retries: The number time this function should retry in case of header reports.
         :param retry_after: the number of seconds should wait upon receiving either an error code or the WDQS is not reachable.
+        :param use_cache: Look up and store the results in the SPARQL result cache, if caching is enabled (see
+            wdi_sparql_cache)
+        :param result_format: The format the endpoint is asked to send the results in, 'json', 'tsv' or 'csv'. The
+            results are returned in JSON format either way, see `wdi_sparql_results`. 'csv' results only have values.
+        :param query_class: 'lookup' or 'bulk', the class of the query for routing it to a mirror of the endpoint, see
+            wdi_sparql_router
         :return: The results of the query are returned in JSON format
         """
 
@@ -104,58 +119,246 @@ class WDFunctionsEngine(object):
         if prefix:
             query = prefix + '\n' + query
 
-        params = {
-            'query': '#Tool: wdi_core fastrun\n' + query,
-            'format': 'json'
-        }
+        # csv results lack the types, so they can't be shared with the other formats
+        cache = get_cache() if use_cache and result_format != 'csv' else None
+        if cache is not None:
+            results = cache.get(query, sparql_endpoint_url)
+            if results is not None:
+                return WDItemEngine._sparql_query_result_to_df(results) if as_dataframe else results
+
+        run = partial(WDFunctionsEngine._run_sparql_query, user_agent=user_agent, max_retries=max_retries,
+                      retry_after=retry_after, result_format=result_format)
+        router = get_router()
+        if router is None:
+            results = run(query, sparql_endpoint_url)
+        else:
+            mirror, results = router.run(query, sparql_endpoint_url, query_class, run)
+            if mirror is not None:
+                results = mirror.map_results(results)
+        if results is None:
+            return None
+        if cache is not None:
+            cache.put(query, sparql_endpoint_url, results)
 
-        headers = {
-            'Accept': 'application/sparql-results+json',
-            'User-Agent': user_agent
-        }
+        if as_dataframe:
+            return WDItemEngine._sparql_query_result_to_df(results)
+        else:
+            return results
+
+    @staticmethod
+    def execute_sparql_query_iter(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                                  chunk_size=10000, max_retries=1000, retry_after=60, use_cache=True,
+                                  result_format='json', query_class='bulk'):
+        """
+        Like `execute_sparql_query`, but the results are parsed while they are received and returned one at a time,
+        so that the complete result set is never held in memory. The query is only retried until the endpoint starts
+        sending results. If the SPARQL result cache is used, the results are also collected while they are received,
+        and stored in the cache once all of them were read.
+
+        :param as_dataframe: Return pandas dataframes of up to `chunk_size` results, instead of the bindings
+        :param chunk_size: number of results in each dataframe
+        :type chunk_size: int
+        :param use_cache: Look up and store the results in the SPARQL result cache, if caching is enabled
+        :param result_format: The format the endpoint is asked to send the results in, 'json', 'tsv' or 'csv'
+        :param query_class: 'lookup' or 'bulk', the class of the query for routing it, see wdi_sparql_router
+        :return: generator of bindings, in the format of results['results']['bindings'] of `execute_sparql_query`,
+            or of dataframes
+        """
+        sparql_endpoint_url = config['SPARQL_ENDPOINT_URL'] if endpoint is None else endpoint
+        user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
+
+        if prefix:
+            query = prefix + '\n' + query
+
+        cache = get_cache() if use_cache and result_format != 'csv' else None
+        results = cache.get(query, sparql_endpoint_url) if cache is not None else None
         response = None
+        # the head and bindings to store in the cache
+        head = dict()
+        stored = None
+        if results is not None:
+            bindings = iter(results['results']['bindings'])
+        else:
+            def post(query, url, mirror=None, max_retries=max_retries, retry_after=retry_after):
+                try:
+                    return WDFunctionsEngine._post_sparql_query(
+                        mirror.rewrite_query(query) if mirror is not None else query, url, user_agent, stream=True,
+                        max_retries=max_retries, retry_after=retry_after, result_format=result_format)
+                except SparqlQueryTimeout:
+                    # the parts of the split query are not streamed
+                    return WDFunctionsEngine._run_split_query(query, url, user_agent, max_retries=max_retries,
+                                                              retry_after=retry_after, result_format=result_format,
+                                                              mirror=mirror)
+
+            router = get_router()
+            mirror = None
+            if router is None:
+                result = post(query, sparql_endpoint_url)
+            else:
+                mirror, result = router.run(query, sparql_endpoint_url, query_class, post)
+            if result is None:
+                return
+            if isinstance(result, dict):
+                head = result.get('head', head)
+                bindings = iter(result['results']['bindings'])
+            else:
+                response = result
+                bindings = iter_bindings(response.iter_content(chunk_size=2 ** 16), result_format, head=head)
+            if mirror is not None:
+                bindings = map(mirror.map_binding, bindings)
+            if cache is not None:
+                stored = []
+                # copies, as the caller may change the bindings it gets
+                bindings = (stored.append({k: dict(v) for k, v in x.items()}) or x for x in bindings)
+
+        try:
+            if not as_dataframe:
+                yield from bindings
+            else:
+                while True:
+                    chunk = list(islice(bindings, chunk_size))
+                    if not chunk:
+                        break
+                    yield WDItemEngine._sparql_query_result_to_df({'results': {'bindings': chunk}})
+        finally:
+            if response is not None:
+                response.close()
+        # only reached if all the results were read
+        if stored is not None:
+            variables = head.get('vars') or list(dict.fromkeys(k for x in stored for k in x))
+            cache.put(query, sparql_endpoint_url, {'head': {'vars': variables}, 'results': {'bindings': stored}})
+
+    @staticmethod
+    def _run_sparql_query(query, sparql_endpoint_url, user_agent, mirror=None, max_retries=1000, retry_after=60,
+                          result_format='json', split_depth=0):
+        """
+        Send a query to a SPARQL endpoint and parse the results. If the query times out, it is split up and the parts
+        are run instead, see `_run_split_query`
+
+        :param mirror: the wdi_sparql_router.SparqlMirror at `sparql_endpoint_url`, if any. The query is sent in the
+            form the mirror needs, the results are not mapped back.
+        :return: the results in JSON format, or None if the query was retried `max_retries` times
+        """
+        try:
+            response = WDFunctionsEngine._post_sparql_query(mirror.rewrite_query(query) if mirror is not None else query,
+                                                            sparql_endpoint_url, user_agent, max_retries=max_retries,
+                                                            retry_after=retry_after, result_format=result_format)
+            if response is None:
+                return None
+            return WDFunctionsEngine._parse_sparql_response(response, result_format)
+        except SparqlQueryTimeout:
+            return WDFunctionsEngine._run_split_query(query, sparql_endpoint_url, user_agent, mirror=mirror,
+                                                      max_retries=max_retries, retry_after=retry_after,
+                                                      result_format=result_format, split_depth=split_depth)
+
+    @staticmethod
+    def _run_split_query(query, sparql_endpoint_url, user_agent, mirror=None, max_retries=1000, retry_after=60,
+                         result_format='json', split_depth=0):
+        """
+        Run a query that timed out as smaller queries (see wdi_sparql_split), which are split again if they time out
+        too, up to config['SPARQL_SPLIT_MAX_DEPTH'] times. The query is split in the form of the query service, and
+        each part is rewritten for `mirror`, if given.
+
+        :return: the merged results in JSON format, or None if a part was retried `max_retries` times
+        """
+        parts = split_query(query) if split_depth < config['SPARQL_SPLIT_MAX_DEPTH'] else None
+        if not parts:
+            raise SparqlQueryTimeout(query)
+        print("Query timed out. Splitting it into {} queries".format(len(parts)))
+        results = []
+        for part in parts:
+            result = WDFunctionsEngine._run_sparql_query(part, sparql_endpoint_url, user_agent, mirror=mirror,
+                                                         max_retries=max_retries, retry_after=retry_after,
+                                                         result_format=result_format, split_depth=split_depth + 1)
+            if result is None:
+                return None
+            results.append(result)
+        return merge_results(query, results)
+
+    @staticmethod
+    def _post_sparql_query(query, sparql_endpoint_url, user_agent, stream=False, max_retries=1000, retry_after=60,
+                           result_format='json'):
+        """
+        Send a query to a SPARQL endpoint, retrying while the endpoint is unavailable or asks to slow down
+
+        :param result_format: one of wdi_sparql_results.RESULT_FORMATS
+        :return: requests.Response, or None if the query was retried `max_retries` times
+        :raises SparqlQueryTimeout: if the endpoint gave up on the query because it took too long
+        """
+        params, headers = WDFunctionsEngine._sparql_request_args(query, user_agent, result_format)
+        post = partial(get_transport().post, sparql_endpoint_url, data=params, headers=headers, stream=stream)
+        budget = get_budget(sparql_endpoint_url)
 
         for n in range(max_retries):
             try:
-                response = requests.post(sparql_endpoint_url, params=params, headers=headers)
+                response = budget.call(post) if budget is not None else post()
             except requests.exceptions.ConnectionError as e:
-                print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
-                time.sleep(retry_after)
+                if n + 1 < max_retries:
+                    print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
+                    time.sleep(retry_after)
                 continue
             if response.status_code == 503:
-                print("service unavailable. sleeping for {} seconds".format(retry_after))
-                time.sleep(retry_after)
+                if n + 1 < max_retries:
+                    print("service unavailable. sleeping for {} seconds".format(retry_after))
+                    time.sleep(retry_after)
                 continue
             if response.status_code == 429:
                 if "retry-after" in response.headers.keys():
                     retry_after = int(response.headers["retry-after"])
-                print("service unavailable. sleeping for {} seconds".format(retry_after))
-                time.sleep(retry_after)
+                if budget is not None:
+                    budget.throttle(retry_after)
+                if n + 1 < max_retries:
+                    print("service unavailable. sleeping for {} seconds".format(retry_after))
+                    time.sleep(retry_after)
                 continue
+            if response.status_code == 500 and 'TimeoutException' in response.text:
+                raise SparqlQueryTimeout(query)
             response.raise_for_status()
-            results = response.json()
+            return response
 
-            if as_dataframe:
-                return WDItemEngine._sparql_query_result_to_df(results)
-            else:
-                return results
+    @staticmethod
+    def _sparql_request_args(query, user_agent, result_format='json'):
+        """
+        :return: the form data and the headers of a request for a SPARQL query
+        """
+        if result_format not in RESULT_FORMATS:
+            raise ValueError("unknown SPARQL result format: {}".format(result_format))
+        params = {
+            'query': '#Tool: wdi_core fastrun\n' + query
+        }
+        if result_format == 'json':
+            # the query service lets the format parameter take precedence over the Accept header
+            params['format'] = 'json'
+
+        headers = {
+            'Accept': RESULT_FORMATS[result_format],
+            'User-Agent': user_agent
+        }
+        return params, headers
 
     @staticmethod
-    def _sparql_query_result_to_df(results):
-
-        def parse_value(item):
-            if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#decimal":
-                return float(item['value'])
-            if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#integer":
-                return int(item['value'])
-            if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#dateTime":
-                return datetime.datetime.strptime(item['value'], '%Y-%m-%dT%H:%M:%SZ')
-            return item['value']
-
-        results = results['results']['bindings']
-        results = [{k: parse_value(v) for k, v in item.items()} for item in results]
-        df = pd.DataFrame(results)
-        return df
+    def _parse_sparql_response(response, result_format='json'):
+        """
+        :return: the results of a SPARQL query in JSON format, whatever format they were sent in
+        """
+        if result_format == 'json':
+            try:
+                return response.json()
+            except ValueError:
+                # the query service may time out after it started sending results
+                if 'TimeoutException' in response.text:
+                    raise SparqlQueryTimeout(response.text[-1000:])
+                raise
+        head = dict()
+        bindings = list(iter_bindings(response.iter_content(chunk_size=2 ** 16), result_format, head=head))
+        return {'head': head, 'results': {'bindings': bindings}}
+
+    @staticmethod
+    def _sparql_query_result_to_df(results, strip_prefix=False, categorical=False, arrow=False):
+        """
+        :return: the results of a SPARQL query as a pandas dataframe, see `wdi_sparql_results.results_to_df`
+        """
+        return results_to_df(results, strip_prefix=strip_prefix, categorical=categorical, arrow=arrow)
 
     @staticmethod
     def delete_item(item, reason, login, mediawiki_api_url=None, user_agent=None):
@@ -184,7 +387,7 @@ class WDFunctionsEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     @staticmethod
@@ -201,7 +404,7 @@ class WDFunctionsEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     ## SHEX related functions
@@ -225,7 +428,7 @@ class WDFunctionsEngine(object):
         else:
             rdfdata.parse(data=data)
         entity_schema_repo = config["ENTITY_SCHEMA_REPO"] if entity_schema_repo is None else entity_schema_repo
-        schema = requests.get(entity_schema_repo+eid).text
+        schema = get_transport().get(entity_schema_repo+eid).text
 
         for result in ShExEvaluator(rdf=rdfdata, schema=schema, focus=config["CONCEPT_BASE_URI"] + qid).evaluate():
             shex_result = dict()
@@ -306,6 +509,20 @@ class WDItemEngine(object):
 
     DISTINCT_VALUE_PROPS = dict()
 
+    # the query for the items having any of several core prop values, see __select_wd_item
+    core_props_query = '''
+        PREFIX wd: <{wb_url}/entity/>
+        PREFIX p: <{wb_url}/prop/>
+        PREFIX ps: <{wb_url}/prop/statement/>
+        PREFIX pq: <{wb_url}/prop/qualifier/>
+        SELECT ?row ?item_id ?mrt WHERE {{
+          VALUES (?row ?p ?ps ?value) {{ {values} }}
+          ?item_id ?p ?s .
+          ?s ?ps ?value .
+          OPTIONAL {{?s pq:{mrt_pid} ?mrt}}
+        }}
+    '''
+
     logger = None
 
     def __init__(self, wd_item_id='', new_item=False, data=None, mediawiki_api_url=None, sparql_endpoint_url=None,
@@ -313,7 +530,8 @@ class WDItemEngine(object):
                  fast_run_use_refs=False, ref_handler=None, global_ref_mode='KEEP_GOOD', good_refs=None,
                  keep_good_ref_statements=True, search_only=False, item_data=None, user_agent=None, core_props=None,
                  core_prop_match_thresh=0.66, property_constraint_pid=None, distinct_values_constraint_qid=None,
-                 fast_run_case_insensitive=False, debug=False):
+                 fast_run_case_insensitive=False, fast_run_snapshot_dir=None, fast_run_compact=False, fast_run_qids=None,
+                 fast_run_unindexed_props=None, debug=False, context=None):
         """
         constructor
 
@@ -381,9 +599,36 @@ class WDItemEngine(object):
         :param core_prop_match_thresh: The proportion of core props that must match during retrieval of an item
         when the wd_item_id is not specified.
         :type core_prop_match_thresh: float
+        :param fast_run_snapshot_dir: A directory with fastrun snapshots written by `save_fastrun_snapshots`. If a
+        snapshot matching `fast_run_base_filter`, `fast_run_use_refs` and the sparql endpoint exists, a new fastrun
+        container is warm started from it instead of being loaded from the sparql endpoint.
+        :type fast_run_snapshot_dir: str
+        :param fast_run_compact: Store the fastrun data with interned integer ids in columnar arrays instead of nested
+        dicts and sets. Uses a fraction of the memory for large base filters, at the cost of a slower item lookup.
+        :type fast_run_compact: bool
+        :param fast_run_qids: Only load the fastrun data of these items (and `wd_item_id`), instead of all items
+        matching `fast_run_base_filter`. Items not in this list are invisible to fastrun. An empty list loads the
+        `wd_item_id` of each engine as it comes.
+        :type fast_run_qids: list
+        :param fast_run_unindexed_props: Properties whose values don't identify items (e.g. P31 for a class of
+        millions of items). They are left out of the fastrun reverse lookup, but are still compared.
+        :type fast_run_unindexed_props: list
         :param debug: Enable debug output.
         :type debug: boolean
-        """
+        :param context: The data shared by the engines working on a wikibase, whose urls are used by default. If None,
+        the context shared by all engines of the class with the same urls is used. See wdi_engine_context
+        :type context: wdi_engine_context.EngineContext
+        """
+        if context is not None:
+            mediawiki_api_url = context.mediawiki_api_url if mediawiki_api_url is None else mediawiki_api_url
+            sparql_endpoint_url = context.sparql_endpoint_url if sparql_endpoint_url is None else sparql_endpoint_url
+            wikibase_url = context.wikibase_url if wikibase_url is None else wikibase_url
+            concept_base_uri = context.concept_base_uri if concept_base_uri is None else concept_base_uri
+            property_constraint_pid = context.property_constraint_pid if property_constraint_pid is None \
+                else property_constraint_pid
+            distinct_values_constraint_qid = context.distinct_values_constraint_qid \
+                if distinct_values_constraint_qid is None else distinct_values_constraint_qid
+
         self.core_prop_match_thresh = core_prop_match_thresh
         self.wd_item_id = wd_item_id
         self.new_item = new_item
@@ -399,6 +644,10 @@ class WDItemEngine(object):
         self.fast_run_base_filter = fast_run_base_filter
         self.fast_run_use_refs = fast_run_use_refs
         self.fast_run_case_insensitive = fast_run_case_insensitive
+        self.fast_run_snapshot_dir = fast_run_snapshot_dir
+        self.fast_run_compact = fast_run_compact
+        self.fast_run_qids = fast_run_qids
+        self.fast_run_unindexed_props = fast_run_unindexed_props
         self.ref_handler = ref_handler
         self.global_ref_mode = global_ref_mode
         self.good_refs = good_refs
@@ -409,8 +658,11 @@ class WDItemEngine(object):
 
         self.create_new_item = False
         self.wd_json_representation = {}
-        self.statements = []
-        self.original_statements = []
+        # the claims json the item was loaded with, from which the statements are built on first use
+        self._claims_json = dict()
+        self._prop_statements = dict()
+        self._statements = []
+        self._original_statements = []
         self.entity_metadata = {}
         self.fast_run_container = None
         self.require_write = True
@@ -427,19 +679,14 @@ class WDItemEngine(object):
         if self.global_ref_mode == "CUSTOM" and self.ref_handler is None:
             raise ValueError("If using a custom ref mode, ref_handler must be set")
 
-        if (core_props is None) and (self.sparql_endpoint_url not in self.DISTINCT_VALUE_PROPS):
-            self.get_distinct_value_props(self.sparql_endpoint_url, self.wikibase_url, self.property_constraint_pid,
-                                          self.distinct_values_constraint_qid)
-        self.core_props = core_props if core_props is not None else self.DISTINCT_VALUE_PROPS[self.sparql_endpoint_url]
+        self.context = context if context is not None else get_context(
+            self.__class__, self.sparql_endpoint_url, self.mediawiki_api_url, self.wikibase_url, self.concept_base_uri,
+            self.property_constraint_pid, self.distinct_values_constraint_qid)
+        self.core_props = core_props if core_props is not None else self.context.core_props
 
-        try:
-            self.mrh = MappingRelationHelper(self.sparql_endpoint_url)
-        except Exception as e:
-            # if the "equivalent property" and "mappingRelation" property are not found, we can't know what the
-            # QIDs for the mapping relation types are
-            self.mrh = None
-            if self.debug:
-                warnings.warn("mapping relation types are being ignored")
+        self.mrh = self.context.mrh
+        if self.mrh is None and self.debug:
+            warnings.warn("mapping relation types are being ignored")
 
         if self.fast_run:
             self.init_fastrun()
@@ -522,13 +769,15 @@ class WDItemEngine(object):
 
     def init_fastrun(self):
         # We search if we already have a FastRunContainer with the same parameters to re-use it
-        for c in WDItemEngine.fast_run_store:
-            if (c.base_filter == self.fast_run_base_filter) and (c.use_refs == self.fast_run_use_refs) and \
-                    (c.sparql_endpoint_url == self.sparql_endpoint_url):
-                self.fast_run_container = c
-                self.fast_run_container.ref_handler = self.ref_handler
-                if self.debug:
-                    print('Found an already existing FastRunContainer')
+        c = self.context.find_fastrun_container(self.fast_run_base_filter, self.fast_run_use_refs, self.fast_run_qids,
+                                                self.fast_run_unindexed_props)
+        if c:
+            self.fast_run_container = c
+            self.fast_run_container.ref_handler = self.ref_handler
+            if self.fast_run_qids:
+                self.fast_run_container.add_target_qids(self.fast_run_qids)
+            if self.debug:
+                print('Found an already existing FastRunContainer')
 
         if not self.fast_run_container:
             self.fast_run_container = FastRunContainer(base_filter=self.fast_run_base_filter,
@@ -541,9 +790,18 @@ class WDItemEngine(object):
                                                        use_refs=self.fast_run_use_refs,
                                                        ref_handler=self.ref_handler,
                                                        case_insensitive=self.fast_run_case_insensitive,
+                                                       compact=self.fast_run_compact,
+                                                       qids=self.fast_run_qids,
+                                                       unindexed_props=self.fast_run_unindexed_props,
                                                        debug=self.debug)
+            if self.fast_run_snapshot_dir:
+                self.fast_run_container.load_snapshot(self.fast_run_snapshot_dir)
+            self.context.fast_run_store.append(self.fast_run_container)
             WDItemEngine.fast_run_store.append(self.fast_run_container)
 
+        # load all properties of this item in one go, instead of one query per property
+        self.fast_run_container.prefetch(x.get_prop_nr() for x in self.data if x.get_value() or x.data_type)
+
         if not self.search_only:
             self.require_write = self.fast_run_container.write_required(self.data, append_props=self.append_value,
                                                                         cqid=self.wd_item_id)
@@ -556,6 +814,18 @@ class WDItemEngine(object):
             if not self.wd_item_id:
                 self.wd_item_id = self.fast_run_container.current_qid
 
+    @classmethod
+    def save_fastrun_snapshots(cls, snapshot_dir):
+        """
+        Write all fastrun containers created in this process to `snapshot_dir`. Pass the same directory as
+        `fast_run_snapshot_dir` in a later run to skip the full reload of the fastrun data.
+
+        :param snapshot_dir: the directory to write the snapshots to
+        :type snapshot_dir: str
+        :return: list of the snapshot file paths
+        """
+        return [c.save_snapshot(snapshot_dir) for c in cls.fast_run_store]
+
     def rollback(self, login, bot_account=True, summary=""):
         """
 
@@ -614,18 +884,74 @@ class WDItemEngine(object):
         self.sitelinks = wd_json.get('sitelinks', dict())
         self.pageid = wd_json.get('pageid')
 
-        self.statements = []
-        for prop in wd_data['claims']:
-            for z in wd_data['claims'][prop]:
-                data_type = [x for x in WDBaseDataType.__subclasses__() if x.DTYPE == z['mainsnak']['datatype']][0]
-                statement = data_type.from_json(z)
-                self.statements.append(statement)
+        # the statements are built from the claims when they are first used, see `statements`. The claims json is
+        # never modified, so it also serves as the snapshot of the original statements.
+        self._claims_json = wd_data['claims']
+        self._reset_statements()
+        self._original_statements = None
 
         self.wd_json_representation = wd_data
-        self.original_statements = copy.deepcopy(self.statements)
 
         return wd_data
 
+    def _reset_statements(self):
+        self._statements = None
+        self._prop_statements = dict()
+
+    def _build_statements(self, prop_nr):
+        return [_datatype_class(z['mainsnak']['datatype']).from_json(z) for z in self._claims_json.get(prop_nr, [])]
+
+    @property
+    def statements(self):
+        """
+        The statements of the item, as WDBaseDataType objects. When the item was loaded from json, they are built
+        on first access.
+        """
+        if self._statements is None:
+            statements = []
+            for prop_nr in self._claims_json:
+                statements.extend(self.get_property_statements(prop_nr))
+            self._statements = statements
+            self._prop_statements = dict()
+        return self._statements
+
+    @statements.setter
+    def statements(self, statements):
+        self._statements = statements
+        self._prop_statements = dict()
+
+    @property
+    def original_statements(self):
+        """
+        The statements of the item as it was loaded, which `update` starts from. Built from the claims json on first
+        access, independent of `statements`.
+        """
+        if self._original_statements is None:
+            self._original_statements = [s for prop_nr in self._claims_json for s in self._build_statements(prop_nr)]
+        return self._original_statements
+
+    @original_statements.setter
+    def original_statements(self, statements):
+        # the claims json doesn't match the original statements any more, so the statements are built before it's
+        # dropped
+        self._statements = self.statements
+        self._original_statements = statements
+        self._claims_json = None
+
+    def get_property_statements(self, prop_nr):
+        """
+        The statements of one property. Unlike `statements`, this only builds the statements of `prop_nr` if the
+        item was loaded from json and the statements weren't used yet.
+
+        :param prop_nr: the property ID, e.g. 'P31'
+        :return: list of WDBaseDataType objects, in the order of the item
+        """
+        if self._statements is not None:
+            return [x for x in self._statements if x.get_prop_nr() == prop_nr]
+        if prop_nr not in self._prop_statements:
+            self._prop_statements[prop_nr] = self._build_statements(prop_nr)
+        return self._prop_statements[prop_nr]
+
     @staticmethod
     def get_wd_search_results(search_string='', mediawiki_api_url=None,
                               user_agent=None, max_results=500,
@@ -671,7 +997,7 @@ class WDItemEngine(object):
         while cont_count > 0:
             params.update({'continue': 0 if cont_count == 1 else cont_count})
 
-            reply = requests.get(mediawiki_api_url, params=params, headers=headers)
+            reply = get_transport().get(mediawiki_api_url, params=params, headers=headers)
             reply.raise_for_status()
             search_results = reply.json()
 
@@ -704,6 +1030,8 @@ class WDItemEngine(object):
 
         :return: a list of WD property ID strings (Pxxxx).
         """
+        if self._statements is None:
+            return list(self._claims_json)
         property_list = set()
         for x in self.statements:
             property_list.add(x.get_prop_nr())
@@ -712,7 +1040,9 @@ class WDItemEngine(object):
 
     def __select_wd_item(self):
         """
-        The most likely WD item QID should be returned, after querying WDQ for all values in core_id properties
+        The most likely WD item QID should be returned, after querying WDQ for all values in core_id properties. The
+        values are looked up in the core prop index of the context where it has them, and with a single query
+        otherwise.
 
         :return: Either a single WD QID is returned, or an empty string if no suitable item in WD
         """
@@ -729,6 +1059,7 @@ class WDItemEngine(object):
             exact_qid = "Q0"
             mrt_pid = "PXXX"
 
+        lookups = []
         for statement in self.data:
             wd_property = statement.get_prop_nr()
 
@@ -742,30 +1073,23 @@ class WDItemEngine(object):
             if isinstance(data_point, tuple):
                 data_point = data_point[0]
 
-            core_props = self.core_props
-            if wd_property in core_props:
-                tmp_qids = set()
-                # if mrt_pid is "PXXX", this is fine, because the part of the SPARQL query using it is optional
-                query = statement.sparql_query.format(wb_url=self.wikibase_url, mrt_pid=mrt_pid, pid=wd_property,
-                                                      value=data_point.replace("'", r"\'"))
-                results = WDItemEngine.execute_sparql_query(query=query, endpoint=self.sparql_endpoint_url)
+            if wd_property in self.core_props:
+                lookups.append((statement, data_point))
 
-                for i in results['results']['bindings']:
-                    qid = i['item_id']['value'].split('/')[-1]
-                    if ('mrt' not in i) or ('mrt' in i and i['mrt']['value'].split('/')[-1] == exact_qid):
-                        tmp_qids.add(qid)
-
-                qid_list.update(tmp_qids)
+        for (statement, data_point), tmp_qids in zip(lookups, self.__find_core_prop_items(lookups, mrt_pid,
+                                                                                           exact_qid)):
+            wd_property = statement.get_prop_nr()
+            qid_list.update(tmp_qids)
 
-                # Protocol in what property the conflict arises
-                if wd_property in conflict_source:
-                    conflict_source[wd_property].append(tmp_qids)
-                else:
-                    conflict_source[wd_property] = [tmp_qids]
+            # Protocol in what property the conflict arises
+            if wd_property in conflict_source:
+                conflict_source[wd_property].append(tmp_qids)
+            else:
+                conflict_source[wd_property] = [tmp_qids]
 
-                if len(tmp_qids) > 1:
-                    raise ManualInterventionReqException(
-                        'More than one WD item has the same property value', wd_property, tmp_qids)
+            if len(tmp_qids) > 1:
+                raise ManualInterventionReqException(
+                    'More than one WD item has the same property value', wd_property, tmp_qids)
 
         if len(qid_list) == 0:
             self.create_new_item = True
@@ -781,12 +1105,61 @@ class WDItemEngine(object):
         elif len(unique_qids) == 1:
             return list(unique_qids)[0]
 
+    def __find_core_prop_items(self, lookups, mrt_pid, exact_qid):
+        """
+        Find the items having core prop values, with one query for all values that aren't in the core prop index. The
+        SPARQL result cache is not used, an outdated result could lead to a duplicate item.
+
+        :param lookups: list of tuples of a statement and the value to look up
+        :return: list of sets of QIDs, one for each lookup
+        """
+        def item_qids(bindings):
+            return [(i, i['item_id']['value'].split('/')[-1]) for i in bindings
+                    if ('mrt' not in i) or ('mrt' in i and i['mrt']['value'].split('/')[-1] == exact_qid)]
+
+        index = self.context.core_prop_index
+        found = [set() for _ in lookups]
+        # the rows of the VALUES block of the query, and the lookups of each row
+        rows = dict()
+        for n, (statement, data_point) in enumerate(lookups):
+            wd_property = statement.get_prop_nr()
+            if wd_property in index:
+                qids = index[wd_property].get(data_point, set())
+                found[n].update({qids} if isinstance(qids, str) else qids)
+                continue
+
+            # if mrt_pid is "PXXX", this is fine, because the part of the SPARQL query using it is optional
+            query = statement.sparql_query.format(wb_url=self.wikibase_url, mrt_pid=mrt_pid, pid=wd_property,
+                                                  value=str(data_point).replace("'", r"\'"))
+            m = _sparql_value_re.search(query)
+            if m:
+                rows.setdefault((wd_property, m.group(1)), []).append(n)
+            else:
+                # the query of the datatype has another form, so the value is looked up on its own
+                results = WDItemEngine.execute_sparql_query(query=query, endpoint=self.sparql_endpoint_url,
+                                                            use_cache=False)
+                found[n].update(qid for i, qid in item_qids(results['results']['bindings']))
+
+        if rows:
+            values = ' '.join('({} p:{} ps:{} {})'.format(k, pid, pid, term) for k, (pid, term) in enumerate(rows))
+            query = self.core_props_query.format(wb_url=self.wikibase_url, mrt_pid=mrt_pid, values=values)
+            results = WDItemEngine.execute_sparql_query(query=query, endpoint=self.sparql_endpoint_url,
+                                                        use_cache=False)
+            positions = list(rows.values())
+            for i, qid in item_qids(results['results']['bindings']):
+                for n in positions[int(i['row']['value'])]:
+                    found[n].add(qid)
+        return found
+
     def __construct_claim_json(self):
         """
         Writes the properties from self.data to a new or existing json in self.wd_json_representation
 
         :return: None
         """
+        if not self.data and self._statements is None:
+            # nothing to merge: the claims json stays as loaded, without building the statements
+            return
 
         def handle_qualifiers(old_item, new_item):
             if not new_item.check_qualifier_equality:
@@ -794,8 +1167,7 @@ class WDItemEngine(object):
 
         def is_good_ref(ref_block):
 
-            if len(WDItemEngine.databases) == 0:
-                WDItemEngine._init_ref_system()
+            databases = self.context.databases
 
             prop_nrs = [x.get_prop_nr() for x in ref_block]
             values = [x.get_value() for x in ref_block]
@@ -835,10 +1207,10 @@ class WDItemEngine(object):
                 pn = ref.get_prop_nr()
                 value = ref.get_value()
 
-                if pn == 'P248' and value not in WDItemEngine.databases and 'P854' not in prop_nrs:
+                if pn == 'P248' and value not in databases and 'P854' not in prop_nrs:
                     return False
-                elif pn == 'P248' and value in WDItemEngine.databases:
-                    db_props = WDItemEngine.databases[value]
+                elif pn == 'P248' and value in databases:
+                    db_props = databases[value]
                     if not any([False if x not in prop_nrs else True for x in db_props]) and 'P854' not in prop_nrs:
                         return False
 
@@ -895,55 +1267,53 @@ class WDItemEngine(object):
         self.data.sort(key=lambda z: z.get_prop_nr().lower())
 
         # collect all statements which should be deleted
-        statements_for_deletion = []
+        statements_for_deletion = set()
         for item in self.data:
             if item.get_value() == '' and isinstance(item, WDBaseDataType):
-                statements_for_deletion.append(item.get_prop_nr())
+                statements_for_deletion.add(item.get_prop_nr())
 
         if self.create_new_item:
-            self.statements = copy.copy(self.data)
+            index = _StatementIndex(self.data)
         else:
+            index = _StatementIndex(self.statements)
+            # properties whose existing statements were set for removal
+            marked = set()
             for stat in self.data:
                 prop_nr = stat.get_prop_nr()
 
-                prop_data = [x for x in self.statements if x.get_prop_nr() == prop_nr]
-                prop_pos = [x.get_prop_nr() == prop_nr for x in self.statements]
-                prop_pos.reverse()
-                insert_pos = len(prop_pos) - (prop_pos.index(True) if any(prop_pos) else 0)
-
                 # If value should be appended, check if values exists, if not, append
                 if prop_nr in self.append_value:
-                    equal_items = [stat == x for x in prop_data]
-                    if True not in equal_items:
-                        self.statements.insert(insert_pos + 1, stat)
+                    current_item = next((x for x in index.candidates(stat) if stat == x), None)
+                    if current_item is None:
+                        index.insert(stat)
                     else:
                         # if item exists, modify rank
-                        current_item = prop_data[equal_items.index(True)]
                         current_item.set_rank(stat.get_rank())
                         handle_references(old_item=current_item, new_item=stat)
                         handle_qualifiers(old_item=current_item, new_item=stat)
                     continue
 
-                # set all existing values of a property for removal
-                for x in prop_data:
-                    # for deletion of single statements, do not set all others to delete
-                    if hasattr(stat, 'remove'):
-                        break
-                    elif x.get_id() and not hasattr(x, 'retain'):
-                        # keep statements with good references if keep_good_ref_statements is True
-                        if self.keep_good_ref_statements:
-                            if any([is_good_ref(r) for r in x.get_references()]):
-                                setattr(x, 'retain', '')
-                        else:
-                            setattr(x, 'remove', '')
-
-                match = []
-                for i in prop_data:
+                # set all existing values of a property for removal, once per property. For deletion of single
+                # statements, do not set all others to delete
+                if not hasattr(stat, 'remove') and prop_nr not in marked:
+                    marked.add(prop_nr)
+                    for x in index.get(prop_nr):
+                        if x.get_id() and not hasattr(x, 'retain'):
+                            # keep statements with good references if keep_good_ref_statements is True
+                            if self.keep_good_ref_statements:
+                                if any([is_good_ref(r) for r in x.get_references()]):
+                                    setattr(x, 'retain', '')
+                            else:
+                                setattr(x, 'remove', '')
+
+                # only statements with the same value can be equal
+                match = False
+                for i in index.candidates(stat):
                     if stat == i and hasattr(stat, 'remove'):
-                        match.append(True)
+                        match = True
                         setattr(i, 'remove', '')
                     elif stat == i:
-                        match.append(True)
+                        match = True
                         setattr(i, 'retain', '')
                         if hasattr(i, 'remove'):
                             delattr(i, 'remove')
@@ -951,19 +1321,20 @@ class WDItemEngine(object):
                         handle_qualifiers(old_item=i, new_item=stat)
 
                         i.set_rank(rank=stat.get_rank())
-                    # if there is no value, do not add an element, this is also used to delete whole properties.
-                    elif i.get_value():
-                        match.append(False)
 
-                if True not in match and not hasattr(stat, 'remove'):
-                    self.statements.insert(insert_pos + 1, stat)
+                if not match and not hasattr(stat, 'remove'):
+                    index.insert(stat)
+                    if stat.get_id():
+                        # a statement with an ID is set for removal by the next statement of the property
+                        marked.discard(prop_nr)
+
+        # For whole property deletions, drop the statements which are not on the item yet
+        for prop_nr in statements_for_deletion:
+            for item in index.get(prop_nr):
+                if item.get_id() == '':
+                    index.remove(item)
 
-        # For whole property deletions, add remove flag to all statements which should be deleted
-        for item in copy.deepcopy(self.statements):
-            if item.get_prop_nr() in statements_for_deletion and item.get_id() != '':
-                setattr(item, 'remove', '')
-            elif item.get_prop_nr() in statements_for_deletion:
-                self.statements.remove(item)
+        self.statements = index.to_list()
 
         # regenerate claim json
         self.wd_json_representation['claims'] = {}
@@ -994,7 +1365,11 @@ class WDItemEngine(object):
             self.append_value.extend(append_value)
 
         self.data.extend(data)
-        self.statements = copy.deepcopy(self.original_statements)
+        if self._claims_json is not None:
+            # start over from the claims json, which is cheaper than copying the original statements
+            self._reset_statements()
+        else:
+            self.statements = copy.deepcopy(self.original_statements)
 
         if self.debug:
             print(self.data)
@@ -1336,7 +1711,7 @@ class WDItemEngine(object):
         rdfdata = wdi_rdf.WDqidRDFEngine(qid=self.wd_item_id, json_data=self.get_wd_json_representation(), max_steps=max_steps, current_step = 0).rdf_item
 
         entity_schema_repo = config["ENTITY_SCHEMA_REPO"] if entity_schema_repo is None else entity_schema_repo
-        schema = requests.get(entity_schema_repo+eid).text
+        schema = get_transport().get(entity_schema_repo+eid).text
 
         for result in ShExEvaluator(rdf=rdfdata, schema=schema, focus=config["CONCEPT_BASE_URI"] + self.wd_item_id).evaluate():
             shex_result = dict()
@@ -1360,7 +1735,8 @@ class WDItemEngine(object):
         """
         :param method: 'GET' or 'POST'
         :param mediawiki_api_url:
-        :param session: If a session is passed, it will be used. Otherwise a new requests session is created
+        :param session: If a session is passed, it will be used. Otherwise the shared transport is used, see
+        wdi_transport
         :param max_retries: If api request fails due to rate limiting, maxlag, or readonly mode, retry up to
         `max_retries` times
         :type max_retries: int
@@ -1373,7 +1749,7 @@ class WDItemEngine(object):
         mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
 
         response = None
-        session = session if session else requests.session()
+        session = session if session else get_transport()
         for n in range(max_retries):
             try:
                 response = session.request(method, mediawiki_api_url, **kwargs)
@@ -1388,34 +1764,10 @@ class WDItemEngine(object):
 
             response.raise_for_status()
             json_data = response.json()
-            """
-            wikidata api response has code = 200 even if there are errors.
-            rate limit doesn't return HTTP 429 either. may in the future
-            https://phabricator.wikimedia.org/T172293
-            """
-            if 'error' in json_data:
-                # rate limiting
-                error_msg_names = set()
-                if 'messages' in json_data['error']:
-                    error_msg_names = set(x.get('name') for x in json_data["error"]['messages'])
-                if 'actionthrottledtext' in error_msg_names:
-                    sleep_sec = int(response.headers.get('retry-after', retry_after))
-                    print("{}: rate limited. sleeping for {} seconds".format(datetime.datetime.utcnow(), sleep_sec))
-                    time.sleep(sleep_sec)
-                    continue
-
-                # maxlag
-                if 'code' in json_data['error'] and json_data['error']['code'] == 'maxlag':
-                    sleep_sec = json_data['error'].get('lag', retry_after)
-                    print("{}: maxlag. sleeping for {} seconds".format(datetime.datetime.utcnow(), sleep_sec))
-                    time.sleep(sleep_sec)
-                    continue
-
-                # readonly
-                if 'code' in json_data['error'] and json_data['error']['code'] == 'readonly':
-                    print('Wikidata currently is in readonly mode, waiting for {} seconds'.format(retry_after))
-                    time.sleep(retry_after)
-                    continue
+            sleep_sec = WDItemEngine._mediawiki_retry_delay(response, json_data, retry_after)
+            if sleep_sec is not None:
+                time.sleep(sleep_sec)
+                continue
 
             # there is no error or waiting. break out of this loop and parse response
             break
@@ -1427,6 +1779,38 @@ class WDItemEngine(object):
 
         return json_data
 
+    @staticmethod
+    def _mediawiki_retry_delay(response, json_data, retry_after=60):
+        """
+        Check a mediawiki api response for errors that go away by waiting: rate limiting, maxlag and readonly mode
+
+        :return: the number of seconds to wait before sending the request again, or None
+        """
+        # wikidata api response has code = 200 even if there are errors.
+        # rate limit doesn't return HTTP 429 either. may in the future
+        # https://phabricator.wikimedia.org/T172293
+        if 'error' in json_data:
+            # rate limiting
+            error_msg_names = set()
+            if 'messages' in json_data['error']:
+                error_msg_names = set(x.get('name') for x in json_data["error"]['messages'])
+            if 'actionthrottledtext' in error_msg_names:
+                sleep_sec = int(response.headers.get('retry-after', retry_after))
+                print("{}: rate limited. sleeping for {} seconds".format(datetime.datetime.utcnow(), sleep_sec))
+                return sleep_sec
+
+            # maxlag
+            if 'code' in json_data['error'] and json_data['error']['code'] == 'maxlag':
+                sleep_sec = json_data['error'].get('lag', retry_after)
+                print("{}: maxlag. sleeping for {} seconds".format(datetime.datetime.utcnow(), sleep_sec))
+                return sleep_sec
+
+            # readonly
+            if 'code' in json_data['error'] and json_data['error']['code'] == 'readonly':
+                print('Wikidata currently is in readonly mode, waiting for {} seconds'.format(retry_after))
+                return retry_after
+        return None
+
     @classmethod
     def setup_logging(cls, log_dir="./logs", log_name=None, header=None, names=None,
                       delimiter=";", logger_name='WD_logger'):
@@ -1507,6 +1891,7 @@ class WDItemEngine(object):
         A method which allows for retrieval of a list of Wikidata items or properties. The method generates a list of
         tuples where the first value in the tuple is the QID or property ID, whereas the second is the new instance of
         WDItemEngine containing all the data of the item. This is most useful for mass retrieval of WD items.
+        Items that don't exist are left out, see `iter_item_instances` to find out which.
 
         :param items: A list of QIDs or property IDs
         :type items: list
@@ -1518,39 +1903,28 @@ class WDItemEngine(object):
         :return: A list of tuples, first value in the tuple is the QID or property ID string, second value is the
             instance of WDItemEngine with the corresponding item data.
         """
+        return list(cls.iter_item_instances(items, mediawiki_api_url=mediawiki_api_url, login=login,
+                                            user_agent=user_agent))
 
-        mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
-        user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
-
-        assert type(items) == list
-
-        url = mediawiki_api_url
-        params = {
-            'action': 'wbgetentities',
-            'ids': '|'.join(items),
-            'format': 'json'
-        }
-        headers = {
-            'User-Agent': user_agent
-        }
-
-        if login:
-            reply = login.get_session().get(url, params=params, headers=headers)
-        else:
-            reply = requests.get(url, params=params)
-
-        item_instances = []
-        for qid, v in reply.json()['entities'].items():
-            ii = cls(wd_item_id=qid, item_data=v)
-            ii.mediawiki_api_url = mediawiki_api_url
-            item_instances.append((qid, ii))
+    @classmethod
+    def iter_item_instances(cls, items, mediawiki_api_url=None, login=None, user_agent=None, loader=None):
+        """
+        Like `generate_item_instances`, but for any number of items, which are fetched in parallel batches and
+        returned as they arrive, see wdi_entity_loader
 
-        return item_instances
+        :param items: iterable of QIDs or property IDs
+        :param loader: A WDEntityLoader, whose `missing` and `redirects` tell which IDs don't exist or were redirected
+        :type loader: wdi_entity_loader.WDEntityLoader
+        :return: generator of tuples of the QID or property ID and the instance of the class with the item data
+        """
+        if loader is None:
+            loader = WDEntityLoader(cls, mediawiki_api_url=mediawiki_api_url, login=login, user_agent=user_agent)
+        return loader.load(items)
 
     @staticmethod
-    @wdi_backoff()
     def execute_sparql_query(query, prefix=None, endpoint=None,
-                             user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60):
+                             user_agent=None, as_dataframe=False, max_retries=1000, retry_after=60, use_cache=True,
+                             result_format='json', query_class='lookup'):
         """
         Static method which can be used to execute any SPARQL query
 
@@ -1562,67 +1936,41 @@ class WDItemEngine(object):
         :type user_agent: str
         :param max_retries: The number time this function should retry in case of header reports.
         :param retry_after: the number of seconds should wait upon receiving either an error code or the WDQS is not reachable.
+        :param use_cache: Look up and store the results in the SPARQL result cache, if caching is enabled (see
+            wdi_sparql_cache)
+        :param result_format: The format the endpoint is asked to send the results in, 'json', 'tsv' or 'csv'. The
+            results are returned in JSON format either way, see `wdi_sparql_results`. 'csv' results only have values.
+        :param query_class: 'lookup' or 'bulk', the class of the query for routing it to a mirror of the endpoint, see
+            wdi_sparql_router
         :return: The results of the query are returned in JSON format
         """
+        return WDFunctionsEngine.execute_sparql_query(query, prefix=prefix, endpoint=endpoint, user_agent=user_agent,
+                                                      as_dataframe=as_dataframe, max_retries=max_retries,
+                                                      retry_after=retry_after, use_cache=use_cache,
+                                                      result_format=result_format, query_class=query_class)
 
-        sparql_endpoint_url = config['SPARQL_ENDPOINT_URL'] if endpoint is None else endpoint
-        user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
-
-        if prefix:
-            query = prefix + '\n' + query
-
-        params = {
-            'query': '#Tool: wdi_core fastrun\n' + query,
-            'format': 'json'
-        }
-
-        headers = {
-            'Accept': 'application/sparql-results+json',
-            'User-Agent': user_agent
-        }
-        response = None
-
-        for n in range(max_retries):
-            try:
-                response = requests.post(sparql_endpoint_url, params=params, headers=headers)
-            except requests.exceptions.ConnectionError as e:
-                print("Connection error: {}. Sleeping for {} seconds.".format(e, retry_after))
-                time.sleep(retry_after)
-                continue
-            if response.status_code == 503:
-                print("service unavailable. sleeping for {} seconds".format(retry_after))
-                time.sleep(retry_after)
-                continue
-            if response.status_code == 429:
-                if "retry-after" in response.headers.keys():
-                    retry_after = response.headers["retry-after"]
-                print("service unavailable. sleeping for {} seconds".format(retry_after))
-                time.sleep(retry_after)
-                continue
-            response.raise_for_status()
-            results = response.json()
+    @staticmethod
+    def execute_sparql_query_iter(query, prefix=None, endpoint=None, user_agent=None, as_dataframe=False,
+                                  chunk_size=10000, max_retries=1000, retry_after=60, use_cache=True,
+                                  result_format='json', query_class='bulk'):
+        """
+        Static method which can be used to execute a SPARQL query with a large result, see
+        `WDFunctionsEngine.execute_sparql_query_iter`
 
-            if as_dataframe:
-                return WDItemEngine._sparql_query_result_to_df(results)
-            else:
-                return results
+        :return: generator of bindings, or of dataframes of up to `chunk_size` results
+        """
+        return WDFunctionsEngine.execute_sparql_query_iter(query, prefix=prefix, endpoint=endpoint,
+                                                           user_agent=user_agent, as_dataframe=as_dataframe,
+                                                           chunk_size=chunk_size, max_retries=max_retries,
+                                                           retry_after=retry_after, use_cache=use_cache,
+                                                           result_format=result_format, query_class=query_class)
 
     @staticmethod
-    def _sparql_query_result_to_df(results):
-
-        def parse_value(item):
-            if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#decimal":
-                return float(item['value'])
-            if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#integer":
-                return int(item['value'])
-            if item.get("datatype") == "http://www.w3.org/2001/XMLSchema#dateTime":
-                return datetime.datetime.strptime(item['value'], '%Y-%m-%dT%H:%M:%SZ')
-            return item['value']
-
-        results = results['results']['bindings']
-        results = [{k: parse_value(v) for k, v in item.items()} for item in results]
-        df = pd.DataFrame(results)
-        return df
+    def _sparql_query_result_to_df(results, strip_prefix=False, categorical=False, arrow=False):
+        """
+        :return: the results of a SPARQL query as a pandas dataframe, see `wdi_sparql_results.results_to_df`
+        """
+        return results_to_df(results, strip_prefix=strip_prefix, categorical=categorical, arrow=arrow)
 
     @staticmethod
     def get_linked_by(qid, mediawiki_api_url=None):
@@ -1635,13 +1983,13 @@ class WDItemEngine(object):
         mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
 
         linkedby = []
-        whatlinkshere = json.loads(requests.get(
+        whatlinkshere = json.loads(get_transport().get(
             mediawiki_api_url + "?action=query&list=backlinks&format=json&bllimit=500&bltitle=" + qid).text)
         for link in whatlinkshere["query"]["backlinks"]:
             if link["title"].startswith("Q"):
                 linkedby.append(link["title"])
         while 'continue' in whatlinkshere.keys():
-            whatlinkshere = json.loads(requests.get(
+            whatlinkshere = json.loads(get_transport().get(
                 mediawiki_api_url + "?action=query&list=backlinks&blcontinue=" +
                 whatlinkshere['continue']['blcontinue'] + "&format=json&bllimit=50&bltitle=" + "Q42").text)
             for link in whatlinkshere["query"]["backlinks"]:
@@ -1704,7 +2052,7 @@ class WDItemEngine(object):
 
         try:
             # TODO: should we retry this?
-            merge_reply = requests.post(url=url, data=params, headers=headers, cookies=login_obj.get_edit_cookie())
+            merge_reply = get_transport().post(url=url, data=params, headers=headers, cookies=login_obj.get_edit_cookie())
             merge_reply.raise_for_status()
 
             if 'error' in merge_reply.json():
@@ -1767,7 +2115,7 @@ class WDItemEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     @staticmethod
@@ -1784,7 +2132,7 @@ class WDItemEngine(object):
         headers = {
             'User-Agent': user_agent
         }
-        r = requests.post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
+        r = get_transport().post(url=mediawiki_api_url, data=params, cookies=login.get_edit_cookie(), headers=headers)
         print(r.json())
 
     ## References
@@ -1883,7 +2231,7 @@ class JsonParser(object):
                             ref_class.snak_type = prop_ref['snaktype']
                             ref_class.set_hash(ref_hash)
 
-                            self.references[count].append(copy.deepcopy(ref_class))
+                            self.references[count].append(ref_class)
 
                             # print(self.references)
             if 'qualifiers' in json_representation:
@@ -1915,12 +2263,127 @@ class JsonParser(object):
             return self.get_class_representation(jsn=self.json_representation)
 
     def get_class_representation(self, jsn):
-        data_type = [x for x in WDBaseDataType.__subclasses__() if x.DTYPE == jsn['datatype']][0]
+        data_type = _datatype_class(jsn['datatype'])
         self.final = True
         self.current_type = data_type
         return data_type.from_json(jsn)
 
 
+_unhashable = object()
+# the value in the triple of the statement of a datatype's sparql_query
+_sparql_value_re = re.compile(r'^\s*\?s\s+(?:ps:\w+|<[^>]*/prop/statement/\w+>)\s+(.+?)\s*\.\s*$', re.MULTILINE)
+
+
+class _StatementIndex(object):
+    """
+    The statements of an item, indexed by property and value for __construct_claim_json. The statements are kept as
+    a linked list, so that a new statement is placed in constant time where a list insert would put it.
+    """
+
+    def __init__(self, statements):
+        self.statements = []
+        self.next = []
+        self.head = -1
+        self.tail = -1
+        self.removed = set()
+        # property ID to the positions of its statements in list order
+        self.props = dict()
+        # property ID to a dict of value to positions. None if the property has an unhashable value
+        self.values = dict()
+        for stat in statements:
+            self._add(stat, self.tail)
+
+    @staticmethod
+    def _key(stat):
+        value = stat.get_value()
+        try:
+            hash(value)
+        except TypeError:
+            return _unhashable
+        return value
+
+    def _add(self, stat, after):
+        # add stat to the list after the position `after`
+        n = len(self.statements)
+        self.statements.append(stat)
+        self.next.append(-1)
+        if self.head == -1:
+            self.head = n
+        else:
+            self.next[n] = self.next[after]
+            self.next[after] = n
+        if after == self.tail:
+            self.tail = n
+
+        prop_nr = stat.get_prop_nr()
+        self.props.setdefault(prop_nr, []).append(n)
+        values = self.values.setdefault(prop_nr, dict())
+        key = self._key(stat)
+        if key is _unhashable:
+            self.values[prop_nr] = None
+        elif values is not None:
+            values.setdefault(key, []).append(n)
+
+    def insert(self, stat):
+        """
+        Add stat after the statement following the last one of its property, or else at the end
+        """
+        positions = self.props.get(stat.get_prop_nr())
+        after = self.tail
+        if positions and self.next[positions[-1]] != -1:
+            after = self.next[positions[-1]]
+        self._add(stat, after)
+
+    def get(self, prop_nr):
+        """
+        :return: list of the statements of a property, in list order
+        """
+        return [self.statements[n] for n in self.props.get(prop_nr, [])]
+
+    def _candidate_positions(self, stat):
+        prop_nr = stat.get_prop_nr()
+        values = self.values.get(prop_nr)
+        key = self._key(stat)
+        if values is None or key is _unhashable:
+            return self.props.get(prop_nr, [])
+        return values.get(key, [])
+
+    def candidates(self, stat):
+        """
+        :return: list of the statements that can be equal to stat, in list order
+        """
+        return [self.statements[n] for n in self._candidate_positions(stat)]
+
+    def remove(self, stat):
+        """
+        Remove the first statement in the list that is equal to stat, as list.remove does
+        """
+        for n in self._candidate_positions(stat):
+            if n not in self.removed and self.statements[n] == stat:
+                self.removed.add(n)
+                return
+
+    def to_list(self):
+        statements = []
+        n = self.head
+        while n != -1:
+            if n not in self.removed:
+                statements.append(self.statements[n])
+            n = self.next[n]
+        return statements
+
+
+_datatype_classes = dict()
+
+
+def _datatype_class(data_type):
+    # the WDBaseDataType subclass of a datatype, e.g. 'wikibase-item'
+    cls = _datatype_classes.get(data_type)
+    if cls is None:
+        cls = _datatype_classes[data_type] = [x for x in WDBaseDataType.__subclasses__() if x.DTYPE == data_type][0]
+    return cls
+
+
 class WDBaseDataType(object):
     """
     The base class for all Wikidata data types, they inherit from it
@@ -2028,8 +2491,8 @@ class WDBaseDataType(object):
     def has_equal_qualifiers(self, other):
         # check if the qualifiers are equal with the 'other' object
         equal_qualifiers = True
-        self_qualifiers = copy.deepcopy(self.get_qualifiers())
-        other_qualifiers = copy.deepcopy(other.get_qualifiers())
+        self_qualifiers = self.get_qualifiers()
+        other_qualifiers = other.get_qualifiers()
 
         if len(self_qualifiers) != len(other_qualifiers):
             equal_qualifiers = False
@@ -3650,6 +4113,19 @@ class NonUniqueLabelDescriptionPairError(WDApiError):
         return repr(self.wd_error_msg)
 
 
+class SparqlQueryTimeout(Exception):
+    def __init__(self, value):
+        """
+        The SPARQL endpoint gave up on a query because it took too long
+
+        :param value: the query
+        """
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
 class IDMissingError(Exception):
     def __init__(self, value):
         self.value = value
@@ -0,0 +1,169 @@
+"""
+Data shared by the engines working on one wikibase.
+
+Besides the item itself, a WDItemEngine needs data about the wikibase it works on: the core properties used to find
+items, the mapping relation type property and items, the databases used to judge references, property datatypes and
+the fastrun containers. An `EngineContext` loads each of these once, when it is first needed, and engines constructed
+with the context use them without any lookups of their own:
+
+    context = EngineContext(sparql_endpoint_url=..., mediawiki_api_url=..., core_props={'P352'})
+    for qid in qids:
+        item = wdi_core.WDItemEngine(wd_item_id=qid, context=context)
+
+Engines constructed without a context use the one `get_context` returns for their endpoint, which is shared by the
+whole process.
+
+Engines constructed without a wd_item_id find their item by the values of its core props, with a SPARQL query. With a
+`core_prop_index`, the values of the properties it has are looked up locally instead, e.g. with an index of a dump or
+one built with BatchResolver:
+
+    index = {'P352': BatchResolver('P352').values_to_qids(uniprot_ids, return_as_set=True)}
+    context = EngineContext(core_props={'P352'}, core_prop_index=index)
+"""
+
+import threading
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_fastrun import FastRunContainer
+from wikidataintegrator.wdi_helpers import MappingRelationHelper
+
+
+class EngineContext(object):
+    def __init__(self, engine=None, sparql_endpoint_url=None, mediawiki_api_url=None, wikibase_url=None,
+                 concept_base_uri=None, property_constraint_pid=None, distinct_values_constraint_qid=None,
+                 core_props=None, core_prop_index=None):
+        """
+        :param engine: the engine class whose queries load the data. Default WDItemEngine
+        :param sparql_endpoint_url: Default from config['SPARQL_ENDPOINT_URL']
+        :param mediawiki_api_url: Default from config['MEDIAWIKI_API_URL']
+        :param wikibase_url: Default from config['WIKIBASE_URL']
+        :param concept_base_uri: Default from config['CONCEPT_BASE_URI']
+        :param property_constraint_pid: Default from config['PROPERTY_CONSTRAINT_PID']
+        :param distinct_values_constraint_qid: Default from config['DISTINCT_VALUES_CONSTRAINT_QID']
+        :param core_props: set of PIDs used to find items, see `WDItemEngine`. Default are the properties with a
+            distinct values constraint, which are queried on first use
+        :param core_prop_index: dict of PIDs of core props to dicts of their values to the QID, or set of QIDs, of the
+            items having them. Values of these properties missing from the index are taken to be on no item
+        """
+        self.engine = wdi_core.WDItemEngine if engine is None else engine
+        self.sparql_endpoint_url = config['SPARQL_ENDPOINT_URL'] if sparql_endpoint_url is None else sparql_endpoint_url
+        self.mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
+        self.wikibase_url = config['WIKIBASE_URL'] if wikibase_url is None else wikibase_url
+        self.concept_base_uri = config['CONCEPT_BASE_URI'] if concept_base_uri is None else concept_base_uri
+        self.property_constraint_pid = config['PROPERTY_CONSTRAINT_PID'] if property_constraint_pid is None \
+            else property_constraint_pid
+        self.distinct_values_constraint_qid = config['DISTINCT_VALUES_CONSTRAINT_QID'] \
+            if distinct_values_constraint_qid is None else distinct_values_constraint_qid
+
+        self.core_prop_index = dict() if core_prop_index is None else core_prop_index
+
+        # fastrun containers created by engines of this context
+        self.fast_run_store = []
+        # property datatypes, the same dict the fastrun containers of this wikibase use
+        self.prop_datatypes = FastRunContainer.prop_datatype_cache[self.mediawiki_api_url]
+
+        self._core_props = core_props
+        self._mrh = None
+        self._mrh_loaded = False
+        self._lock = threading.RLock()
+
+    @property
+    def core_props(self):
+        """
+        The properties used to find items
+        """
+        if self._core_props is None:
+            with self._lock:
+                if self._core_props is None:
+                    props = self.engine.DISTINCT_VALUE_PROPS
+                    if self.sparql_endpoint_url not in props:
+                        self.engine.get_distinct_value_props(self.sparql_endpoint_url, self.wikibase_url,
+                                                             self.property_constraint_pid,
+                                                             self.distinct_values_constraint_qid)
+                    self._core_props = props[self.sparql_endpoint_url]
+        return self._core_props
+
+    @property
+    def mrh(self):
+        """
+        The MappingRelationHelper of the wikibase, or None if its mapping relation types can't be found
+        """
+        if not self._mrh_loaded:
+            with self._lock:
+                if not self._mrh_loaded:
+                    try:
+                        self._mrh = MappingRelationHelper(self.sparql_endpoint_url)
+                    except Exception:
+                        # if the "equivalent property" and "mappingRelation" property are not found, we can't know
+                        # what the QIDs for the mapping relation types are. This isn't tried again for every engine
+                        self._mrh = None
+                    self._mrh_loaded = True
+        return self._mrh
+
+    @property
+    def databases(self):
+        """
+        dict of the QIDs of databases to the PIDs of their identifiers, used to judge references
+        """
+        if len(self.engine.databases) == 0:
+            with self._lock:
+                if len(self.engine.databases) == 0:
+                    self.engine._init_ref_system()
+        return self.engine.databases
+
+    def find_fastrun_container(self, base_filter, use_refs, qids, unindexed_props):
+        """
+        :return: the fastrun container of this context with the same parameters, or None
+        """
+        unindexed_props = set(unindexed_props or [])
+        for c in self.fast_run_store:
+            if c.sparql_endpoint_url == self.sparql_endpoint_url and c.base_filter == base_filter and \
+                    c.use_refs == use_refs and (c.target_qids is None) == (qids is None) and \
+                    c.unindexed_props == unindexed_props:
+                return c
+        return None
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items()
+                           if not k.startswith('_') and k not in ('fast_run_store', 'prop_datatypes',
+                                                                  'core_prop_index')),
+        )
+
+
+_contexts = dict()
+_contexts_lock = threading.Lock()
+
+
+def get_context(engine, sparql_endpoint_url=None, mediawiki_api_url=None, wikibase_url=None, concept_base_uri=None,
+                property_constraint_pid=None, distinct_values_constraint_qid=None):
+    """
+    The context shared by the engines of a class working on a wikibase, created on first use
+
+    :param engine: the engine class
+    :return: EngineContext
+    """
+    key = (engine, sparql_endpoint_url or config['SPARQL_ENDPOINT_URL'],
+           mediawiki_api_url or config['MEDIAWIKI_API_URL'], wikibase_url or config['WIKIBASE_URL'],
+           concept_base_uri or config['CONCEPT_BASE_URI'], property_constraint_pid or config['PROPERTY_CONSTRAINT_PID'],
+           distinct_values_constraint_qid or config['DISTINCT_VALUES_CONSTRAINT_QID'])
+    context = _contexts.get(key)
+    if context is None:
+        with _contexts_lock:
+            context = _contexts.get(key)
+            if context is None:
+                context = _contexts[key] = EngineContext(*key)
+    return context
+
+
+def clear_contexts():
+    """
+    Forget the shared contexts, e.g. after the configuration changed
+    """
+    with _contexts_lock:
+        _contexts.clear()
@@ -0,0 +1,139 @@
+"""
+Bulk loading of entities from the wikibase api.
+
+`WDEntityLoader` fetches the entities of any number of IDs with wbgetentities calls of as many IDs as the api allows
+(50, or 500 for accounts with the apihighlimits right, e.g. bots), a few calls at a time. Entities are turned into
+engine instances and yielded as soon as their call returns, so that a bot can start working on the first items
+while the others are loaded, instead of fetching each item with a call of its own (`get_wd_entity`):
+
+    loader = WDEntityLoader(wdi_core.WDItemEngine, login=login)
+    for qid, item in loader.load(qids):
+        ...
+    print(loader.missing, loader.redirects)
+
+The calls go through `mediawiki_api_call`, and are retried the same way on maxlag, rate limiting and readonly mode.
+IDs of deleted or never created entities are collected in `missing`, and redirected IDs in `redirects`, instead of
+raising an error.
+
+Options (see wdi_config):
+ENTITY_LOADER_WORKERS: default number of wbgetentities calls in flight
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_transport import get_transport
+
+
+class WDEntityLoader(object):
+    # maximum number of IDs per wbgetentities call, without and with the apihighlimits right
+    batch_size = 50
+    high_batch_size = 500
+
+    def __init__(self, engine, mediawiki_api_url=None, login=None, user_agent=None, max_workers=None,
+                 batch_size=None):
+        """
+        :param engine: the class of the instances, e.g. WDItemEngine. Its `mediawiki_api_call` sends the calls
+        :param mediawiki_api_url: The MediaWiki url which should be used. Default config['MEDIAWIKI_API_URL']
+        :param login: An object of type WDLogin, whose session is used for the calls. With the apihighlimits right,
+            the calls have 500 instead of 50 IDs
+        :param max_workers: number of calls in flight. Default config['ENTITY_LOADER_WORKERS']
+        :param batch_size: number of IDs per call, instead of the limit of the api
+        """
+        self.engine = engine
+        self.mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
+        self.login = login
+        self.user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
+        self.max_workers = config['ENTITY_LOADER_WORKERS'] if max_workers is None else max_workers
+        self._batch_size = batch_size
+        self.missing = []
+        self.redirects = dict()
+
+    def _session(self):
+        return self.login.get_session() if self.login else get_transport()
+
+    def _api_call(self, params):
+        headers = {
+            'User-Agent': self.user_agent
+        }
+        params = dict(params, format='json', maxlag=config['MAXLAG'])
+        return self.engine.mediawiki_api_call('GET', self.mediawiki_api_url, session=self._session(), params=params,
+                                              headers=headers)
+
+    def get_batch_size(self):
+        """
+        :return: the number of IDs per wbgetentities call
+        """
+        if self._batch_size is None:
+            self._batch_size = self.batch_size
+            if self.login:
+                reply = self._api_call({'action': 'query', 'meta': 'userinfo', 'uiprop': 'rights'})
+                if 'apihighlimits' in reply.get('query', {}).get('userinfo', {}).get('rights', []):
+                    self._batch_size = self.high_batch_size
+        return self._batch_size
+
+    def _fetch(self, ids):
+        reply = self._api_call({'action': 'wbgetentities', 'ids': '|'.join(ids)})
+        if 'error' in reply:
+            if reply['error'].get('code') == 'no-such-entity' and len(ids) > 1:
+                # one of the IDs is not valid, which fails the whole call
+                entities = dict()
+                for entity_id in ids:
+                    entities.update(self._fetch([entity_id]))
+                return entities
+            if reply['error'].get('code') == 'no-such-entity':
+                return {ids[0]: {'id': ids[0], 'missing': ''}}
+            raise wdi_core.WDApiError(reply)
+        return reply['entities']
+
+    def _instances(self, entities):
+        for entity_id, data in entities.items():
+            if 'missing' in data:
+                self.missing.append(data.get('id', entity_id))
+                continue
+            if 'redirects' in data:
+                self.redirects[data['redirects']['from']] = data['redirects']['to']
+            instance = self.engine(wd_item_id=entity_id, item_data=data)
+            instance.mediawiki_api_url = self.mediawiki_api_url
+            yield entity_id, instance
+
+    def load(self, items):
+        """
+        Fetch the entities of the IDs in `items`
+
+        :param items: iterable of QIDs or property IDs, which is consumed while the entities are loaded
+        :return: generator of tuples of the entity ID and the instance of `engine` with the entity data, in the order
+            the calls return. A redirected ID is given as the ID it redirects to.
+        """
+        batch_size = self.get_batch_size()
+        seen = set()
+        ids = (x for x in items if not (x in seen or seen.add(x)))
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while True:
+                    # keep the workers busy, without reading far ahead of what was yielded
+                    while len(pending) < 2 * self.max_workers:
+                        batch = list(islice(ids, batch_size))
+                        if not batch:
+                            break
+                        pending.add(executor.submit(self._fetch, batch))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from self._instances(future.result())
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items() if not k.startswith('_')),
+        )
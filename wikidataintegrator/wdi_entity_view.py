@@ -0,0 +1,120 @@
+"""
+Read-only access to the json of an entity.
+
+For analytics over many items, building a WDItemEngine with its statement objects is wasted work. A `WDEntityView`
+wraps the entity json as the api returns it, and reads labels, descriptions, aliases, sitelinks and claim values from
+it without building any objects. It takes the same `wd_item_id` and `item_data` arguments as WDItemEngine, so it can
+be used as the engine of a WDEntityLoader:
+
+    loader = WDEntityLoader(WDEntityView)
+    for qid, view in loader.load(qids):
+        print(qid, view.get_label(), view.get_values('P31'))
+
+The datatype objects of a property can still be built when needed, with `get_statements`.
+"""
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_config import config
+
+
+class WDEntityView(object):
+    def __init__(self, wd_item_id='', item_data=None, mediawiki_api_url=None, user_agent=None):
+        """
+        :param wd_item_id: the ID of the entity, e.g. 'Q42'
+        :param item_data: the json of the entity. If None, it is loaded from the wikibase api
+        :param mediawiki_api_url: Default from config['MEDIAWIKI_API_URL']
+        :param user_agent: Default from config['USER_AGENT_DEFAULT']
+        """
+        self.wd_item_id = wd_item_id
+        self.mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
+        self.user_agent = config['USER_AGENT_DEFAULT'] if user_agent is None else user_agent
+        if item_data is None:
+            params = {
+                'action': 'wbgetentities',
+                'ids': wd_item_id,
+                'format': 'json'
+            }
+            headers = {
+                'User-Agent': self.user_agent
+            }
+            reply = wdi_core.WDItemEngine.mediawiki_api_call("GET", self.mediawiki_api_url, params=params,
+                                                             headers=headers)
+            item_data = reply['entities'][wd_item_id]
+        self.json = item_data
+        self.wd_item_id = item_data.get('id', wd_item_id)
+
+    @property
+    def lastrevid(self):
+        return self.json.get('lastrevid')
+
+    def get_label(self, lang='en'):
+        """
+        :return: the label in `lang`, or '' if there is none
+        """
+        return self.json.get('labels', {}).get(lang, {}).get('value', '')
+
+    def get_description(self, lang='en'):
+        """
+        :return: the description in `lang`, or '' if there is none
+        """
+        return self.json.get('descriptions', {}).get(lang, {}).get('value', '')
+
+    def get_aliases(self, lang='en'):
+        """
+        :return: list of the aliases in `lang`
+        """
+        return [x['value'] for x in self.json.get('aliases', {}).get(lang, [])]
+
+    def get_sitelink(self, site):
+        """
+        :return: the title of the page on `site`, e.g. 'enwiki', or None
+        """
+        return self.json.get('sitelinks', {}).get(site, {}).get('title')
+
+    def get_property_list(self):
+        """
+        :return: list of the property IDs the entity has claims of
+        """
+        return list(self.json.get('claims', {}))
+
+    def get_claims(self, prop_nr):
+        """
+        :return: list of the claims of `prop_nr` in json, as given by the api. They must not be modified.
+        """
+        return self.json.get('claims', {}).get(prop_nr, [])
+
+    def get_values(self, prop_nr, include_deprecated=False):
+        """
+        The values of the main snaks of a property. Entity values are given as their ID, other values as in the
+        json, e.g. a dict with 'time' and 'precision' for a point in time.
+
+        :param include_deprecated: include the values of claims with deprecated rank
+        :return: list of values. Claims with 'somevalue' or 'novalue' are left out.
+        """
+        values = []
+        for claim in self.get_claims(prop_nr):
+            if claim.get('rank') == 'deprecated' and not include_deprecated:
+                continue
+            snak = claim['mainsnak']
+            if snak['snaktype'] != 'value':
+                continue
+            value = snak['datavalue']['value']
+            if isinstance(value, dict) and 'id' in value:
+                value = value['id']
+            values.append(value)
+        return values
+
+    def get_statements(self, prop_nr):
+        """
+        :return: list of the WDBaseDataType objects of the claims of `prop_nr`, built on each call
+        """
+        return [wdi_core._datatype_class(z['mainsnak']['datatype']).from_json(z) for z in self.get_claims(prop_nr)]
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items() if k != 'json'),
+        )
@@ -1,10 +1,23 @@
 import copy
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import re
+import sys
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
-from functools import lru_cache
+from collections.abc import MutableMapping
 from itertools import chain
 
 from wikidataintegrator.wdi_config import config
 
+# the title of an item, property or lexeme page, without the namespace
+_entity_title_re = re.compile(r'^[QPL]\d+$')
+
 example_Q14911732 = {'P1057':
                          {'Q14911732-23F268EB-2848-4A82-A248-CF4DF6B256BC':
                               {'v': 'Q847102',
@@ -16,19 +29,382 @@ example_Q14911732 = {'P1057':
                      }
 
 
+class CompactPropData(MutableMapping):
+    """
+    Memory efficient drop-in replacement for `FastRunContainer.prop_data`
+
+    Strings (PIDs, reference hashes and values) are interned and referred to by integer ids, item IDs and
+    wikibase-item values are stored as their numeric id. Statements, qualifiers and reference snaks are kept in
+    columnar arrays, the qualifiers and reference snaks of a statement are chained together with `*_next` arrays.
+    Looking up an item returns the same nested dict as the default dict based storage (see `example_Q14911732`),
+    built on the fly.
+    """
+
+    def __init__(self):
+        self._strings = []
+        self._string_ids = {}
+        # item -> list of statement rows
+        self._items = {}
+        # statement ID -> statement row, and back
+        self._sid_rows = {}
+        self._sids = []
+        # statements
+        self._st_prop = array('i')
+        self._st_value = array('i')
+        self._st_unit = array('i')
+        self._st_qual = array('i')
+        self._st_ref = array('i')
+        # qualifiers
+        self._q_prop = array('i')
+        self._q_value = array('i')
+        self._q_next = array('i')
+        # reference snaks
+        self._r_ref = array('i')
+        self._r_prop = array('i')
+        self._r_value = array('i')
+        self._r_next = array('i')
+
+    def _intern(self, s):
+        try:
+            return self._string_ids[s]
+        except KeyError:
+            self._string_ids[s] = len(self._strings)
+            self._strings.append(s)
+            return self._string_ids[s]
+
+    @staticmethod
+    def _is_qid(s):
+        return len(s) > 1 and s[0] == 'Q' and s[1] != '0' and s[1:].isascii() and s[1:].isdigit()
+
+    def _encode_value(self, v):
+        # negative numbers are QIDs, so the most common values don't need to be interned. QIDs too large for the
+        # int32 arrays (e.g. external IDs that look like QIDs) are interned like other strings
+        if self._is_qid(v) and int(v[1:]) < 2 ** 31:
+            return -int(v[1:]) - 1
+        return self._intern(v)
+
+    def _decode_value(self, code):
+        if code < 0:
+            return 'Q{}'.format(-code - 1)
+        return self._strings[code]
+
+    def _encode_item(self, qid):
+        return int(qid[1:]) if self._is_qid(qid) else qid
+
+    @staticmethod
+    def _decode_item(key):
+        return 'Q{}'.format(key) if isinstance(key, int) else key
+
+    def _get_statement_row(self, qid, prop_nr, sid):
+        if sid in self._sid_rows:
+            return self._sid_rows[sid]
+        row = len(self._sids)
+        self._sid_rows[sid] = row
+        self._sids.append(sid)
+        self._st_prop.append(self._intern(prop_nr))
+        self._st_value.append(self._intern(''))
+        self._st_unit.append(self._encode_value('1'))
+        self._st_qual.append(-1)
+        self._st_ref.append(-1)
+        self._items.setdefault(self._encode_item(qid), []).append(row)
+        return row
+
+    def _add_qualifier(self, row, pq, qval):
+        pq, qval = self._intern(pq), self._encode_value(qval)
+        i = self._st_qual[row]
+        while i != -1:
+            if self._q_prop[i] == pq and self._q_value[i] == qval:
+                return
+            i = self._q_next[i]
+        self._q_prop.append(pq)
+        self._q_value.append(qval)
+        self._q_next.append(self._st_qual[row])
+        self._st_qual[row] = len(self._q_prop) - 1
+
+    def _add_reference_snak(self, row, ref, pr, rval):
+        ref, pr, rval = self._intern(ref), self._intern(pr), self._encode_value(rval)
+        i = self._st_ref[row]
+        while i != -1:
+            if self._r_ref[i] == ref and self._r_prop[i] == pr and self._r_value[i] == rval:
+                return
+            i = self._r_next[i]
+        self._r_ref.append(ref)
+        self._r_prop.append(pr)
+        self._r_value.append(rval)
+        self._r_next.append(self._st_ref[row])
+        self._st_ref[row] = len(self._r_ref) - 1
+
+    def update_from_query(self, r, prop_nr):
+        """
+        Same as `FastRunContainer.update_frc_from_query`, for this storage
+        """
+        for i in r:
+            if 'v' not in i and i['sid'] not in self._sid_rows:
+                continue
+            row = self._get_statement_row(i['item'], prop_nr, i['sid'])
+            if 'v' in i:
+                self._st_value[row] = self._encode_value(i['v'])
+            if 'pq' in i and 'qval' in i:
+                self._add_qualifier(row, i['pq'], i['qval'])
+            if 'ref' in i:
+                self._add_reference_snak(row, i['ref'], i['pr'], i['rval'])
+            if 'unit' in i:
+                self._st_unit[row] = self._encode_value(i['unit'])
+
+    def __getitem__(self, qid):
+        rows = self._items[self._encode_item(qid)]
+        item_data = dict()
+        for row in rows:
+            qual = set()
+            i = self._st_qual[row]
+            while i != -1:
+                qual.add((self._strings[self._q_prop[i]], self._decode_value(self._q_value[i])))
+                i = self._q_next[i]
+            ref = dict()
+            i = self._st_ref[row]
+            while i != -1:
+                ref.setdefault(self._strings[self._r_ref[i]], set()).add(
+                    (self._strings[self._r_prop[i]], self._decode_value(self._r_value[i])))
+                i = self._r_next[i]
+            prop_nr = self._strings[self._st_prop[row]]
+            item_data.setdefault(prop_nr, dict())[self._sids[row]] = {
+                'v': self._decode_value(self._st_value[row]),
+                'qual': qual,
+                'ref': ref,
+                'unit': self._decode_value(self._st_unit[row])
+            }
+        return item_data
+
+    def __setitem__(self, qid, item_data):
+        if qid in self:
+            del self[qid]
+        self._items[self._encode_item(qid)] = []
+        for prop_nr, statements in item_data.items():
+            for sid, d in statements.items():
+                row = self._get_statement_row(qid, prop_nr, sid)
+                self._st_value[row] = self._encode_value(d['v'])
+                self._st_unit[row] = self._encode_value(d.get('unit', '1'))
+                for pq, qval in d.get('qual', set()):
+                    self._add_qualifier(row, pq, qval)
+                for ref, snaks in d.get('ref', dict()).items():
+                    for pr, rval in snaks:
+                        self._add_reference_snak(row, ref, pr, rval)
+
+    def __delitem__(self, qid):
+        # the rows of the item stay in the arrays, but are not reachable anymore
+        for row in self._items.pop(self._encode_item(qid)):
+            del self._sid_rows[self._sids[row]]
+
+    def __contains__(self, qid):
+        return isinstance(qid, str) and self._encode_item(qid) in self._items
+
+    def __iter__(self):
+        return (self._decode_item(key) for key in self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def memory_usage(self):
+        """
+        Approximate number of bytes used by this storage
+        """
+        size = sys.getsizeof(self._strings) + sys.getsizeof(self._string_ids) + sum(map(sys.getsizeof, self._strings))
+        size += sys.getsizeof(self._items) + sum(sys.getsizeof(rows) for rows in self._items.values())
+        size += sys.getsizeof(self._sid_rows) + sys.getsizeof(self._sids) + sum(map(sys.getsizeof, self._sids))
+        size += sum(sys.getsizeof(v) for v in self.__dict__.values() if isinstance(v, array))
+        return size
+
+    def __repr__(self):
+        return "<{klass} @{id:x} items={items} statements={statements} qualifiers={qualifiers} " \
+               "reference_snaks={refs} memory={memory:.1f}MB>".format(
+                klass=self.__class__.__name__,
+                id=id(self) & 0xFFFFFF,
+                items=len(self._items),
+                statements=len(self._sid_rows),
+                qualifiers=len(self._q_prop),
+                refs=len(self._r_ref),
+                memory=self.memory_usage() / 1024 ** 2,
+                )
+
+
+class ReverseIndex(MutableMapping):
+    """
+    Reverse lookup of the fastrun data: value -> item IDs, as a mapping of values to sets of item IDs.
+    Item IDs are stored as integers, a single one for values used by one item, and a sorted array for values used by
+    many items. Use `count`, `contains` and `intersect` to look things up without building sets.
+    """
+
+    def __init__(self):
+        # values with one item, and values with more items
+        self._single = {}
+        self._multi = {}
+        # values whose array has items appended since it was last sorted
+        self._unsorted = set()
+        # IDs that aren't Q-ids get negative codes
+        self._other_ids = []
+        self._other_codes = {}
+
+    def _encode(self, qid):
+        if CompactPropData._is_qid(qid):
+            return int(qid[1:])
+        if qid not in self._other_codes:
+            self._other_ids.append(qid)
+            self._other_codes[qid] = -len(self._other_ids)
+        return self._other_codes[qid]
+
+    def _decode(self, code):
+        return 'Q{}'.format(code) if code >= 0 else self._other_ids[-code - 1]
+
+    def _codes(self, value):
+        if value in self._single:
+            return self._single[value],
+        codes = self._multi[value]
+        if value in self._unsorted:
+            codes = self._multi[value] = array('q', sorted(set(codes)))
+            self._unsorted.discard(value)
+        return codes
+
+    def add(self, value, qid):
+        code = self._encode(qid)
+        if value in self._multi:
+            self._multi[value].append(code)
+            self._unsorted.add(value)
+        elif value in self._single:
+            if self._single[value] != code:
+                self._multi[value] = array('q', sorted([self._single.pop(value), code]))
+        else:
+            self._single[value] = code
+
+    def discard(self, value, qid):
+        if value not in self:
+            return
+        if value in self._single:
+            if self._single[value] == self._encode(qid):
+                del self._single[value]
+            return
+        codes = self._codes(value)
+        code = self._encode(qid)
+        i = bisect_left(codes, code)
+        if i < len(codes) and codes[i] == code:
+            del codes[i]
+            if len(codes) == 1:
+                self._single[value] = codes[0]
+                del self._multi[value]
+
+    def count(self, value):
+        """
+        Number of items with `value`
+        """
+        if value in self._single:
+            return 1
+        return len(self._codes(value)) if value in self._multi else 0
+
+    def contains(self, value, qid):
+        """
+        Check if item `qid` has `value`
+        """
+        if value in self._single:
+            return self._single[value] == self._encode(qid)
+        if value not in self._multi:
+            return False
+        codes = self._codes(value)
+        code = self._encode(qid)
+        i = bisect_left(codes, code)
+        return i < len(codes) and codes[i] == code
+
+    def intersect(self, values):
+        """
+        The items which have all of `values`. Starts from the value with the fewest items, and only looks up
+        those items in the others.
+
+        :param values: list of values
+        :return: set of item IDs
+        """
+        if not values or any(value not in self for value in values):
+            return set()
+        values = sorted(values, key=self.count)
+        codes = self._codes(values[0])
+        others = [self._codes(value) for value in values[1:]]
+        matches = set()
+        for code in codes:
+            for other in others:
+                i = bisect_left(other, code)
+                if i == len(other) or other[i] != code:
+                    break
+            else:
+                matches.add(self._decode(code))
+        return matches
+
+    def __getitem__(self, value):
+        return {self._decode(code) for code in self._codes(value)}
+
+    def __setitem__(self, value, qids):
+        if value in self:
+            del self[value]
+        for qid in qids:
+            self.add(value, qid)
+
+    def __delitem__(self, value):
+        if value in self._single:
+            del self._single[value]
+        else:
+            del self._multi[value]
+            self._unsorted.discard(value)
+
+    def __contains__(self, value):
+        return value in self._single or value in self._multi
+
+    def __iter__(self):
+        return chain(self._single, self._multi)
+
+    def __len__(self):
+        return len(self._single) + len(self._multi)
+
+    def __repr__(self):
+        return "<{klass} @{id:x} values={values} multi_item_values={multi}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            values=len(self),
+            multi=len(self._multi),
+        )
+
+
 class FastRunContainer(object):
+    # bump this whenever the layout of the data stored in a snapshot changes
+    SNAPSHOT_VERSION = 4
+    # number of QIDs put in one `VALUES ?item {...}` block when only some items are (re)loaded
+    qid_chunk_size = 200
+    # number of statements fetched per fastrun query
+    page_size = 10000
+    # number of properties per wbgetentities call when looking up datatypes (the api limit for bots is 50)
+    datatype_batch_size = 50
+    # property datatypes, shared by all containers: {mediawiki_api_url: {prop_nr: datatype}}
+    prop_datatype_cache = defaultdict(dict)
+
     def __init__(self, base_data_type, engine, mediawiki_api_url=None, sparql_endpoint_url=None, wikibase_url=None,
                  concept_base_uri=None, base_filter=None, use_refs=False, ref_handler=None, case_insensitive=False,
-                 debug=False):
-        self.prop_data = {}
+                 compact=False, qids=None, query_hints=None, unindexed_props=None, debug=False):
+        self.compact = compact
+        self.prop_data = CompactPropData() if compact else {}
         self.loaded_langs = {}
         self.statements = []
         self.base_filter = {}
         self.base_filter_string = ''
         self.prop_dt_map = {}
+        # properties loaded for all items matching the base filter
+        self.loaded_props = set()
+        # if only some items are loaded (`qids`): the items loaded per property, and per (language, data type)
+        self.target_qids = None if qids is None else set(qids)
+        self.loaded_qids = defaultdict(set)
+        self.loaded_lang_qids = defaultdict(set)
+        # properties loaded for all targeted items, and the items targeted since they were loaded
+        self._target_props = set()
+        self._pending_qids = set()
         self.current_qid = ''
-        self.rev_lookup = defaultdict(set)
-        self.rev_lookup_ci = defaultdict(set)
+        self.rev_lookup = ReverseIndex()
+        self.rev_lookup_ci = ReverseIndex()
+        # properties whose values don't identify items (e.g. instance of human), left out of the reverse lookup
+        self.unindexed_props = set(unindexed_props) if unindexed_props else set()
         self.base_data_type = base_data_type
         self.engine = engine
         self.mediawiki_api_url = config['MEDIAWIKI_API_URL'] if mediawiki_api_url is None else mediawiki_api_url
@@ -36,10 +412,16 @@ class FastRunContainer(object):
         self.wikibase_url = config['WIKIBASE_URL'] if wikibase_url is None else wikibase_url
         self.concept_base_uri = config['CONCEPT_BASE_URI'] if concept_base_uri is None else concept_base_uri
         self.case_insensitive = case_insensitive
+        # lines added to the statement query, e.g. ['hint:Query hint:optimizer "None" .']
+        self.query_hints = config['FASTRUN_QUERY_HINTS'] if query_hints is None else query_hints
         self.debug = debug
         self.reconstructed_statements = []
         self.use_refs = use_refs
         self.ref_handler = ref_handler
+        # time (UTC) at which loading data from the sparql endpoint started. Anything edited after this may be stale
+        self.data_timestamp = None
+        # statement fingerprints per item, see `get_fingerprints`
+        self._fingerprints = {}
 
         if base_filter and any(base_filter):
             self.base_filter = base_filter
@@ -55,14 +437,17 @@ class FastRunContainer(object):
         if qid not in self.prop_data:
             self.reconstructed_statements = reconstructed_statements
             return reconstructed_statements
-        for prop_nr, dt in self.prop_data[qid].items():
-            # get datatypes for qualifier props
-            q_props = set(chain(*[[x[0] for x in d['qual']] for d in dt.values()]))
-            r_props = set(chain(*[set(chain(*[[y[0] for y in x] for x in d['ref'].values()])) for d in dt.values()]))
-            props = q_props | r_props
-            for prop in props:
-                if prop not in self.prop_dt_map:
-                    self.prop_dt_map.update({prop: self.get_prop_datatype(prop)})
+        item_data = self.prop_data[qid]
+        # get datatypes for qualifier and reference props, all in one go
+        props = set()
+        for dt in item_data.values():
+            for d in dt.values():
+                props.update(x[0] for x in d['qual'])
+                props.update(y[0] for x in d['ref'].values() for y in x)
+        props = props - set(self.prop_dt_map)
+        if props:
+            self.prop_dt_map.update(self.get_prop_datatypes(props))
+        for prop_nr, dt in item_data.items():
             # reconstruct statements from frc (including qualifiers, and refs)
             for uid, d in dt.items():
                 qualifiers = []
@@ -94,8 +479,96 @@ class FastRunContainer(object):
         self.reconstructed_statements = reconstructed_statements
         return reconstructed_statements
 
+    def prefetch(self, props):
+        """
+        Load the data of several properties with one query, instead of querying them one by one as `load_item`
+        comes across them. Properties which are already loaded are skipped.
+
+        :param props: iterable of property IDs
+        :return: list of the properties that were loaded
+        """
+        props = set(props)
+        if self.target_qids is not None:
+            loaded = self.load_qids(self.target_qids, props)
+            self._target_props.update(props - self.loaded_props)
+            return loaded
+        props = sorted(props - set(self.prop_dt_map))
+        if not props:
+            return props
+        if self.debug:
+            print("prefetching {}".format(', '.join(props)))
+        self.prop_dt_map.update(self.get_prop_datatypes(props))
+        self._query_props(props)
+        return props
+
+    def is_loaded(self, prop_nr, qid):
+        return prop_nr in self.loaded_props or qid in self.loaded_qids[prop_nr]
+
+    def add_target_qids(self, qids):
+        """
+        Add items to `target_qids`. They are loaded with the next item that is compared, for all properties loaded
+        for the targeted items so far.
+
+        :param qids: iterable of item IDs
+        """
+        if self.target_qids is None:
+            self.target_qids = set()
+        qids = set(qids) - self.target_qids
+        self.target_qids.update(qids)
+        self._pending_qids.update(qids)
+
+    def load_qids(self, qids, props, use_cache=True):
+        """
+        Load the data of some items only, in chunks of `qid_chunk_size` items. The items are added to `target_qids`,
+        and (property, item) combinations which are already loaded are skipped. From then on, properties which are
+        not loaded yet are only loaded for the targeted items.
+
+        :param qids: iterable of item IDs
+        :param props: iterable of property IDs
+        :param use_cache: look up the results in the SPARQL result cache, if caching is enabled
+        :return: list of the properties that were (partly) loaded
+        """
+        qids = set(qids)
+        self.add_target_qids(qids)
+        props = set(props)
+        self.prop_dt_map.update(self.get_prop_datatypes(props - set(self.prop_dt_map)))
+
+        # group the properties by the items they are missing, so that each group is loaded with one query per chunk
+        missing = defaultdict(list)
+        for prop_nr in sorted(props):
+            prop_qids = frozenset(qid for qid in qids if not self.is_loaded(prop_nr, qid))
+            if prop_qids:
+                missing[prop_qids].append(prop_nr)
+        for prop_qids, group in missing.items():
+            if self.debug:
+                print("loading {} for {} items".format(', '.join(group), len(prop_qids)))
+            prop_qids = sorted(prop_qids)
+            for i in range(0, len(prop_qids), self.qid_chunk_size):
+                self._query_props(group, qids=prop_qids[i:i + self.qid_chunk_size], use_cache=use_cache)
+            for prop_nr in group:
+                self.loaded_qids[prop_nr].update(prop_qids)
+        return sorted(chain(*missing.values()))
+
+    def _load_targets(self, props, cqid=None):
+        # Only the items targeted since the last call, and the properties new to the targets are loaded, so the
+        # targets are not all checked again for every item that is compared
+        if cqid:
+            self.add_target_qids([cqid])
+        if self._pending_qids and self._target_props:
+            self.load_qids(self._pending_qids, self._target_props)
+        self._pending_qids = set()
+        new_props = set(props) - self._target_props - self.loaded_props
+        if new_props:
+            self.load_qids(self.target_qids, new_props)
+            self._target_props.update(new_props)
+
     def load_item(self, data, cqid=None):
-        match_sets = []
+        if self.target_qids is not None:
+            # only the targeted items are loaded, including the deletion statements, so every property in `data`
+            # is known for the item that is compared
+            self._load_targets([x.get_prop_nr() for x in data], cqid)
+
+        lookups = []
         for date in data:
             # skip to next if statement has no value or no data type defined, e.g. for deletion objects
             current_value = date.get_value()
@@ -110,6 +583,10 @@ class FastRunContainer(object):
                 self.prop_dt_map.update({prop_nr: self.get_prop_datatype(prop_nr)})
                 self._query_data(prop_nr)
 
+            if prop_nr in self.unindexed_props:
+                # not in the reverse lookup, this is left to write_required
+                continue
+
             # more sophisticated data types like dates and globe coordinates need special treatment here
             if self.prop_dt_map[prop_nr] == 'time':
                 current_value = current_value[0]
@@ -123,9 +600,9 @@ class FastRunContainer(object):
 
             if current_value in self.rev_lookup:
                 # quick check for if the value has ever been seen before, if not, write required
-                temp_set = set(self.rev_lookup[current_value])
+                lookups.append((self.rev_lookup, current_value))
             elif self.case_insensitive and current_value.casefold() in self.rev_lookup_ci:
-                temp_set = set(self.rev_lookup_ci[current_value.casefold()])
+                lookups.append((self.rev_lookup_ci, current_value.casefold()))
             else:
                 if self.debug:
                     if self.case_insensitive:
@@ -135,12 +612,15 @@ class FastRunContainer(object):
                         print(self.rev_lookup)
                     print('no matches for rev lookup')
                 return True
-            match_sets.append(temp_set)
 
         if cqid:
             matching_qids = {cqid}
+        elif not lookups:
+            if self.debug:
+                print('no statements to identify the item')
+            return True
         else:
-            matching_qids = match_sets[0].intersection(*match_sets[1:])
+            matching_qids = self._intersect_rev_lookups(lookups)
 
         # check if there are any items that have all of these values
         # if not, a write is required no matter what
@@ -153,7 +633,6 @@ class FastRunContainer(object):
         self.current_qid = qid
 
     def write_required(self, data, append_props=None, cqid=None):
-        del_props = set()
         data_props = set()
         if not append_props:
             append_props = []
@@ -161,16 +640,27 @@ class FastRunContainer(object):
         for x in data:
             if x.value and x.data_type:
                 data_props.add(x.get_prop_nr())
-        write_required = False
         self.load_item(data, cqid)
 
-        reconstructed_statements = self.reconstruct_statements(self.current_qid)
-        tmp_rs = copy.deepcopy(reconstructed_statements)
+        if self.use_refs and self.ref_handler:
+            # the ref handler works on the statement objects, so compare those one by one
+            return self._write_required_statements(data, append_props, data_props)
 
         # handle append properties
+        if append_props and self._append_required(data, append_props,
+                                                  self.reconstruct_statements(self.current_qid)):
+            return True
+
+        try:
+            return self._write_required_fingerprints(data, append_props, data_props)
+        except TypeError:
+            # a value that can't be hashed, fall back to comparing the statements
+            return self._write_required_statements(data, append_props, data_props)
+
+    def _append_required(self, data, append_props, reconstructed_statements):
         for p in append_props:
             app_data = [x for x in data if x.get_prop_nr() == p]  # new statements
-            rec_app_data = [x for x in tmp_rs if x.get_prop_nr() == p]  # orig statements
+            rec_app_data = [x for x in reconstructed_statements if x.get_prop_nr() == p]  # orig statements
             comp = []
             for x in app_data:
                 for y in rec_app_data:
@@ -188,9 +678,89 @@ class FastRunContainer(object):
                 if self.debug:
                     print("failed append: {}".format(p))
                 return True
+        return False
 
-        tmp_rs = [x for x in tmp_rs if x.get_prop_nr() not in append_props and x.get_prop_nr() in data_props]
+    @staticmethod
+    def _snaks_fingerprint(snaks):
+        return len(snaks), frozenset((x.get_prop_nr(), x.get_value()) for x in snaks)
+
+    def _statement_fingerprint(self, statement):
+        """
+        Hashable key of a statement, in two parts: (property, value, references) and the qualifiers.
+        Two statements are equal (`WDBaseDataType.equals`) when both parts are. Snaks repeated within the
+        qualifiers or a reference are counted, so they never match a statement without the repetition.
+        """
+        refs = None
+        if self.use_refs:
+            references = statement.get_references()
+            refs = len(references), frozenset(self._snaks_fingerprint(ref) for ref in references)
+        return (statement.get_prop_nr(), statement.get_value(), refs), \
+            self._snaks_fingerprint(statement.get_qualifiers())
+
+    def get_fingerprints(self, qid):
+        """
+        Fingerprints of the statements of `qid` in this container, see `_statement_fingerprint`.
+        They are computed once per item and kept until the data of the item changes.
+
+        :return: list of (property, value, references) and qualifiers fingerprints
+        """
+        if qid not in self._fingerprints:
+            self._fingerprints[qid] = [self._statement_fingerprint(x) for x in self.reconstruct_statements(qid)]
+        return self._fingerprints[qid]
+
+    def _write_required_fingerprints(self, data, append_props, data_props):
+        # the statements of the item not yet matched by one in `data`, grouped by (property, value, references)
+        remaining = defaultdict(list)
+        prop_count = defaultdict(int)
+        for key, quals in self.get_fingerprints(self.current_qid):
+            if key[0] in data_props and key[0] not in append_props:
+                remaining[key].append(quals)
+                prop_count[key[0]] += 1
+
+        for date in data:
+            prop_nr = date.get_prop_nr()
+            # ensure that statements meant for deletion get handled properly
+            if not date.value or not date.data_type:
+                if prop_count[prop_nr]:
+                    if self.debug:
+                        print('returned from delete prop handling')
+                    return True
+                # Ignore the deletion statements which are not in the reconstructed statements.
+                continue
+
+            if prop_nr in append_props:
+                continue
+
+            key, quals = self._statement_fingerprint(date)
+            candidates = remaining.get(key)
+            if candidates and not date.check_qualifier_equality and not self.use_refs:
+                # WDBaseDataType.__ne__, used when comparing references, still looks at the qualifiers
+                candidates.pop(0)
+            elif candidates and quals in candidates:
+                candidates.remove(quals)
+            else:
+                if self.debug:
+                    print('fast run failed at', prop_nr)
+                return True
+            prop_count[prop_nr] -= 1
+
+        if any(prop_count.values()):
+            if self.debug:
+                print('failed because not zero')
+            return True
+        return False
+
+    def _write_required_statements(self, data, append_props, data_props):
+        del_props = set()
+        write_required = False
+        reconstructed_statements = self.reconstruct_statements(self.current_qid)
+        tmp_rs = copy.deepcopy(reconstructed_statements)
 
+        # handle append properties
+        if self._append_required(data, append_props, tmp_rs):
+            return True
+
+        tmp_rs = [x for x in tmp_rs if x.get_prop_nr() not in append_props and x.get_prop_nr() in data_props]
         for date in data:
             # ensure that statements meant for deletion get handled properly
             reconst_props = set([x.get_prop_nr() for x in tmp_rs])
@@ -272,10 +842,30 @@ class FastRunContainer(object):
             self.loaded_langs[lang] = {}
 
         if lang_data_type not in self.loaded_langs[lang]:
+            if self.target_qids is not None:
+                self.loaded_langs[lang][lang_data_type] = defaultdict(set)
+                self.load_lang_qids(self.target_qids, lang, lang_data_type)
+                return
+            self._set_data_timestamp()
             result = self._query_lang(lang=lang, lang_data_type=lang_data_type)
             data = self._process_lang(result)
             self.loaded_langs[lang].update({lang_data_type: data})
 
+    def load_lang_qids(self, qids, lang, lang_data_type, use_cache=True):
+        """
+        Load the language data of some items only, see `load_qids`
+        """
+        self._set_data_timestamp()
+        loaded = self.loaded_lang_qids[(lang, lang_data_type)]
+        qids = sorted(set(qids) - loaded)
+        data = self.loaded_langs[lang][lang_data_type]
+        for i in range(0, len(qids), self.qid_chunk_size):
+            result = self._query_lang(lang=lang, lang_data_type=lang_data_type, qids=qids[i:i + self.qid_chunk_size],
+                                      use_cache=use_cache)
+            for qid, strings in self._process_lang(result).items():
+                data[qid] = strings
+        loaded.update(qids)
+
     def get_language_data(self, qid, lang, lang_data_type):
         """
         get language data for specified qid
@@ -290,6 +880,8 @@ class FastRunContainer(object):
             If lang_data_type == aliases: returns []
         """
         self.init_language_data(lang, lang_data_type)
+        if self.target_qids is not None and qid not in self.loaded_lang_qids[(lang, lang_data_type)]:
+            self.load_lang_qids([qid], lang, lang_data_type)
 
         current_lang_data = self.loaded_langs[lang][lang_data_type]
         all_lang_strings = current_lang_data.get(qid, [])
@@ -336,7 +928,10 @@ class FastRunContainer(object):
             rval: reference value
             unit: property unit
         """
-        prop_dt = self.get_prop_datatype(prop_nr)
+        # look up the datatypes of the main, qualifier and reference properties at once
+        prop_dts = self.get_prop_datatypes({prop_nr} | {i[k]['value'].split('/')[-1] for i in r for k in ('pq', 'pr')
+                                                        if k in i})
+        prop_dt = prop_dts[prop_nr]
         for i in r:
             for value in {'item', 'sid', 'pq', 'pr', 'ref', 'unit'}:
                 if value in i:
@@ -365,14 +960,14 @@ class FastRunContainer(object):
 
                 # Note: no-value and some-value don't actually show up in the results here
                 # see for example: select * where { wd:Q7207 p:P40 ?c . ?c ?d ?e }
-                if type(i['v']) is not dict:
-                    self.rev_lookup[i['v']].add(i['item'])
+                if type(i['v']) is not dict and prop_nr not in self.unindexed_props:
+                    self._add_rev_lookup(self.rev_lookup, i['v'], i['item'])
                     if self.case_insensitive:
-                        self.rev_lookup_ci[i['v'].casefold()].add(i['item'])
+                        self._add_rev_lookup(self.rev_lookup_ci, i['v'].casefold(), i['item'])
 
             # handle qualifier value
             if 'qval' in i:
-                qual_prop_dt = self.get_prop_datatype(prop_nr=i['pq'])
+                qual_prop_dt = prop_dts[i['pq']]
                 if i['qval']['type'] == 'uri' and qual_prop_dt == 'wikibase-item':
                     i['qval'] = i['qval']['value'].split('/')[-1]
                 else:
@@ -380,7 +975,7 @@ class FastRunContainer(object):
 
             # handle reference value
             if 'rval' in i:
-                ref_prop_dt = self.get_prop_datatype(prop_nr=i['pr'])
+                ref_prop_dt = prop_dts[i['pr']]
                 if i['rval']['type'] == 'uri' and ref_prop_dt == 'wikibase-item':
                     i['rval'] = i['rval']['value'].split('/')[-1]
                 else:
@@ -401,8 +996,16 @@ class FastRunContainer(object):
     def update_frc_from_query(self, r, prop_nr):
         # r is the output of format_query_results
         # this updates the frc from the query (result of _query_data)
+        # rows without a value (?v) only add qualifiers or references to statements loaded before
+        for i in r:
+            self._fingerprints.pop(i['item'], None)
+        if isinstance(self.prop_data, CompactPropData):
+            self.prop_data.update_from_query(r, prop_nr)
+            return
         for i in r:
             qid = i['item']
+            if 'v' not in i and i['sid'] not in self.prop_data.get(qid, dict()).get(prop_nr, dict()):
+                continue
             if qid not in self.prop_data:
                 self.prop_data[qid] = {prop_nr: dict()}
             if prop_nr not in self.prop_data[qid]:
@@ -410,8 +1013,9 @@ class FastRunContainer(object):
             if i['sid'] not in self.prop_data[qid][prop_nr]:
                 self.prop_data[qid][prop_nr].update({i['sid']: dict()})
             # update values for this statement (not including ref)
-            d = {'v': i['v']}
-            self.prop_data[qid][prop_nr][i['sid']].update(d)
+            if 'v' in i:
+                d = {'v': i['v']}
+                self.prop_data[qid][prop_nr][i['sid']].update(d)
 
             if 'qual' not in self.prop_data[qid][prop_nr][i['sid']]:
                 self.prop_data[qid][prop_nr][i['sid']]['qual'] = set()
@@ -430,113 +1034,162 @@ class FastRunContainer(object):
             if 'unit' in i:
                 self.prop_data[qid][prop_nr][i['sid']]['unit'] = i['unit']
 
-    def _query_data_refs(self, prop_nr):
-        page_size = 10000
-        page_count = 0
+    def _query_data(self, prop_nr, qids=None):
+        """
+        Load the statements for `prop_nr` of all items matching the base filter
+
+        :param prop_nr: the property to load
+        :param qids: if given, only load the data of these items
+        """
+        self._query_props([prop_nr], qids=qids)
+
+    def _query_props(self, props, qids=None, use_cache=True):
+        """
+        Load the statements of several properties at once. The properties are bound with a VALUES clause, so all of
+        them are fetched with a single (paged) query instead of one query per property.
+
+        :param props: list of properties to load
+        :param qids: if given, only load the data of these items
+        :param use_cache: look up the results in the SPARQL result cache, if caching is enabled
+        """
+        self._set_data_timestamp()
+        if qids is None:
+            self.loaded_props.update(props)
+        base_filter_string = self._get_base_filter_string(qids)
+        values_string = ' '.join('(p:{0} ps:{0} psv:{0})'.format(prop_nr) for prop_nr in props)
+        label = ', '.join(props)
+
         num_pages = None
-        if self.debug:
+        if self.debug and self.use_refs:
             # get the number of pages/queries so we can show a progress bar
             query = """PREFIX wd: <{0}/entity/>
             PREFIX wdt: <{0}/prop/direct/>
             PREFIX p: <{0}/prop/>
             PREFIX ps: <{0}/prop/statement/>
+            PREFIX psv: <{0}/prop/statement/value/>
 
             SELECT (COUNT(?item) as ?c) where {{
                   {1}
-                  ?item p:{2} ?sid .
-            }}""".format(self.wikibase_url, self.base_filter_string, prop_nr)
+                  VALUES (?p ?ps ?psv) {{ {2} }}
+                  ?item ?p ?sid .
+            }}""".format(self.wikibase_url, base_filter_string, values_string)
 
             if self.debug:
                 print(query)
 
-            r = self.engine.execute_sparql_query(query, endpoint=self.sparql_endpoint_url)['results']['bindings']
+            r = self.engine.execute_sparql_query(query, endpoint=self.sparql_endpoint_url,
+                                                 use_cache=use_cache)['results']['bindings']
             count = int(r[0]['c']['value'])
-            num_pages = (int(count) // page_size) + 1
-            print("Query {}: {}/{}".format(prop_nr, page_count, num_pages))
-        while True:
-            query = """
-                PREFIX wd: <**wikibase_url**/entity/>
-                PREFIX wdt: <**wikibase_url**/prop/direct/>
-                PREFIX p: <**wikibase_url**/prop/>
-                PREFIX ps: <**wikibase_url**/prop/statement/>
-                #Tool: wdi_core fastrun
-                SELECT ?item ?qval ?pq ?sid ?v ?ref ?pr ?rval WHERE {
-                  {
-                    SELECT ?item ?v ?sid where {
-                      **base_filter_string**
-                      ?item p:**prop_nr** ?sid .
-                      ?sid ps:**prop_nr** ?v .
-                    } GROUP BY ?item ?v ?sid
-                    ORDER BY ?sid
-                    OFFSET **offset**
-                    LIMIT **page_size**
-                  }
-                  OPTIONAL {
-                    ?sid ?pq ?qval .
-                    [] wikibase:qualifier ?pq
-                  }
-                  OPTIONAL {
-                    ?sid prov:wasDerivedFrom ?ref .
-                    ?ref ?pr ?rval .
-                    [] wikibase:reference ?pr
-                  }
-                }""".replace("**offset**", str(page_count * page_size)). \
-                replace("**base_filter_string**", self.base_filter_string). \
-                replace("**prop_nr**", prop_nr).replace("**page_size**", str(page_size)). \
+            num_pages = (int(count) // self.page_size) + 1
+            print("Query {}: {}/{}".format(label, 0, num_pages))
+
+        # the statements with their qualifiers and units. The references are fetched with a separate query for the
+        # same statements, instead of the cross product of qualifiers and reference snaks
+        query = """
+            PREFIX wd: <**wikibase_url**/entity/>
+            PREFIX wdt: <**wikibase_url**/prop/direct/>
+            PREFIX p: <**wikibase_url**/prop/>
+            PREFIX ps: <**wikibase_url**/prop/statement/>
+            PREFIX psv: <**wikibase_url**/prop/statement/value/>
+            #Tool: wdi_core fastrun
+            select ?item ?p ?qval ?pq ?sid ?v ?unit where {
+              {
+                SELECT ?item ?p ?psv ?v ?sid where {
+                  **query_hints**
+                  **base_filter_string**
+                  VALUES (?p ?ps ?psv) { **values_string** }
+                  ?item ?p ?sid .
+                  ?sid ?ps ?v .
+                  FILTER(STR(?sid) > "**last_sid**")
+                } GROUP BY ?item ?p ?psv ?v ?sid
+                ORDER BY ?sid
+                LIMIT **page_size**
+              }
+              OPTIONAL {
+                ?sid ?pq ?qval .
+                [] wikibase:qualifier ?pq
+              }
+              OPTIONAL {
+                ?sid ?psv ?valuenode .
+                ?valuenode wikibase:quantityUnit ?unit
+              }
+            }"""
+        refs_query = None
+        if self.use_refs:
+            refs_query = """
+            PREFIX wd: <**wikibase_url**/entity/>
+            PREFIX wdt: <**wikibase_url**/prop/direct/>
+            PREFIX p: <**wikibase_url**/prop/>
+            #Tool: wdi_core fastrun
+            SELECT ?item ?p ?sid ?ref ?pr ?rval WHERE {
+              **base_filter_string**
+              VALUES ?p { **props_string** }
+              ?item ?p ?sid .
+              FILTER(STR(?sid) > "**last_sid**" && STR(?sid) <= "**max_sid**")
+              ?sid prov:wasDerivedFrom ?ref .
+              ?ref ?pr ?rval .
+              [] wikibase:reference ?pr
+            }"""
+            refs_query = refs_query.replace("**base_filter_string**", base_filter_string). \
+                replace("**props_string**", ' '.join('p:{}'.format(prop_nr) for prop_nr in props)). \
                 replace("**wikibase_url**", self.wikibase_url)
+        query = query.replace("**query_hints**", '\n'.join(self.query_hints)). \
+            replace("**base_filter_string**", base_filter_string). \
+            replace("**values_string**", values_string).replace("**page_size**", str(self.page_size)). \
+            replace("**wikibase_url**", self.wikibase_url)
+        self._query_paged(query, label, num_pages=num_pages, refs_query=refs_query, use_cache=use_cache)
 
+    def _query_paged(self, query, label, num_pages=None, refs_query=None, use_cache=True):
+        """
+        Run a fastrun query one page of statements at a time. Pages are selected on the last statement ID seen
+        (`**last_sid**` in `query`) instead of an OFFSET, so the endpoint never has to skip over earlier pages.
+        The rows of each page are split up by their ?p binding and stored under that property.
+
+        :param query: sparql query selecting at most `page_size` statements, ordered by ?sid, with an ID larger
+        than `**last_sid**`
+        :param label: name of the query, for the progress output
+        :param num_pages: expected number of pages, for the progress output
+        :param refs_query: if given, sparql query for the references of the statements with an ID larger than
+        `**last_sid**` and up to `**max_sid**`, run after each page of `query`
+        :param use_cache: look up the results in the SPARQL result cache, if caching is enabled
+        """
+        last_sid = ''
+        page_count = 0
+        while True:
+            page_query = query.replace("**last_sid**", last_sid)
             if self.debug:
-                print(query)
-
-            results = self.engine.execute_sparql_query(query, endpoint=self.sparql_endpoint_url)['results']['bindings']
-            self.format_query_results(results, prop_nr)
-            self.update_frc_from_query(results, prop_nr)
+                print(page_query)
+
+            results_by_prop = defaultdict(list)
+            sids = set()
+            for x in self._sparql_bindings(page_query, use_cache=use_cache):
+                sids.add(x['sid']['value'])
+                results_by_prop[x['p']['value'].split('/')[-1]].append(x)
+            if refs_query and sids:
+                page_query = refs_query.replace("**last_sid**", last_sid).replace("**max_sid**", max(sids))
+                if self.debug:
+                    print(page_query)
+                # statements first, the references are only stored for statements that are known
+                for x in self._sparql_bindings(page_query, use_cache=use_cache):
+                    results_by_prop[x['p']['value'].split('/')[-1]].append(x)
+            if sids:
+                last_sid = max(sids)
+            for prop_nr, prop_results in results_by_prop.items():
+                self.format_query_results(prop_results, prop_nr)
+                self.update_frc_from_query(prop_results, prop_nr)
             page_count += 1
             if num_pages:
-                print("Query {}: {}/{}".format(prop_nr, page_count, num_pages))
-            if len(results) == 0:
+                print("Query {}: {}/{}".format(label, page_count, num_pages))
+            if len(sids) < self.page_size:
                 break
 
-    def _query_data(self, prop_nr):
-        if self.use_refs:
-            self._query_data_refs(prop_nr)
-        else:
-            query = '''
-                PREFIX wd: <{0}/entity/>
-                PREFIX wdt: <{0}/prop/direct/>
-                PREFIX p: <{0}/prop/>
-                PREFIX ps: <{0}/prop/statement/>
-                PREFIX psv: <{0}/prop/statement/value/>
-                #Tool: wdi_core fastrun
-                select ?item ?qval ?pq ?sid ?v ?unit where {{
-                  {1}
-
-                  ?item p:{2} ?sid .
-
-                  ?sid ps:{2} ?v .
-                  OPTIONAL {{
-                    ?sid ?pq ?qval .
-                    [] wikibase:qualifier ?pq
-                  }}
-                  OPTIONAL {{
-                    ?sid psv:{2} ?valuenode .
-                    ?valuenode wikibase:quantityUnit ?unit
-                  }}
-                }}
-                '''.format(self.wikibase_url, self.base_filter_string, prop_nr)
-
-            if self.debug:
-                print(query)
-
-            r = self.engine.execute_sparql_query(query=query, endpoint=self.sparql_endpoint_url)['results']['bindings']
-            self.format_query_results(r, prop_nr)
-            self.update_frc_from_query(r, prop_nr)
-
-    def _query_lang(self, lang, lang_data_type):
+    def _query_lang(self, lang, lang_data_type, qids=None, use_cache=True):
         """
 
         :param lang:
         :param lang_data_type:
+        :param qids: if given, only query the labels of these items
+        :param use_cache: look up the results in the SPARQL result cache, if caching is enabled
         :return:
         """
 
@@ -559,12 +1212,35 @@ class FastRunContainer(object):
                 ?item {2} ?label FILTER (lang(?label) = "{3}") .
             }}
         }}
-        '''.format(self.wikibase_url, self.base_filter_string, lang_data_type_dict[lang_data_type], lang)
+        '''.format(self.wikibase_url, self._get_base_filter_string(qids), lang_data_type_dict[lang_data_type], lang)
 
         if self.debug:
             print(query)
 
-        return self.engine.execute_sparql_query(query=query, endpoint=self.sparql_endpoint_url)['results']['bindings']
+        return self._sparql_bindings(query, use_cache=use_cache)
+
+    def _streams_results(self):
+        # An engine overriding `execute_sparql_query` but not `execute_sparql_query_iter` (e.g. to send the queries
+        # elsewhere) inherits the streaming of the base engine, which would bypass the override. The results are only
+        # streamed if `execute_sparql_query_iter` is defined by the same class, or a subclass of it.
+        def defined_by(name):
+            return next(klass for klass in self.engine.__mro__ if name in vars(klass))
+
+        return hasattr(self.engine, 'execute_sparql_query_iter') and \
+            issubclass(defined_by('execute_sparql_query_iter'), defined_by('execute_sparql_query'))
+
+    def _sparql_bindings(self, query, use_cache=True):
+        """
+        Run a query, and iterate over its bindings while they are received if the engine supports it
+
+        :param use_cache: look up the results in the SPARQL result cache, if caching is enabled
+        :return: iterable of bindings
+        """
+        if self._streams_results():
+            return self.engine.execute_sparql_query_iter(query, endpoint=self.sparql_endpoint_url, use_cache=use_cache,
+                                                         result_format=config['SPARQL_BULK_FORMAT'])
+        return self.engine.execute_sparql_query(query, endpoint=self.sparql_endpoint_url,
+                                                use_cache=use_cache)['results']['bindings']
 
     @staticmethod
     def _process_lang(result):
@@ -575,21 +1251,314 @@ class FastRunContainer(object):
                 data[qid].add(r['label']['value'])
         return data
 
-    @lru_cache(maxsize=100000)
     def get_prop_datatype(self, prop_nr):
-        item = self.engine(wd_item_id=prop_nr, sparql_endpoint_url=self.sparql_endpoint_url,
-                           mediawiki_api_url=self.mediawiki_api_url,
-                           wikibase_url=self.wikibase_url)
-        return item.entity_metadata['datatype']
+        return self.get_prop_datatypes([prop_nr])[prop_nr]
+
+    def get_prop_datatypes(self, props):
+        """
+        Look up the datatypes of properties. Unknown ones are fetched with one wbgetentities call per
+        `datatype_batch_size` properties, and kept in `prop_datatype_cache`, shared by all containers using the same
+        mediawiki api.
+
+        :param props: iterable of property IDs
+        :return: dict of property ID: datatype
+        :raises ValueError: if a property does not exist
+        """
+        props = set(props)
+        cache = self.prop_datatype_cache[self.mediawiki_api_url]
+        missing = sorted(props - set(cache))
+        for i in range(0, len(missing), self.datatype_batch_size):
+            params = {
+                'action': 'wbgetentities',
+                'ids': '|'.join(missing[i:i + self.datatype_batch_size]),
+                'props': 'datatype',
+                'format': 'json'
+            }
+            reply = self.engine.mediawiki_api_call('GET', self.mediawiki_api_url, params=params)
+            if 'error' in reply:
+                raise ValueError("Could not get the datatypes of {}: {}".format(params['ids'], reply['error']))
+            for entity in reply['entities'].values():
+                if 'datatype' in entity:
+                    cache[entity['id']] = entity['datatype']
+        unknown = sorted(props - set(cache))
+        if unknown:
+            raise ValueError("Could not get the datatypes of {}: no such properties".format(', '.join(unknown)))
+        return {prop_nr: cache[prop_nr] for prop_nr in props}
 
     def clear(self):
         """
         convinience function to empty this fastrun container
         """
         self.prop_dt_map = dict()
-        self.prop_data = dict()
-        self.rev_lookup = defaultdict(set)
-        self.rev_lookup_ci = defaultdict(set)
+        self.prop_data = CompactPropData() if self.compact else dict()
+        self.loaded_props = set()
+        self.loaded_qids = defaultdict(set)
+        self.loaded_lang_qids = defaultdict(set)
+        self._target_props = set()
+        self._pending_qids = set()
+        self.rev_lookup = ReverseIndex()
+        self.rev_lookup_ci = ReverseIndex()
+        self._fingerprints = dict()
+
+    def _get_base_filter_string(self, qids=None):
+        if not qids:
+            return self.base_filter_string
+        values = ' '.join('wd:{}'.format(qid) for qid in qids)
+        return 'VALUES ?item {{ {} }}\n'.format(values) + self.base_filter_string
+
+    def get_recent_changes(self, since):
+        """
+        Get the entities edited, created or deleted since `since` from the RecentChanges feed of the mediawiki api.
+        Only changes in the entity namespaces of config['RECENT_CHANGES_NAMESPACES'] are requested.
+
+        :param since: UTC timestamp to start from
+        :type since: datetime.datetime
+        :return: set of entity IDs
+        """
+        namespaces = config['RECENT_CHANGES_NAMESPACES']
+        params = {
+            'action': 'query',
+            'list': 'recentchanges',
+            'rcstart': since.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'rcdir': 'newer',
+            'rcprop': 'title|timestamp',
+            'rctype': 'edit|new|log',
+            'rcnamespace': '|'.join(str(ns) for ns in namespaces),
+            'rclimit': 'max',
+            'format': 'json'
+        }
+        entities = set()
+        while True:
+            json_data = self.engine.mediawiki_api_call('GET', self.mediawiki_api_url, params=params)
+            for change in json_data['query']['recentchanges']:
+                if 'ns' in change and change['ns'] not in namespaces:
+                    continue
+                # item pages are 'Q42' on wikidata, but 'Item:Q42' on a default wikibase install
+                title = change['title'].split(':')[-1]
+                if _entity_title_re.match(title):
+                    entities.add(title)
+            if 'continue' not in json_data:
+                break
+            params.update(json_data['continue'])
+        return entities
+
+    def refresh(self, since=None):
+        """
+        Bring this container up to date without reloading everything. The items edited since `since` are looked up
+        in the RecentChanges feed and only their data is queried again and replaced.
+
+        :param since: UTC timestamp to look for edits from. Defaults to the time the data in this container was loaded
+        :type since: datetime.datetime
+        :return: set of the entity IDs that were refreshed
+        """
+        since = self.data_timestamp if since is None else since
+        if since is None:
+            # nothing was loaded yet
+            return set()
+        # anything edited while the refresh is running is picked up by the next one
+        watermark = datetime.datetime.utcnow()
+        qids = self.get_recent_changes(since)
+        if self.debug:
+            print('refreshing {} entities edited since {}'.format(len(qids), since))
+        self.reload_items(qids)
+        self.data_timestamp = watermark
+        return qids
+
+    def reload_items(self, qids):
+        """
+        Remove the data of the items in `qids` and query them again, for all properties and labels loaded so far.
+        Items that no longer match the base filter are dropped. The SPARQL result cache is not used, as the items are
+        reloaded to get their current data.
+
+        :param qids: iterable of item IDs
+        """
+        qids = sorted(set(qids))
+        partial_props = [prop_nr for prop_nr, loaded in self.loaded_qids.items() if loaded & set(qids)]
+        partial_qids = set(chain(*self.loaded_qids.values())) & set(qids)
+        partial_lang = {k: loaded & set(qids) for k, loaded in self.loaded_lang_qids.items()}
+        self.remove_items(qids)
+        for i in range(0, len(qids), self.qid_chunk_size):
+            chunk = qids[i:i + self.qid_chunk_size]
+            if self.loaded_props:
+                self._query_props(sorted(self.loaded_props), qids=chunk, use_cache=False)
+            for lang, lang_data in self.loaded_langs.items():
+                for lang_data_type, data in lang_data.items():
+                    if (lang, lang_data_type) in self.loaded_lang_qids:
+                        continue
+                    result = self._query_lang(lang=lang, lang_data_type=lang_data_type, qids=chunk, use_cache=False)
+                    for qid, strings in self._process_lang(result).items():
+                        data[qid] = strings
+        if partial_props:
+            self.load_qids(partial_qids, partial_props, use_cache=False)
+        for (lang, lang_data_type), lang_qids in partial_lang.items():
+            self.load_lang_qids(lang_qids, lang, lang_data_type, use_cache=False)
+
+    def remove_items(self, qids):
+        """
+        Remove all data of the items in `qids` from this container
+
+        :param qids: iterable of item IDs
+        """
+        for qid in qids:
+            self._fingerprints.pop(qid, None)
+            for loaded in chain(self.loaded_qids.values(), self.loaded_lang_qids.values()):
+                loaded.discard(qid)
+            for statements in self.prop_data.pop(qid, dict()).values():
+                for d in statements.values():
+                    self._discard_rev_lookup(self.rev_lookup, d['v'], qid)
+                    if self.case_insensitive:
+                        self._discard_rev_lookup(self.rev_lookup_ci, d['v'].casefold(), qid)
+            for lang_data in self.loaded_langs.values():
+                for data in lang_data.values():
+                    data.pop(qid, None)
+
+    @staticmethod
+    def _add_rev_lookup(rev_lookup, value, qid):
+        if isinstance(rev_lookup, ReverseIndex):
+            rev_lookup.add(value, qid)
+        else:
+            rev_lookup.setdefault(value, set()).add(qid)
+
+    @staticmethod
+    def _discard_rev_lookup(rev_lookup, value, qid):
+        if isinstance(rev_lookup, ReverseIndex):
+            rev_lookup.discard(value, qid)
+        elif value in rev_lookup:
+            rev_lookup[value].discard(qid)
+            if not rev_lookup[value]:
+                del rev_lookup[value]
+
+    @staticmethod
+    def _intersect_rev_lookups(lookups):
+        """
+        The items having all values in `lookups`, a list of (reverse lookup, value). The lookups are checked
+        smallest first, without copying them.
+        """
+        if all(isinstance(rev_lookup, ReverseIndex) for rev_lookup, value in lookups) and \
+                len({id(rev_lookup) for rev_lookup, value in lookups}) == 1:
+            return lookups[0][0].intersect([value for rev_lookup, value in lookups])
+
+        def count(lookup):
+            rev_lookup, value = lookup
+            return rev_lookup.count(value) if isinstance(rev_lookup, ReverseIndex) else len(rev_lookup[value])
+
+        def contains(lookup, qid):
+            rev_lookup, value = lookup
+            return rev_lookup.contains(value, qid) if isinstance(rev_lookup, ReverseIndex) else \
+                qid in rev_lookup[value]
+
+        lookups = sorted(lookups, key=count)
+        rev_lookup, value = lookups[0]
+        return {qid for qid in rev_lookup[value] if all(contains(lookup, qid) for lookup in lookups[1:])}
+
+    def _set_data_timestamp(self):
+        if self.data_timestamp is None:
+            self.data_timestamp = datetime.datetime.utcnow()
+
+    def snapshot_key(self):
+        """
+        Key identifying the data held by this container. A snapshot is only loaded into a container with the same key.
+
+        :return: hex digest of `base_filter`, `use_refs` and `sparql_endpoint_url`
+        """
+        key = json.dumps([self.base_filter, self.use_refs, self.sparql_endpoint_url], sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_snapshot_path(self, snapshot_dir):
+        return os.path.join(snapshot_dir, 'fastrun_{}.pkl.gz'.format(self.snapshot_key()))
+
+    def save_snapshot(self, snapshot_dir):
+        """
+        Write the data currently held by this container to a gzipped pickle in `snapshot_dir`, so that a later process
+        can warm start from it with `load_snapshot`
+
+        :param snapshot_dir: directory the snapshot is written to. Created if it does not exist
+        :type snapshot_dir: str
+        :return: the path of the snapshot file
+        """
+        os.makedirs(snapshot_dir, exist_ok=True)
+        snapshot = {
+            'version': self.SNAPSHOT_VERSION,
+            'key': self.snapshot_key(),
+            'base_filter': self.base_filter,
+            'use_refs': self.use_refs,
+            'sparql_endpoint_url': self.sparql_endpoint_url,
+            'case_insensitive': self.case_insensitive,
+            'compact': self.compact,
+            'unindexed_props': self.unindexed_props,
+            'data_timestamp': self.data_timestamp,
+            'prop_data': self.prop_data,
+            'prop_dt_map': self.prop_dt_map,
+            'loaded_props': self.loaded_props,
+            'loaded_qids': self.loaded_qids,
+            'loaded_lang_qids': self.loaded_lang_qids,
+            'rev_lookup': self.rev_lookup,
+            'rev_lookup_ci': self.rev_lookup_ci,
+            'loaded_langs': self.loaded_langs,
+        }
+        path = self.get_snapshot_path(snapshot_dir)
+        # write to a temporary file first, so a crash never leaves a truncated snapshot behind
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with gzip.open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        if self.debug:
+            print('fastrun snapshot written to {}'.format(path))
+        return path
+
+    def load_snapshot(self, snapshot_dir, max_age=None):
+        """
+        Replace the data in this container with a snapshot written by `save_snapshot`. Only use snapshots from
+        trusted locations, they are pickles.
+
+        :param snapshot_dir: directory the snapshot was written to
+        :type snapshot_dir: str
+        :param max_age: if given, snapshots whose data is older than this are ignored
+        :type max_age: datetime.timedelta
+        :return: True if a snapshot was loaded, False if there is no usable snapshot
+        """
+        path = self.get_snapshot_path(snapshot_dir)
+        if not os.path.exists(path):
+            return False
+        with gzip.open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+
+        if snapshot.get('version') != self.SNAPSHOT_VERSION or snapshot.get('key') != self.snapshot_key():
+            if self.debug:
+                print('ignoring incompatible fastrun snapshot {}'.format(path))
+            return False
+        if self.target_qids is None and any(snapshot['loaded_qids'].values()):
+            # only some items were loaded for this snapshot
+            return False
+        if self.unindexed_props != snapshot['unindexed_props']:
+            return False
+        if self.case_insensitive and not snapshot['case_insensitive']:
+            # the case insensitive reverse lookup wasn't built for this snapshot
+            return False
+        if self.compact != snapshot.get('compact', False):
+            # the statements are stored in the other form (CompactPropData or dicts)
+            return False
+        if max_age is not None and (snapshot['data_timestamp'] is None or
+                                    datetime.datetime.utcnow() - snapshot['data_timestamp'] > max_age):
+            if self.debug:
+                print('ignoring outdated fastrun snapshot {}'.format(path))
+            return False
+
+        self.data_timestamp = snapshot['data_timestamp']
+        self.prop_data = snapshot['prop_data']
+        self.prop_dt_map = snapshot['prop_dt_map']
+        self.loaded_props = snapshot['loaded_props']
+        self.loaded_qids = snapshot['loaded_qids']
+        self.loaded_lang_qids = snapshot['loaded_lang_qids']
+        self._target_props = set()
+        self._pending_qids = set()
+        self.rev_lookup = snapshot['rev_lookup']
+        self.rev_lookup_ci = snapshot['rev_lookup_ci']
+        self.loaded_langs = snapshot['loaded_langs']
+        self._fingerprints = dict()
+        if self.debug:
+            print('fastrun snapshot loaded from {}, data from {}'.format(path, self.data_timestamp))
+        return True
 
     """A mixin implementing a simple __repr__."""
 
@@ -8,6 +8,7 @@ import pandas as pd
 from tqdm import tqdm
 
 from .. import wdi_core
+from ..wdi_config import config
 
 
 def take(n, iterable):
@@ -135,6 +136,8 @@ def prop2qid(prop, value, endpoint='https://query.wikidata.org/sparql'):
     :param value: value of property
     :type value: str
     :return: wdid as string or None
+
+    To look up many values, use `BatchResolver(prop).values_to_qids(values)` instead, which needs far fewer queries
     """
     arguments = '?item wdt:{} "{}"'.format(prop, value)
     query = 'SELECT * WHERE {{{}}}'.format(arguments)
@@ -190,15 +193,29 @@ def id_mapper(prop, filters=None, raise_on_duplicate=False, return_as_set=False,
         for f in filters:
             query += "?item wdt:{} wd:{} .\n".format(f[0], f[1])
     query = query + "}"
-    results = wdi_core.WDItemEngine.execute_sparql_query(query, endpoint=endpoint)['results']['bindings']
-    results = [{k: v['value'] for k, v in x.items()} for x in results]
-    for r in results:
+    results = []
+    for x in wdi_core.WDItemEngine.execute_sparql_query_iter(query, endpoint=endpoint,
+                                                             result_format=config['SPARQL_BULK_FORMAT']):
+        r = {k: v['value'] for k, v in x.items()}
         r['item'] = r['item'].split('/')[-1]
         if 'mrt' in r:
             r['mrt'] = r['mrt'].split('/')[-1]
+        results.append(r)
     if not results:
         return None
+    return _map_ids(results, raise_on_duplicate=raise_on_duplicate, return_as_set=return_as_set,
+                    prefer_exact_match=prefer_exact_match)
+
 
+def _map_ids(results, key='id', value='item', raise_on_duplicate=False, return_as_set=False,
+             prefer_exact_match=False):
+    """
+    Turn the rows of an ID mapping query into a dict of `key` to `value`, see `id_mapper` for the options
+
+    :param results: list of dicts with the ext ID in 'id', the QID in 'item' and the mapping relation type QID in 'mrt'
+    """
+    if not results:
+        return dict()
     if prefer_exact_match:
         df = pd.DataFrame(results)
         if 'mrt' not in df:
@@ -232,7 +249,7 @@ def id_mapper(prop, filters=None, raise_on_duplicate=False, return_as_set=False,
 
     id_qid = defaultdict(set)
     for r in results:
-        id_qid[r['id']].add(r['item'])
+        id_qid[r[key]].add(r[value])
     dupe = {k: v for k, v in id_qid.items() if len(v) > 1}
     if raise_on_duplicate and dupe:
         raise ValueError("duplicate ids: {}".format(dupe))
@@ -240,13 +257,13 @@ def id_mapper(prop, filters=None, raise_on_duplicate=False, return_as_set=False,
     if return_as_set:
         return dict(id_qid)
     else:
-        return {x['id']: x['item'] for x in results}
+        return {x[key]: x[value] for x in results}
 
 
 def get_values(pid, values, endpoint='https://query.wikidata.org/sparql'):
     """
     This is a basic version of id_mapper, but restrict to values in `values`.
-    Missing IDs are ignored
+    Missing IDs are ignored. Like the `wdt:` prefix, only statements of the best rank are used
 
     :param pid: PID
     :param values: list of strings
@@ -255,18 +272,7 @@ def get_values(pid, values, endpoint='https://query.wikidata.org/sparql'):
     Example: Get the QIDs for the items with these PMIDs:
      get_values("P698", ["9719382", "9729004", "16384941"]) -> {'16384941': 'Q24642869', '9719382': 'Q33681179'}
     """
-    chunks = chunked(values, 100)
-    d = dict()
-    for chunk in tqdm(chunks, total=round(len(values) / 100)):
-        value_quotes = '"' + '" "'.join(map(str, chunk)) + '"'
-        query = """select * where {
-              values ?x {**value_quotes**}
-              ?item wdt:**pid** ?x
-            }""".replace("**value_quotes**", value_quotes).replace("**pid**", pid)
-        results = wdi_core.WDItemEngine.execute_sparql_query(query, endpoint=endpoint)['results']['bindings']
-        dl = [{k: v['value'] for k, v in item.items()} for item in results]
-        d.update({x['x']: x['item'].replace("http://www.wikidata.org/entity/", "") for x in dl})
-    return d
+    return BatchResolver(pid, endpoint=endpoint, truthy=True, progress=True).values_to_qids(values)
 
 
 def get_last_modified_header(entity="http://www.wikidata.org", endpoint='https://query.wikidata.org/sparql'):
@@ -298,6 +304,7 @@ def wait_for_last_modified(timestamp, delay=30, entity="http://www.wikidata.org"
         sleep(delay)
 
 
+from .batch_resolver import BatchResolver
 from .mapping_relation_helper import MappingRelationHelper
 from .publication import PublicationHelper
 from .release import Release
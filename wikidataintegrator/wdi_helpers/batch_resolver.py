@@ -0,0 +1,157 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tqdm import tqdm
+
+from wikidataintegrator import wdi_core
+from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_helpers import _map_ids
+
+
+class BatchResolver(object):
+    """
+    Look up the items having many values of an external ID property, or the values of many items, with queries of
+    `VALUES` chunks run in parallel. Each query goes through `execute_sparql_query`, so they all stay within the
+    query budget of the endpoint (see wdi_query_budget).
+
+    The size of the chunks adapts to the time the queries take: it grows while queries finish well within
+    `target_latency`, and shrinks when they take longer. A chunk never makes a query longer than
+    `max_query_length` characters.
+
+    Example: the items of many PMIDs
+    >>> BatchResolver('P698').values_to_qids(["9719382", "9729004", "16384941"])
+    {'9719382': 'Q33681179', '16384941': 'Q24642869'}
+    """
+    initial_chunk_size = 500
+    min_chunk_size = 10
+    max_chunk_size = 10000
+    # seconds a chunk's query should take
+    target_latency = 10
+    # characters in a query. The query service takes queries of about 1MB, but long ones are slow to parse
+    max_query_length = 200000
+
+    def __init__(self, prop, endpoint=None, max_workers=None, raise_on_duplicate=False, prefer_exact_match=False,
+                 truthy=False, progress=False):
+        """
+        :param prop: property ID of the external ID, e.g. 'P698'
+        :param endpoint: The URL of the SPARQL endpoint. Default config['SPARQL_ENDPOINT_URL']
+        :param max_workers: number of queries run in parallel. Default config['SPARQL_MAX_CONCURRENT']
+        :param raise_on_duplicate: raise ValueError if a value is on more than one item (or an item has more than one
+            value), see `id_mapper`
+        :param prefer_exact_match: of several mappings of a value, keep those marked as exact match, see `id_mapper`
+        :param truthy: only use the statements of the best rank, like the `wdt:` prefix does: no deprecated
+            statements, and only the preferred ones if there are any. By default all statements are used
+        :param progress: show a progress bar
+        """
+        self.prop = prop
+        self.endpoint = config['SPARQL_ENDPOINT_URL'] if endpoint is None else endpoint
+        self.max_workers = config['SPARQL_MAX_CONCURRENT'] if max_workers is None else max_workers
+        self.raise_on_duplicate = raise_on_duplicate
+        self.prefer_exact_match = prefer_exact_match
+        self.truthy = truthy
+        self.progress = progress
+        self.chunk_size = self.initial_chunk_size
+
+    @staticmethod
+    def _quote(value):
+        return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+    def _query(self, variable, terms):
+        query = "SELECT ?id ?item ?mrt WHERE {{\nVALUES ?{} {{ {} }}\n".format(variable, ' '.join(terms))
+        query += "?item p:{0} ?s .\n?s ps:{0} ?id .\n".format(self.prop)
+        if self.truthy:
+            query += "?s a wikibase:BestRank .\n"
+        query += "OPTIONAL {?s pq:P4390 ?mrt}\n}"
+        return query
+
+    def _run_chunk(self, variable, terms):
+        start = time.time()
+        results = wdi_core.WDItemEngine.execute_sparql_query(self._query(variable, terms), endpoint=self.endpoint,
+                                                             result_format=config['SPARQL_BULK_FORMAT'],
+                                                             query_class='bulk')
+        rows = []
+        for x in results['results']['bindings']:
+            r = {k: v['value'] for k, v in x.items()}
+            r['item'] = r['item'].split('/')[-1]
+            if 'mrt' in r:
+                r['mrt'] = r['mrt'].split('/')[-1]
+            rows.append(r)
+        return rows, time.time() - start
+
+    def _adapt(self, n, duration):
+        # move the chunk size halfway towards the one that would take `target_latency`
+        ideal = n * self.target_latency / max(duration, 0.001)
+        size = max(self.chunk_size / 2, min(self.chunk_size * 2, (self.chunk_size + ideal) / 2))
+        self.chunk_size = int(max(self.min_chunk_size, min(self.max_chunk_size, size)))
+
+    def _take(self, terms, pos):
+        # the end of the next chunk starting at pos
+        length = len(self._query('id', []))
+        end = pos
+        while end < len(terms) and end - pos < self.chunk_size:
+            length += len(terms[end]) + 1
+            if length > self.max_query_length and end > pos:
+                break
+            end += 1
+        return end
+
+    def _resolve(self, variable, terms):
+        rows = [None] * len(terms)
+        pos = 0
+        bar = tqdm(total=len(terms)) if self.progress else None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = dict()
+            while pos < len(terms) or running:
+                while pos < len(terms) and len(running) < self.max_workers:
+                    end = self._take(terms, pos)
+                    running[executor.submit(self._run_chunk, variable, terms[pos:end])] = (pos, end)
+                    pos = end
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, end = running.pop(future)
+                    chunk_rows, duration = future.result()
+                    rows[start] = chunk_rows
+                    self._adapt(end - start, duration)
+                    if bar is not None:
+                        bar.update(end - start)
+        if bar is not None:
+            bar.close()
+        # in the order of the chunks, whichever finished first
+        return [r for chunk_rows in rows if chunk_rows for r in chunk_rows]
+
+    def _mapping(self, rows, key, keys, return_as_set):
+        value = 'item' if key == 'id' else 'id'
+        mapping = _map_ids(rows, key=key, value=value, raise_on_duplicate=self.raise_on_duplicate,
+                          return_as_set=return_as_set, prefer_exact_match=self.prefer_exact_match)
+        return {k: mapping[k] for k in keys if k in mapping}
+
+    def values_to_qids(self, values, return_as_set=False):
+        """
+        :param values: iterable of values of the property
+        :param return_as_set: If True, all values in the returned dict will be a set of QIDs
+        :return: dict of value to the QID of the item having it, in the order of `values`. Values on no item are left
+            out.
+        """
+        values = list(dict.fromkeys(str(v) for v in values))
+        rows = self._resolve('id', [self._quote(v) for v in values])
+        return self._mapping(rows, 'id', values, return_as_set)
+
+    def qids_to_values(self, qids, return_as_set=False):
+        """
+        :param qids: iterable of item IDs
+        :param return_as_set: If True, all values in the returned dict will be a set of values
+        :return: dict of QID to the value of the property on the item, in the order of `qids`. Items without a value
+            are left out.
+        """
+        qids = list(dict.fromkeys(qids))
+        rows = self._resolve('item', ['<{}{}>'.format(config['CONCEPT_BASE_URI'], qid) for qid in qids])
+        return self._mapping(rows, 'item', qids, return_as_set)
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items()),
+        )
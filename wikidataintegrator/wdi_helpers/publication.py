@@ -4,11 +4,11 @@ import difflib
 import argparse
 import sys
 import os
-import requests
 from dateutil import parser as du
 
 from .. import wdi_core, wdi_login
 from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_transport import get_transport
 from wikidataintegrator.wdi_helpers import prop2qid, PROPS, try_write
 
 
@@ -328,7 +328,7 @@ def crossref_api_to_publication(ext_id, id_type="doi"):
     url = "https://api.crossref.org/v1/works/https://doi.org/{}"
     url = url.format(ext_id)
 
-    response = requests.get(url)
+    response = get_transport().get(url)
     response.raise_for_status()
     r = response.json()
 
@@ -374,7 +374,7 @@ def opencitations_api_to_publication(ext_id, id_type="doi"):
     url = "https://w3id.org/oc/index/api/v1/metadata/{}"
     url = url.format(ext_id)
 
-    response = requests.get(url)
+    response = get_transport().get(url)
     response.raise_for_status()
     r = response.json()
 
@@ -420,7 +420,7 @@ def europepmc_api_to_publication(ext_id, id_type):
     headers = {
         'User-Agent': config['USER_AGENT_DEFAULT']
     }
-    response = requests.get(url, headers=headers)
+    response = get_transport().get(url, headers=headers)
     response.raise_for_status()
     d = response.json()
     if d['hitCount'] != 1:
@@ -551,7 +551,7 @@ def biorxiv_api_to_publication(biorxiv_id: str, id_type='biorxiv') -> Publicatio
     headers = {
         'User-Agent': config['USER_AGENT_DEFAULT']
     }
-    response = requests.get(url, headers=headers)
+    response = get_transport().get(url, headers=headers)
     response.raise_for_status()
     revisions = response.json()['collection']
     latest_revision = revisions[-1]
@@ -587,7 +587,7 @@ def chemrxiv_api_to_publication(chemrxiv_id: str, id_type='chemrxiv') -> Publica
     headers = {
         'User-Agent': config['USER_AGENT_DEFAULT']
     }
-    res = requests.get(url, headers=headers)
+    res = get_transport().get(url, headers=headers)
     res.raise_for_status()
     res_json = res.json()
 
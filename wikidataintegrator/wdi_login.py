@@ -7,6 +7,7 @@ from requests_oauthlib import OAuth1
 from wikidataintegrator.wdi_config import config
 
 from wikidataintegrator.wdi_backoff import wdi_backoff
+from wikidataintegrator.wdi_transport import get_transport
 
 __author__ = 'Sebastian Burgstaller-Muehlbacher, Tim Putman, Andra Waagmeester'
 __license__ = 'AGPLv3'
@@ -55,6 +56,8 @@ class WDLogin(object):
         if user:
             self.user = user
         self.s = requests.Session()
+        # share the connection pools with the rest of wikidataintegrator, the session keeps its own cookies
+        get_transport().mount(self.s)
         self.edit_token = ''
         self.rollback_token = ''
         self.instantiation_time = time.time()
@@ -0,0 +1,185 @@
+"""
+Query time budget for SPARQL endpoints.
+
+The Wikidata query service limits each client to 60 seconds of query time per minute and 5 parallel queries, and
+answers with 429 and a Retry-After header once a client goes over. A `QueryBudget` keeps track of the time used by
+all the queries of the process on an endpoint, as a bucket of query seconds that refills at `query_time` per `window`.
+Queries wait, in the order they arrive, until there are enough seconds in the bucket for their expected duration and
+fewer than `max_concurrent` queries are running. A 429 pauses all queries to the endpoint for the Retry-After time.
+This way the queries of parallel threads, async clients and long fastrun pulls are spread out, instead of running
+into the limit and all of them waiting for whole minutes.
+
+Budgets are off by default, as other endpoints have other limits or none. To stay within the limits of the Wikidata
+query service:
+
+    set_budget(config['SPARQL_ENDPOINT_URL'], QueryBudget(query_time=60, max_concurrent=5))
+
+Options (see wdi_config):
+SPARQL_QUERY_TIME_BUDGET: seconds of query time per minute, per endpoint. None disables the budget
+SPARQL_MAX_CONCURRENT: maximum number of queries running at the same time, per endpoint
+"""
+
+import threading
+import time
+from collections import deque
+
+from wikidataintegrator.wdi_config import config
+
+
+class QueryBudget(object):
+    # weight of the newest duration in the estimate of the next one
+    estimate_weight = 0.2
+
+    def __init__(self, query_time=None, window=60, max_concurrent=None):
+        """
+        :param query_time: seconds of query time allowed per `window`. Default from config['SPARQL_QUERY_TIME_BUDGET']
+        :type query_time: float
+        :param window: length of the window in seconds
+        :type window: float
+        :param max_concurrent: maximum number of queries running at the same time. Default from
+            config['SPARQL_MAX_CONCURRENT']
+        :type max_concurrent: int
+        """
+        self.query_time = config['SPARQL_QUERY_TIME_BUDGET'] if query_time is None else query_time
+        self.window = window
+        self.max_concurrent = config['SPARQL_MAX_CONCURRENT'] if max_concurrent is None else max_concurrent
+        self.estimate = 1.0
+        self.blocked_until = 0
+        self.queries = 0
+        self.time_used = 0.0
+        self.time_waited = 0.0
+
+        self._condition = threading.Condition()
+        self._available = self.query_time
+        self._updated = time.time()
+        self._reserved = 0.0
+        self._running = 0
+        self._queue = deque()
+
+    def _refill(self, now):
+        rate = self.query_time / self.window
+        self._available = min(self.query_time, self._available + (now - self._updated) * rate)
+        self._updated = now
+
+    def _wait_time(self, now):
+        # seconds until the next query may start, 0 if it can start now, None if it has to wait for a query to end
+        if self._running >= self.max_concurrent:
+            return None
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # a query longer than the whole budget can still run when nothing else is
+        needed = min(self.estimate, self.query_time) + self._reserved
+        if self._available >= needed:
+            return 0
+        return (needed - self._available) * self.window / self.query_time
+
+    def acquire(self):
+        """
+        Wait until a query may be sent
+
+        :return: the reservation to pass to `release`
+        """
+        ticket = object()
+        start = time.time()
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    wait = self._wait_time(now) if self._queue[0] is ticket else None
+                    if wait == 0:
+                        break
+                    self._condition.wait(timeout=wait)
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+            reservation = self.estimate
+            self._reserved += reservation
+            self._running += 1
+            self.time_waited += time.time() - start
+        return reservation
+
+    def release(self, reservation, duration):
+        """
+        Record the end of a query
+
+        :param reservation: the return value of `acquire`
+        :param duration: seconds the query took
+        """
+        with self._condition:
+            self._refill(time.time())
+            self._available -= duration
+            self._reserved -= reservation
+            self._running -= 1
+            self.estimate += self.estimate_weight * (duration - self.estimate)
+            self.queries += 1
+            self.time_used += duration
+            self._condition.notify_all()
+
+    def throttle(self, seconds):
+        """
+        Pause all queries, e.g. after a 429 reply with a Retry-After header
+
+        :param seconds: number of seconds from now
+        """
+        with self._condition:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+            # the endpoint thinks the budget is used up
+            self._available = min(self._available, 0)
+            self._condition.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call `func` within the budget, and count its run time as query time
+
+        :return: the return value of func
+        """
+        reservation = self.acquire()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(reservation, time.time() - start)
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items() if not k.startswith('_')),
+        )
+
+
+_budgets = dict()
+_budgets_lock = threading.Lock()
+
+
+def get_budget(endpoint):
+    """
+    The query budget of an endpoint, shared by the whole process and created on first use
+
+    :param endpoint: url of the SPARQL endpoint
+    :return: QueryBudget, or None if config['SPARQL_QUERY_TIME_BUDGET'] is None and none was set for the endpoint
+    """
+    budget = _budgets.get(endpoint)
+    if budget is None and config['SPARQL_QUERY_TIME_BUDGET'] is not None:
+        with _budgets_lock:
+            budget = _budgets.get(endpoint)
+            if budget is None:
+                budget = _budgets[endpoint] = QueryBudget()
+    return budget
+
+
+def set_budget(endpoint, budget):
+    """
+    Replace the query budget of an endpoint
+
+    :param budget: QueryBudget, or None to create a new one from the config on next use
+    """
+    with _budgets_lock:
+        if budget is None:
+            _budgets.pop(endpoint, None)
+        else:
+            _budgets[endpoint] = budget
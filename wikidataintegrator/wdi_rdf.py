@@ -1,8 +1,8 @@
 from rdflib import Graph, URIRef, Literal, Namespace, BNode
 from rdflib.namespace import RDF, RDFS, SKOS, XSD, OWL, PROV
 from wikidataintegrator import wdi_core, wdi_config
+from wikidataintegrator.wdi_transport import get_transport
 import uuid
-import requests
 import json
 import urllib.parse
 
@@ -53,7 +53,7 @@ class WDqidRDFEngine(object):
             self.fetch_truthy_rdf = fetch_truthy_rdf
             self.fetch_linked_items_rdf = fetch_linked_items_rdf
         if bool(qid):
-            self.json_item = json.loads(requests.get("http://www.wikidata.org/entity/" + qid + ".json").text)["entities"][
+            self.json_item = json.loads(get_transport().get("http://www.wikidata.org/entity/" + qid + ".json").text)["entities"][
                 qid]
         else:
             self.json_item = json_data
@@ -180,7 +180,7 @@ class WDqidRDFEngine(object):
 
     def fetch_merged_items(self):
         # Merged items
-        merged_items = json.loads(requests.get(
+        merged_items = json.loads(get_transport().get(
             "https://www.wikidata.org/w/api.php?action=query&prop=redirects&format=json&titles=" + self.qid).text)
         for page in merged_items["query"]["pages"].keys():
             if "redirects" in merged_items["query"]["pages"][page].keys():
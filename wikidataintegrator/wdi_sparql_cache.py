@@ -0,0 +1,286 @@
+"""
+On-disk cache for SPARQL query results.
+
+Bots and notebooks tend to send the same, often heavy, queries on every run (distinct value properties, the reference
+system, id mappings, fastrun data). With the cache enabled, `execute_sparql_query` first looks the query up on disk and
+only goes to the query service on a miss. Entries are gzip compressed json files named by a hash of the endpoint and
+the normalized query. They expire after a time to live, can be checked against the `schema:dateModified` of the
+endpoint, and the least recently used entries are removed once the cache grows over its size limit. Queries whose
+results must be current, like the lookup of the item to write to in WDItemEngine and the reload of the items edited
+since a fastrun container was loaded, don't use the cache.
+
+The cache is off by default. Enable it with:
+
+    from wikidataintegrator.wdi_config import config
+    config['SPARQL_CACHE_DIR'] = '~/.cache/wikidataintegrator/sparql'
+
+or set a cache object at run time:
+
+    from wikidataintegrator import wdi_sparql_cache
+    wdi_sparql_cache.set_cache(wdi_sparql_cache.SparqlResultCache('/tmp/sparql', ttl=3600))
+
+Options (see wdi_config):
+SPARQL_CACHE_DIR: directory of the cache, None disables the cache
+SPARQL_CACHE_TTL: number of seconds an entry is used for, None for no expiry
+SPARQL_CACHE_MAX_SIZE: maximum size of the cache directory in bytes
+SPARQL_CACHE_VALIDATE: None, or number of seconds the data of the endpoint may have changed since an entry was stored
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_transport import get_transport
+
+# default of the options of SparqlResultCache, for which None has a meaning of its own
+_from_config = object()
+
+
+class SparqlResultCache(object):
+    # how long the dateModified of an endpoint is remembered before it is asked again, in seconds
+    date_modified_interval = 60
+    # number of entries stored before the size of the cache directory is counted again, for entries added by other
+    # processes using the same directory
+    evict_interval = 1000
+
+    def __init__(self, cache_dir, ttl=_from_config, max_size=_from_config, validate=_from_config):
+        """
+        :param cache_dir: directory the results are stored in, created if needed
+        :type cache_dir: str
+        :param ttl: number of seconds an entry is used for, None for no expiry. Default from
+            config['SPARQL_CACHE_TTL']
+        :type ttl: int
+        :param max_size: maximum total size of the entries in bytes, None for no limit. Default from
+            config['SPARQL_CACHE_MAX_SIZE']
+        :type max_size: int
+        :param validate: if set, query the `schema:dateModified` of the endpoint and don't use entries stored when the
+            data of the endpoint was more than this number of seconds older than it is now. 0 invalidates on any
+            update, None doesn't validate. Default from config['SPARQL_CACHE_VALIDATE']
+        :type validate: int
+        """
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.ttl = config['SPARQL_CACHE_TTL'] if ttl is _from_config else ttl
+        self.max_size = config['SPARQL_CACHE_MAX_SIZE'] if max_size is _from_config else max_size
+        self.validate = config['SPARQL_CACHE_VALIDATE'] if validate is _from_config else validate
+        self.hits = 0
+        self.misses = 0
+        self._date_modified = dict()
+        # size of the entries as of the last eviction plus the entries stored since, and the number stored since
+        self._size = None
+        self._puts = 0
+        self._size_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalize_query(query):
+        """
+        Remove indentation, trailing whitespace and empty lines, so that queries only formatted differently share an
+        entry. Whitespace within a line is kept, as it may be part of a literal.
+        """
+        return '\n'.join(line.strip() for line in query.splitlines() if line.strip())
+
+    def key(self, query, endpoint):
+        """
+        :return: the name of the entry for a query on an endpoint
+        """
+        s = endpoint + '\n' + self.normalize_query(query)
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json.gz')
+
+    def get(self, query, endpoint):
+        """
+        Look up the results of a query
+
+        :return: the json results, or None if there is no valid entry
+        """
+        path = self._path(self.key(query, endpoint))
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, EOFError, ValueError):
+            # missing, or partially written by a process that was killed
+            self.misses += 1
+            return None
+
+        if not self._is_valid(entry, endpoint):
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry['results']
+
+    def put(self, query, endpoint, results):
+        """
+        Store the results of a query, then remove the least recently used entries if the cache is too large. The size
+        of the cache is kept track of as entries are stored, so the directory is only listed when it goes over
+        `max_size`, or every `evict_interval` entries.
+        """
+        entry = {
+            'endpoint': endpoint,
+            'query': query,
+            'stored': time.time(),
+            'date_modified': self.get_date_modified(endpoint) if self.validate is not None else None,
+            'results': results
+        }
+        path = self._path(self.key(query, endpoint))
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f)
+        size = os.path.getsize(tmp_path)
+        try:
+            # an entry that is replaced doesn't add its size
+            size -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+
+        if self.max_size is None:
+            return
+        with self._size_lock:
+            self._puts += 1
+            if self._size is not None:
+                self._size += size
+            evict = self._size is None or self._size > self.max_size or self._puts >= self.evict_interval
+        if evict:
+            self.evict()
+
+    def _is_valid(self, entry, endpoint):
+        if self.ttl is not None and time.time() - entry['stored'] > self.ttl:
+            return False
+        if self.validate is not None:
+            if entry['date_modified'] is None:
+                return False
+            date_modified = self.get_date_modified(endpoint)
+            if date_modified - entry['date_modified'] > self.validate:
+                return False
+        return True
+
+    def get_date_modified(self, endpoint):
+        """
+        The time of the last update of the data of an endpoint, see `wdi_helpers.get_last_modified_header`
+
+        :return: posix timestamp
+        """
+        checked, date_modified = self._date_modified.get(endpoint, (0, None))
+        if time.time() - checked < self.date_modified_interval:
+            return date_modified
+
+        query = "SELECT ?d WHERE {{ <{}> schema:dateModified ?d }}".format(config['WIKIBASE_URL'])
+        headers = {
+            'Accept': 'application/sparql-results+json',
+            'User-Agent': config['USER_AGENT_DEFAULT']
+        }
+        response = get_transport().post(endpoint, data={'query': query, 'format': 'json'}, headers=headers)
+        response.raise_for_status()
+        t = response.json()['results']['bindings'][0]['d']['value']
+        try:
+            # wikidata format
+            dt = datetime.datetime.strptime(t, '%Y-%m-%dT%H:%M:%SZ')
+        except ValueError:
+            # wikibase format
+            dt = datetime.datetime.strptime(t, '%Y-%m-%dT%H:%M:%S.%fZ')
+        date_modified = dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self._date_modified[endpoint] = (time.time(), date_modified)
+        return date_modified
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json.gz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def size(self):
+        """
+        :return: total size of the entries in bytes
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is no larger than max_size
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            self._remove(os.path.join(self.cache_dir, name))
+            total -= size
+        with self._size_lock:
+            self._size = total
+            self._puts = 0
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        for _, _, name in self._entries():
+            self._remove(os.path.join(self.cache_dir, name))
+        with self._size_lock:
+            self._size = None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items()),
+        )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    The SPARQL result cache, created on first use if config['SPARQL_CACHE_DIR'] is set
+
+    :return: SparqlResultCache, or None if caching is off
+    """
+    global _cache
+    if _cache is None and config['SPARQL_CACHE_DIR']:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SparqlResultCache(config['SPARQL_CACHE_DIR'])
+    return _cache
+
+
+def set_cache(cache):
+    """
+    Replace the SPARQL result cache
+
+    :param cache: SparqlResultCache, or None to create a new one from the config on next use
+    """
+    global _cache
+    with _cache_lock:
+        _cache = cache
@@ -0,0 +1,289 @@
+"""
+Parsers for SPARQL query results that don't need the whole response in memory.
+
+`response.json()` first reads the complete body, then builds a dict holding every binding. For queries returning
+millions of rows, that is several times the size of the data actually kept by the caller. The parsers here work on
+the body as it is received, and yield one binding at a time.
+
+Besides the JSON format, results can be read from the much smaller TSV format, whose terms are parsed into the same
+dicts as JSON results have, and from CSV, which only has the values.
+
+`results_to_df` turns results into a pandas dataframe, converting one column at a time.
+"""
+
+import codecs
+import csv
+import json
+import re
+
+import pandas as pd
+
+from wikidataintegrator.wdi_config import config
+
+_bindings_start = re.compile(r'"bindings"\s*:\s*\[')
+_separator = re.compile(r'[\s,]*')
+_decoder = json.JSONDecoder()
+
+
+def iter_json_bindings(chunks):
+    """
+    Parse a SPARQL JSON results document (https://www.w3.org/TR/sparql11-results-json/) incrementally, and yield its
+    bindings. Only the binding being parsed and the unparsed rest of the last chunk are kept in memory.
+
+    :param chunks: iterable of bytes, e.g. `response.iter_content(chunk_size)`
+    :return: generator of dicts, like the items of results['results']['bindings']
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = None  # the position in buf within the bindings array, once its start was found
+    eof = False
+    chunks = iter(chunks)
+    while not eof:
+        try:
+            buf += decoder.decode(next(chunks))
+        except StopIteration:
+            buf += decoder.decode(b'', final=True)
+            eof = True
+
+        if pos is None:
+            m = _bindings_start.search(buf)
+            if not m:
+                continue
+            pos = m.end()
+
+        while True:
+            pos = _separator.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if buf[pos] == ']':
+                # the rest of the document holds nothing of interest
+                return
+            try:
+                binding, pos_end = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                # the binding continues in the next chunk
+                break
+            yield binding
+            pos = pos_end
+        buf = buf[pos:]
+        pos = 0
+
+    raise ValueError("SPARQL results ended before the end of the bindings")
+
+
+# media types of the result formats, see https://www.w3.org/TR/sparql11-results-csv-tsv/
+RESULT_FORMATS = {
+    'json': 'application/sparql-results+json',
+    'tsv': 'text/tab-separated-values',
+    'csv': 'text/csv'
+}
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+_escape = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_escapes = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _unescape(m):
+    if m.group(3) is not None:
+        return _escapes.get(m.group(3), m.group(3))
+    return chr(int(m.group(1) or m.group(2), 16))
+
+
+def parse_term(term):
+    """
+    Parse an RDF term as written in SPARQL TSV results (N-Triples, with the Turtle abbreviations for numbers and
+    booleans), into the dict used for it in SPARQL JSON results, e.g. `"a"@en` -> {'type': 'literal', 'value': 'a',
+    'xml:lang': 'en'}
+
+    :param term: str
+    :return: dict
+    """
+    c = term[0]
+    if c == '<':
+        return {'type': 'uri', 'value': term[1:-1]}
+    if c == '"':
+        # the language tag or datatype IRI after the closing quote can't contain a quote
+        end = term.rindex('"')
+        value = term[1:end]
+        if '\\' in value:
+            value = _escape.sub(_unescape, value)
+        binding = {'type': 'literal', 'value': value}
+        suffix = term[end + 1:]
+        if suffix.startswith('@'):
+            binding['xml:lang'] = suffix[1:]
+        elif suffix.startswith('^^'):
+            binding['datatype'] = suffix[3:-1]
+        return binding
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    if term in ('true', 'false'):
+        datatype = 'boolean'
+    elif 'e' in term or 'E' in term:
+        datatype = 'double'
+    elif '.' in term:
+        datatype = 'decimal'
+    else:
+        datatype = 'integer'
+    return {'type': 'literal', 'value': term, 'datatype': XSD + datatype}
+
+
+def _iter_lines(chunks, keepends=False):
+    # lines of a utf-8 encoded stream of bytes
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    rest = ''
+    for chunk in chunks:
+        # not splitlines, which also splits on characters allowed unescaped within a value
+        lines = (rest + decoder.decode(chunk)).split('\n')
+        rest = lines.pop()
+        if keepends:
+            for line in lines:
+                yield line + '\n'
+        else:
+            yield from lines
+    rest += decoder.decode(b'', final=True)
+    if rest:
+        yield rest
+
+
+def iter_tsv_bindings(chunks, head=None):
+    """
+    Parse SPARQL TSV results incrementally, and yield their bindings in the format of SPARQL JSON results
+
+    :param chunks: iterable of bytes, e.g. `response.iter_content(chunk_size)`
+    :param head: if given, a dict in which 'vars' is set to the variables of the results
+    :return: generator of dicts, like the items of results['results']['bindings']
+    """
+    lines = _iter_lines(chunks)
+    header = next(lines, '').rstrip('\r')
+    variables = [v[1:] for v in header.split('\t')] if header else []
+    if head is not None:
+        head['vars'] = variables
+    for line in lines:
+        if line.endswith('\r'):
+            line = line[:-1]
+        # most terms are IRIs, which are parsed here to save a function call
+        yield {var: {'type': 'uri', 'value': term[1:-1]} if term[0] == '<' else parse_term(term)
+               for var, term in zip(variables, line.split('\t')) if term}
+
+
+def iter_csv_bindings(chunks, head=None):
+    """
+    Parse SPARQL CSV results incrementally. CSV results have neither the type, the datatype nor the language of the
+    values, so the bindings only have a 'value'. Unbound variables and empty strings are not told apart either.
+
+    :param chunks: iterable of bytes, e.g. `response.iter_content(chunk_size)`
+    :param head: if given, a dict in which 'vars' is set to the variables of the results
+    :return: generator of dicts, like the items of results['results']['bindings'] without the types
+    """
+    rows = csv.reader(_iter_lines(chunks, keepends=True))
+    variables = next(rows, [])
+    if head is not None:
+        head['vars'] = variables
+    for row in rows:
+        yield {var: {'value': value} for var, value in zip(variables, row) if value}
+
+
+def iter_bindings(chunks, result_format='json', head=None):
+    """
+    Parse SPARQL results in one of the RESULT_FORMATS incrementally
+
+    :param head: if given, a dict in which 'vars' is set to the variables of tsv or csv results
+    :return: generator of the bindings
+    """
+    if result_format == 'json':
+        return iter_json_bindings(chunks)
+    if result_format == 'tsv':
+        return iter_tsv_bindings(chunks, head=head)
+    if result_format == 'csv':
+        return iter_csv_bindings(chunks, head=head)
+    raise ValueError("unknown SPARQL result format: {}".format(result_format))
+
+
+_integer_types = {XSD + t for t in ('integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger',
+                                    'positiveInteger', 'nonPositiveInteger', 'negativeInteger', 'unsignedInt',
+                                    'unsignedLong', 'unsignedShort', 'unsignedByte')}
+_float_types = {XSD + t for t in ('decimal', 'double', 'float')}
+_datetime_type = XSD + 'dateTime'
+
+
+def _convert(values, datatype):
+    # values of one datatype, as a Series
+    if datatype in _integer_types:
+        return pd.to_numeric(pd.Series(values, dtype=object))
+    if datatype in _float_types:
+        return pd.Series(values, dtype=object).astype(float)
+    if datatype == _datetime_type:
+        try:
+            return pd.Series(pd.to_datetime(values, format='%Y-%m-%dT%H:%M:%SZ'))
+        except (ValueError, OverflowError):
+            # dates pandas can't hold (e.g. years before the common era) are kept as strings, for the whole column
+            return pd.Series(values)
+    return pd.Series(values)
+
+
+def _to_column(rows, values, kinds, n, strip_prefix, categorical):
+    # the values and their datatypes (or term types) of one variable, which is bound in `rows` of `n`
+    if strip_prefix:
+        length = len(strip_prefix)
+        values = [v[length:] if k == 'uri' and v.startswith(strip_prefix) else v for v, k in zip(values, kinds)]
+
+    kind_set = set(kinds)
+    if len(kind_set) == 1:
+        column = _convert(values, kinds[0])
+        if categorical and kind_set == {'uri'}:
+            column = column.astype('category')
+    else:
+        # values of several types are each converted to their own type, in an object column
+        column = pd.Series([None] * len(values), dtype=object)
+        for kind in kind_set:
+            positions = [i for i, k in enumerate(kinds) if k == kind]
+            column.iloc[positions] = _convert([values[i] for i in positions], kind).astype(object).to_numpy()
+
+    if len(rows) < n:
+        column.index = rows
+        column = column.reindex(range(n))
+    return column
+
+
+def results_to_df(results, strip_prefix=False, categorical=False, arrow=False):
+    """
+    Turn the results of a SPARQL query into a pandas dataframe, with a column per variable. Literals of the numeric
+    XSD types become integer or float columns and xsd:dateTime ones datetime columns (unless pandas can't hold one of
+    the dates, e.g. before the common era), other values are kept as strings. Each column is converted at once, instead of value by value.
+
+    :param results: the results of a query in JSON format, see `WDFunctionsEngine.execute_sparql_query`
+    :param strip_prefix: if True, IRIs starting with config['CONCEPT_BASE_URI'] are shortened to the entity ID, e.g.
+        'Q42'. A string is used as the prefix to strip instead.
+    :param categorical: if True, columns of IRIs are categorical, which takes much less memory for values repeated
+        over many rows, e.g. the properties or the classes of items
+    :param arrow: if True, columns of values of several types are turned into strings, so that the dataframe can be
+        written to Arrow or Parquet, which need a single type per column
+    :return: pandas.DataFrame
+    """
+    bindings = results['results']['bindings']
+    if strip_prefix is True:
+        strip_prefix = config['CONCEPT_BASE_URI']
+
+    # for each variable, in the order they first appear (like pd.DataFrame(list of dicts) has them): the rows it is
+    # bound in, its values and their datatypes
+    columns = dict()
+    for i, binding in enumerate(bindings):
+        for var, term in binding.items():
+            column = columns.get(var)
+            if column is None:
+                column = columns[var] = ([], [], [])
+            column[0].append(i)
+            column[1].append(term['value'])
+            # csv results only have the values
+            column[2].append(term.get('datatype') or term.get('type', 'literal'))
+
+    df = dict()
+    for var, (rows, values, kinds) in columns.items():
+        column = _to_column(rows, values, kinds, len(bindings), strip_prefix, categorical)
+        if arrow and column.dtype == object:
+            column = column.where(column.isna(), column.astype(str))
+        df[var] = column
+    return pd.DataFrame(df, index=pd.RangeIndex(len(bindings)))
@@ -0,0 +1,266 @@
+"""
+Routing of SPARQL queries to alternative endpoints.
+
+Fastrun pulls, id_mapper exports and other bulk queries can be sent to a mirror of the query service, e.g. a local
+QLever or Blazegraph loaded from a dump, while other queries still go to the main endpoint. Every query has a query
+class: 'bulk' for the large pulls, 'lookup' (the default) for everything else. A `SparqlRouter` has a list of
+mirrors per query class, which are tried in order, and falls back to the endpoint the query was meant for when none
+of them answers.
+
+A mirror that fails (connection error, error status, unreadable results) is left out for `health_check_interval`
+seconds. After that, a cheap `ASK {}` query checks whether it is back, and if so queries are routed to it again.
+
+A mirror may need the query in a different form:
+- `declare_prefixes`: the query service predefines prefixes like wd: and wdt:, most other stores don't. Declarations
+  are added for those of WIKIDATA_PREFIXES used but not declared in the query.
+- `iri_map`: {IRI prefix on the query service: IRI prefix on the mirror}, for a mirror loaded with other IRIs. The
+  IRIs in the query are rewritten, and those in the results are rewritten back.
+
+    from wikidataintegrator import wdi_sparql_router
+    router = wdi_sparql_router.SparqlRouter()
+    router.add_mirror('http://localhost:7001/sparql', query_classes=('bulk',), declare_prefixes=True)
+    wdi_sparql_router.set_router(router)
+
+Routing only applies to queries for the router's `primary` endpoint, by default config['SPARQL_ENDPOINT_URL'].
+"""
+
+import re
+import threading
+import time
+
+import requests
+
+from wikidataintegrator.wdi_config import config
+from wikidataintegrator.wdi_transport import get_transport
+
+# the prefixes predefined by the Wikidata query service, that queries of wikidataintegrator use
+WIKIDATA_PREFIXES = {
+    'wd': 'http://www.wikidata.org/entity/',
+    'wds': 'http://www.wikidata.org/entity/statement/',
+    'wdv': 'http://www.wikidata.org/value/',
+    'wdref': 'http://www.wikidata.org/reference/',
+    'wdt': 'http://www.wikidata.org/prop/direct/',
+    'wdtn': 'http://www.wikidata.org/prop/direct-normalized/',
+    'p': 'http://www.wikidata.org/prop/',
+    'ps': 'http://www.wikidata.org/prop/statement/',
+    'psv': 'http://www.wikidata.org/prop/statement/value/',
+    'psn': 'http://www.wikidata.org/prop/statement/value-normalized/',
+    'pq': 'http://www.wikidata.org/prop/qualifier/',
+    'pqv': 'http://www.wikidata.org/prop/qualifier/value/',
+    'pqn': 'http://www.wikidata.org/prop/qualifier/value-normalized/',
+    'pr': 'http://www.wikidata.org/prop/reference/',
+    'prv': 'http://www.wikidata.org/prop/reference/value/',
+    'prn': 'http://www.wikidata.org/prop/reference/value-normalized/',
+    'wdno': 'http://www.wikidata.org/prop/novalue/',
+    'wikibase': 'http://wikiba.se/ontology#',
+    'schema': 'http://schema.org/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'prov': 'http://www.w3.org/ns/prov#',
+    'bd': 'http://www.bigdata.com/rdf#',
+}
+
+_declared_re = re.compile(r'PREFIX\s+(\w*):', re.IGNORECASE)
+
+
+class SparqlMirror(object):
+    def __init__(self, url, query_classes=('bulk',), iri_map=None, declare_prefixes=False, max_retries=1,
+                 retry_after=5):
+        """
+        :param url: url of the SPARQL endpoint of the mirror
+        :param query_classes: the classes of the queries routed to the mirror
+        :param iri_map: dict of IRI prefixes on the query service to the ones used by the mirror instead
+        :param declare_prefixes: declare the prefixes of WIKIDATA_PREFIXES the query uses
+        :param max_retries: tries before the query falls back to the next endpoint
+        :param retry_after: seconds between the tries
+        """
+        self.url = url
+        self.query_classes = set(query_classes)
+        self.iri_map = dict(iri_map) if iri_map else dict()
+        self.declare_prefixes = declare_prefixes
+        self.max_retries = max_retries
+        self.retry_after = retry_after
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0
+        # longest first, so that nested prefixes are rewritten with the most specific mapping
+        self._reverse_map = sorted(((v, k) for k, v in self.iri_map.items()), key=lambda x: -len(x[0]))
+
+    def rewrite_query(self, query):
+        """
+        :return: the query in the form the mirror needs
+        """
+        if self.declare_prefixes:
+            declared = set(_declared_re.findall(query))
+            used = [prefix for prefix in WIKIDATA_PREFIXES if prefix not in declared and
+                    re.search(r'(?<![\w:/#?])' + prefix + r':', query)]
+            query = ''.join('PREFIX {}: <{}>\n'.format(prefix, WIKIDATA_PREFIXES[prefix]) for prefix in used) + query
+        for iri, mirror_iri in sorted(self.iri_map.items(), key=lambda x: -len(x[0])):
+            query = query.replace(iri, mirror_iri)
+        return query
+
+    def map_binding(self, binding):
+        """
+        :return: a binding of the mirror with the IRIs of the query service
+        """
+        if not self._reverse_map:
+            return binding
+        for term in binding.values():
+            value = term['value']
+            for mirror_iri, iri in self._reverse_map:
+                if value.startswith(mirror_iri):
+                    term['value'] = iri + value[len(mirror_iri):]
+                    break
+        return binding
+
+    def map_results(self, results):
+        """
+        :return: the results of the mirror in JSON format with the IRIs of the query service
+        """
+        if self._reverse_map:
+            for binding in results['results']['bindings']:
+                self.map_binding(binding)
+        return results
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items() if not k.startswith('_')),
+        )
+
+
+class SparqlRouter(object):
+    def __init__(self, primary=None, health_check_interval=60):
+        """
+        :param primary: url of the endpoint whose queries are routed. Default from config['SPARQL_ENDPOINT_URL']
+        :param health_check_interval: seconds a mirror is left out after it failed, before it is checked again
+        """
+        self.primary = config['SPARQL_ENDPOINT_URL'] if primary is None else primary
+        self.health_check_interval = health_check_interval
+        self.mirrors = []
+        self._lock = threading.Lock()
+
+    def add_mirror(self, url, query_classes=('bulk',), **kwargs):
+        """
+        Route queries of `query_classes` to a mirror. Mirrors are tried in the order they were added.
+
+        :param kwargs: see `SparqlMirror`
+        :return: the SparqlMirror
+        """
+        mirror = SparqlMirror(url, query_classes=query_classes, **kwargs)
+        self.mirrors.append(mirror)
+        return mirror
+
+    def check(self, mirror):
+        """
+        Check whether a mirror answers queries
+
+        :return: bool
+        """
+        try:
+            response = get_transport().post(mirror.url, data={'query': 'ASK {}', 'format': 'json'},
+                                            headers={'Accept': 'application/sparql-results+json',
+                                                     'User-Agent': config['USER_AGENT_DEFAULT']})
+            response.raise_for_status()
+            return 'boolean' in response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return False
+
+    def mark_failed(self, mirror, error=None):
+        with self._lock:
+            mirror.healthy = False
+            mirror.failures += 1
+            mirror.retry_at = time.time() + self.health_check_interval
+        print("SPARQL mirror {} failed ({}). Using the next endpoint for {} seconds".format(
+            mirror.url, error, self.health_check_interval))
+
+    def mark_healthy(self, mirror):
+        with self._lock:
+            mirror.healthy = True
+            mirror.failures = 0
+
+    def route(self, url, query_class='lookup'):
+        """
+        :param url: the endpoint the query is meant for
+        :return: list of the mirrors to try for the query, before `url`
+        """
+        if url != self.primary:
+            return []
+        mirrors = []
+        for mirror in self.mirrors:
+            if query_class not in mirror.query_classes:
+                continue
+            if not mirror.healthy:
+                if time.time() < mirror.retry_at:
+                    continue
+                if not self.check(mirror):
+                    self.mark_failed(mirror, "health check")
+                    continue
+                print("SPARQL mirror {} is back".format(mirror.url))
+                self.mark_healthy(mirror)
+            mirrors.append(mirror)
+        return mirrors
+
+    def run(self, query, url, query_class, func):
+        """
+        Run a query on the first mirror of its class that answers, or else on `url`
+
+        :param func: function(query, url, mirror=..., max_retries=..., retry_after=...) that runs the query on `url`,
+            in the form `mirror` needs (see `SparqlMirror.rewrite_query`) if one is given, and returns something
+            other than None if it succeeded
+        :return: tuple of the mirror that answered (None for `url`) and the return value of `func`
+        """
+        for mirror in self.route(url, query_class):
+            try:
+                result = func(query, mirror.url, mirror=mirror, max_retries=mirror.max_retries,
+                              retry_after=mirror.retry_after)
+            except requests.exceptions.HTTPError as e:
+                # the mirror may not support everything the query uses, which doesn't make it unhealthy
+                if e.response is not None and 400 <= e.response.status_code < 500:
+                    print("SPARQL mirror {} can't answer the query: {}".format(mirror.url, e))
+                else:
+                    self.mark_failed(mirror, e)
+                continue
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.mark_failed(mirror, e)
+                continue
+            if result is None:
+                self.mark_failed(mirror, "no response")
+                continue
+            return mirror, result
+        return None, func(query, url)
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items() if not k.startswith('_')),
+        )
+
+
+_router = None
+
+
+def get_router():
+    """
+    :return: the SparqlRouter used for all queries, or None if queries are not routed
+    """
+    return _router
+
+
+def set_router(router):
+    """
+    Route the queries of the process with `router`
+
+    :param router: SparqlRouter, or None to send the queries to the endpoints they are meant for
+    """
+    global _router
+    _router = router
@@ -0,0 +1,150 @@
+"""
+Splitting of SPARQL queries that time out.
+
+When the query service gives up on a query after its time limit, sending the same query again fails the same way.
+`split_query` rewrites such a query into smaller ones whose results, put together with `merge_results`, are the
+results of the original query. In order of preference, it:
+
+- halves an ordered LIMIT window: `ORDER BY ?x LIMIT n OFFSET o` becomes two windows of n/2 (used by the paged
+  fastrun queries)
+- halves the largest VALUES block, if that can't change what an aggregate, LIMIT or DISTINCT returns
+- shards the items (the ?item variable) by their ID: Q1..., Q2..., ..., Q9... and all others, then Q10..., Q11...
+  within a shard that times out again
+"""
+
+import json
+import re
+
+from wikidataintegrator.wdi_config import config
+
+# an RDF term, or anything else up to the next whitespace (e.g. UNDEF, prefixed names, numbers)
+_term = r'"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^\S+)?|\'(?:[^\'\\]|\\.)*\'(?:@[\w-]+|\^\^\S+)?|<[^>\s]*>|[^\s(){}]+'
+_term_re = re.compile(_term)
+_row_re = re.compile(r'\((?:\s*(?:' + _term + r'))*\s*\)')
+_values_re = re.compile(r'VALUES\s*(\?\w+|\((?:\s*\?\w+)*\s*\))\s*\{', re.IGNORECASE)
+_limit_re = re.compile(r'(ORDER\s+BY[^{}]*?)LIMIT\s+(\d+)(?:\s+OFFSET\s+(\d+))?', re.IGNORECASE)
+_aggregate_re = re.compile(r'\b(GROUP\s+BY|COUNT|SUM|AVG|MIN|MAX|SAMPLE|GROUP_CONCAT)\b', re.IGNORECASE)
+_group_by_re = re.compile(r'GROUP\s+BY((?:\s+\?\w+)+)', re.IGNORECASE)
+_shard_re = re.compile(r'\n *FILTER\(STRSTARTS\(STR\(\?item\), "[^"]*"\)\) #wdi-shard (Q\d+)\n')
+_string_re = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+
+
+def _block_end(query, pos):
+    # position of the } closing the block that starts at pos, skipping over strings
+    depth = 1
+    while depth:
+        m = _string_re.match(query, pos)
+        if m:
+            pos = m.end()
+            continue
+        c = query[pos]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        pos += 1
+    return pos - 1
+
+
+def _split_limit(query):
+    for m in _limit_re.finditer(query):
+        limit = int(m.group(2))
+        if limit < 2:
+            continue
+        offset = int(m.group(3) or 0)
+        half = limit // 2
+        parts = []
+        for part_limit, part_offset in ((half, offset), (limit - half, offset + half)):
+            window = "LIMIT {}".format(part_limit) + (" OFFSET {}".format(part_offset) if part_offset else "")
+            parts.append(query[:m.start()] + m.group(1) + window + query[m.end():])
+        return parts
+    return None
+
+
+def _aggregates_allow(query, variables):
+    # splitting on `variables` doesn't change the results of the aggregates if every group is within one part
+    if not _aggregate_re.search(query):
+        return True
+    group_bys = [set(m.group(1).split()) for m in _group_by_re.finditer(query)]
+    return bool(group_bys) and all(set(variables) <= group_by for group_by in group_bys)
+
+
+def _split_values(query):
+    if re.search(r'\bLIMIT\b', query, re.IGNORECASE):
+        return None
+    best = None
+    for m in _values_re.finditer(query):
+        end = _block_end(query, m.end())
+        variables = re.findall(r'\?\w+', m.group(1))
+        content = query[m.end():end]
+        rows = _term_re.findall(content) if m.group(1).startswith('?') else _row_re.findall(content)
+        if len(rows) >= 2 and _aggregates_allow(query, variables) and (best is None or len(rows) > len(best[2])):
+            best = (m.end(), end, rows)
+    if best is None:
+        return None
+    start, end, rows = best
+    half = len(rows) // 2
+    return [query[:start] + ' ' + ' '.join(part) + ' ' + query[end:] for part in (rows[:half], rows[half:])]
+
+
+def _split_items(query):
+    if '?item' not in query or re.search(r'\bLIMIT\b', query, re.IGNORECASE) or \
+            not _aggregates_allow(query, ['?item']):
+        return None
+    entity = config['CONCEPT_BASE_URI']
+
+    m = _shard_re.search(query)
+    if m:
+        # refine the shard of the items starting with some ID
+        prefix = m.group(1)
+        shards = ['FILTER(STR(?item) = "{}{}")'.format(entity, prefix)]
+        shards += ['FILTER(STRSTARTS(STR(?item), "{0}{1}{2}")) #wdi-shard {1}{2}'.format(entity, prefix, d)
+                   for d in range(10)]
+        return [query[:m.start()] + '\n' + shard + '\n' + query[m.end():] for shard in shards]
+
+    if '#wdi-shard' in query or 'FILTER(STR(?item) = ' in query:
+        return None
+    shards = ['FILTER(STRSTARTS(STR(?item), "{0}Q{1}")) #wdi-shard Q{1}'.format(entity, d) for d in range(1, 10)]
+    shards.append('FILTER(!STRSTARTS(STR(?item), "{}Q")) #wdi-shard other'.format(entity))
+    end = query.rindex('}')
+    return [query[:end] + '\n' + shard + '\n' + query[end:] for shard in shards]
+
+
+def split_query(query):
+    """
+    Rewrite a query into smaller ones, see the module documentation
+
+    :param query: SPARQL query string
+    :return: list of query strings whose results together are those of `query`, or None if it can't be split
+    """
+    for split in (_split_limit, _split_values, _split_items):
+        parts = split(query)
+        if parts:
+            return parts
+    return None
+
+
+def merge_results(query, results):
+    """
+    Put the results of the parts of a split query back together
+
+    :param query: the query that was split
+    :param results: list of the results of the parts in JSON format, in order
+    :return: the results of `query` in JSON format
+    """
+    variables = []
+    bindings = []
+    for result in results:
+        variables.extend(v for v in result['head'].get('vars', []) if v not in variables)
+        bindings.extend(result['results']['bindings'])
+
+    if re.search(r'SELECT\s+(DISTINCT|REDUCED)\b', query, re.IGNORECASE):
+        seen = set()
+        unique = []
+        for binding in bindings:
+            key = json.dumps(binding, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                unique.append(binding)
+        bindings = unique
+    return {'head': {'vars': variables}, 'results': {'bindings': bindings}}
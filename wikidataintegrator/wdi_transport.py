@@ -0,0 +1,116 @@
+"""
+Shared HTTP transport for the wikibase api, the query service and other web services.
+
+All requests go through one `requests.Session` with keep-alive connection pools, so consecutive calls to the same host
+reuse their connection instead of doing a new TCP and TLS handshake every time. Responses are gzip compressed when
+the server supports it.
+
+The transport can be replaced at run time, e.g. to use a different adapter or to add retries:
+
+    from requests.adapters import HTTPAdapter
+    from wikidataintegrator import wdi_transport
+    wdi_transport.set_transport(wdi_transport.WDTransport(adapter=HTTPAdapter(pool_maxsize=50)))
+
+Options (see wdi_config):
+HTTP_TIMEOUT: (connect, read) timeout in seconds passed to every request, unless the caller passes one
+HTTP_POOL_CONNECTIONS: number of hosts to keep a connection pool for
+HTTP_POOL_MAXSIZE: maximum number of connections kept open per host
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from wikidataintegrator.wdi_config import config
+
+
+class WDTransport(object):
+    def __init__(self, adapter=None, timeout=None, pool_connections=None, pool_maxsize=None):
+        """
+        :param adapter: transport adapter mounted for http and https, default is a pooling `HTTPAdapter`
+        :type adapter: requests.adapters.BaseAdapter
+        :param timeout: default timeout of the requests, see `requests.request`. Default from config['HTTP_TIMEOUT']
+        :param pool_connections: number of hosts to keep a connection pool for
+        :type pool_connections: int
+        :param pool_maxsize: maximum number of connections kept open per host
+        :type pool_maxsize: int
+        """
+        self.timeout = config['HTTP_TIMEOUT'] if timeout is None else timeout
+        if adapter is None:
+            adapter = HTTPAdapter(
+                pool_connections=config['HTTP_POOL_CONNECTIONS'] if pool_connections is None else pool_connections,
+                pool_maxsize=config['HTTP_POOL_MAXSIZE'] if pool_maxsize is None else pool_maxsize)
+        self.adapter = adapter
+
+        self.session = requests.Session()
+        # the session is shared by all callers, so it must not keep cookies set in reply to a logged in request
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.mount(self.session)
+
+    def mount(self, session):
+        """
+        Let another session (e.g. the one of a `WDLogin`, which has to keep its own cookies) use the connection pools
+        of this transport
+
+        :param session: requests.Session
+        """
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, see `requests.request`
+
+        :return: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    """A mixin implementing a simple __repr__."""
+
+    def __repr__(self):
+        return "<{klass} @{id:x} {attrs}>".format(
+            klass=self.__class__.__name__,
+            id=id(self) & 0xFFFFFF,
+            attrs=" ".join("{}={!r}".format(k, v) for k, v in self.__dict__.items()),
+        )
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    The transport used by wikidataintegrator, created on first use
+
+    :return: WDTransport
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = WDTransport()
+    return _transport
+
+
+def set_transport(transport):
+    """
+    Replace the transport used by wikidataintegrator
+
+    :param transport: WDTransport, or None to create a new default one on next use
+    """
+    global _transport
+    with _transport_lock:
+        _transport = transport